@@ -8,21 +8,22 @@ Noms et numéros étudiants:
 
 import argparse
 import getpass
-import json
-import socket
 import sys
-import getpass
 
+import gloclient
 import glosocket
 import gloutils
 
 
 class Client:
-    """Client pour le serveur mail @glo2000.ca."""
+    """
+    Client interactif pour le serveur mail @glo2000.ca: une couche de menus
+    au-dessus de l'API `gloclient.GloClient`.
+    """
 
     def __init__(self, destination: str) -> None:
         """
-        Prépare et connecte le socket du client `_socket`.
+        Prépare et connecte le client `_client`, limité à une connexion.
 
         Prépare un attribut `_username` pour stocker le nom d'utilisateur
         courant. Laissé vide quand l'utilisateur n'est pas connecté.
@@ -30,10 +31,9 @@ class Client:
         #Initialisaition De l'attribut username
         self._username = ""
         try:
-                # Création et connexion du socket
-                self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                # Connecter au serveur
-                self._socket.connect((destination, gloutils.APP_PORT))
+                # Création et connexion du client
+                self._client = gloclient.GloClient(destination, pool_size=1)
+                self._client.connect()
                 print(f"Connexion au serveur {destination} établie.")
         except glosocket.GLOSocketError as e:
                 print(f"Échec de l'initialisation du client : {e}")
@@ -52,27 +52,13 @@ class Client:
         password = getpass.getpass("Entrez votre mot de passe : ")
 
         try:
-            #Creation de la requete et envoi au serveur
-            message = gloutils.GloMessage(header=gloutils.Headers.AUTH_REGISTER,
-                                        payload=gloutils.AuthPayload(
-                                        username=username,
-                                        password=password))
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-
-            #Reponse du serveur
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
-
-            #Traitement de la reponse du serveur
-            if reponse["header"] == gloutils.Headers.OK:
-                print("Création du compte réussie !")
-                self._username = username
-            elif reponse["header"] == gloutils.Headers.ERROR :
-                print(reponse["payload"]["error_message"])
-
+            self._client.register(username, password)
+            print("Création du compte réussie !")
+            self._username = username
+        except gloclient.GloServerError as e:
+            print(e)
         except glosocket.GLOSocketError as e:
             print(f"Erreur de communication avec le serveur : {e}")
-        
-
 
     def _login(self) -> None:
         """
@@ -88,112 +74,137 @@ class Client:
         password = getpass.getpass("Entrez votre mot de passe : ")
 
         try :
-            #Creation et envoi de la requete
-            message = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGIN,
-                                        payload=gloutils.AuthPayload(
-                                        username=username,
-                                        password=password))
-
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-
-            #Trairement de la réponse
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
-
-            if reponse["header"] == gloutils.Headers.OK:
-                print(f"Connexion réussie. Bienvenue {username} !")
-                self._username = username
-            elif reponse["header"] == gloutils.Headers.ERROR :
-                print(reponse["payload"]["error_message"])
-
+            self._client.login(username, password)
+            print(f"Connexion réussie. Bienvenue {username} !")
+            self._username = username
+        except gloclient.GloServerError as e:
+            print(e)
         except glosocket.GLOSocketError as e:
             print(f"Erreur de communication avec le serveur : {e}")
 
 
     def _quit(self) -> None:
         """
-        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
-        socket du client.
+        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme la
+        connexion du client.
         """
-        try :
-            #Message de deconnexion
-            message = gloutils.GloMessage(header=gloutils.Headers.BYE)
-
-            #Envoyer le message au serveur et fermer le socket
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-            print("Déconnexion réussie.")
-            self._socket.close()
-
-        except glosocket.GLOSocketError as e:
-            print(f"Échec de la déconnexion du serveur : {e}")
+        self._client.close()
+        print("Déconnexion réussie.")
 
     def _read_email(self) -> None:
         """
         Demande au serveur la liste de ses courriels avec l'entête
         `INBOX_READING_REQUEST`.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
-
-        Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
+        Affiche la liste des courriels page par page puis affiche le
+        courriel choisi par l'utilisateur (voir `_show_email`).
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
 
         try:
-            # Demander et afficher la liste des courriels
-            message = gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST)
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
-            # Vérification de la réponse du serveur
-            if reponse["header"] != gloutils.Headers.OK:
-                print(reponse["payload"].get("error_message", "Erreur inconnue du serveur."))
-                return
-
-            # Recuperer la liste des courriels
-            email_list = reponse["payload"]["email_list"]
-            if not email_list:
-                print("Aucun courriel.")
-                return
-
-            # Affichage des courriels
-            for email in email_list:
-                print(email)
-
-            # Demande du choix de l'utilisateur
+            offset = 0
             while True:
-                choice = input("Entrez le numéro du courriel à consulter : ").strip()
-                if choice.isdigit() and 1 <= int(choice) <= len(email_list):
-                    choice = int(choice)
+                # Demander et afficher une page de la liste des courriels
+                page = self._client.list_emails(offset, gloutils.INBOX_PAGE_SIZE)
+
+                # Recuperer la page des courriels et leurs identifiants
+                email_list = page["email_list"]
+                email_ids = page["email_ids"]
+                offset = page["offset"]
+                total = page["total"]
+                if not total:
+                    print("Aucun courriel.")
+                    return
+
+                # Affichage des courriels de la page
+                for email in email_list:
+                    print(email)
+                has_next = offset + len(email_list) < total
+                has_previous = offset > 0
+                print(f"Courriels {offset + 1} à {offset + len(email_list)} sur {total}.")
+
+                # Demande du choix de l'utilisateur
+                prompt = "Entrez le numéro du courriel à consulter"
+                if has_next:
+                    prompt += ", 'n' pour la page suivante"
+                if has_previous:
+                    prompt += ", 'p' pour la page précédente"
+                choice = input(prompt + " : ").strip().lower()
+                if choice == "n" and has_next:
+                    offset += len(email_list)
+                    continue
+                if choice == "p" and has_previous:
+                    offset = max(0, offset - gloutils.INBOX_PAGE_SIZE)
+                    continue
+                if choice.isdigit() and offset < int(choice) <= offset + len(email_list):
+                    choice = int(choice) - offset
                     break
                 print("Choix invalide.")
 
-            # Envoyer le choix de l'utilisateur au serveur
-            email_choice_payload = {"choice": choice}
-            message = gloutils.GloMessage(
-                header=gloutils.Headers.INBOX_READING_CHOICE,
-                payload=email_choice_payload
-            )
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
-
-            # Verification de la réponse du serveur pour le choix
-            if reponse["header"] != gloutils.Headers.OK:
-                print(reponse['payload']['error_message'])
-                return
+            self._show_email(email_ids[choice - 1])
+        except gloclient.GloServerError as e:
+            print(e)
+        except glosocket.GLOSocketError:
+            print("Échec de la consultation des courriels.")
+
+    def _show_email(self, email_id: int) -> None:
+        """
+        Demande le courriel `email_id`, reçu par morceaux, et l'affiche à
+        l'aide du gabarit `EMAIL_DISPLAY` au fur et à mesure de sa réception.
 
-            # Affichage du courriel
-            email = reponse["payload"]
-            print(gloutils.EMAIL_DISPLAY.format(
+        Lève une exception GloServerError si le courriel n'existe pas et
+        GLOSocketError en cas de problème de communication.
+        """
+        with self._client.open_email(email_id) as (email, morceaux):
+            # Affichage du courriel au fur et à mesure de sa réception
+            debut, fin = gloutils.EMAIL_DISPLAY.split("{body}")
+            print(debut.format(
                 sender=email["sender"],
                 to=email["destination"],
                 subject=email["subject"],
-                date=email["date"],
-                body=email["content"]
-            ))
-        except glosocket.GLOSocketError:
-            print("Échec de la consultation des courriels.")
+                date=email["date"]
+            ), end="")
+            for morceau in morceaux:
+                print(morceau, end="")
+            print(fin)
+
+
+    def _search_email(self) -> None:
+        """
+        Demande à l'utilisateur les mots à chercher (`from:` et `subject:`
+        restreignent un mot à l'expéditeur ou au sujet) et les transmet avec
+        l'entête `INBOX_SEARCH`.
+
+        Affiche les courriels trouvés puis, au choix de l'utilisateur, le
+        courriel choisi (voir `_show_email`).
+        """
+        query = input("Mots à chercher (from:, subject: pour un champ) : ")
+        try:
+            resultats = self._client.search(query, gloutils.INBOX_MAX_PAGE_SIZE)
+            email_list = resultats["email_list"]
+            email_ids = resultats["email_ids"]
+            total = resultats["total"]
+            if not total:
+                print("Aucun courriel trouvé.")
+                return
+            for email in email_list:
+                print(email)
+            print(f"{len(email_list)} courriel(s) affiché(s) sur {total} trouvé(s).")
 
+            choice = input("Entrez le numéro du courriel à consulter"
+                           " (vide pour revenir au menu) : ").strip()
+            if not choice:
+                return
+            if not choice.isdigit() or not 0 < int(choice) <= len(email_list):
+                print("Choix invalide.")
+                return
+            self._show_email(email_ids[int(choice) - 1])
+        except gloclient.GloServerError as e:
+            print(e)
+        except glosocket.GLOSocketError:
+            print("Échec de la recherche de courriels.")
 
     def _send_email(self) -> None:
         """
@@ -204,77 +215,67 @@ class Client:
 
         La saisie du corps se termine par un point seul sur une ligne.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Transmet ces informations avec l'entête `EMAIL_SENDING`, ou avec
+        l'entête `EMAIL_BATCH_SENDING` si plusieurs destinataires séparés
+        par des virgules sont saisis. Un corps d'au moins
+        `EMAIL_STREAM_THRESHOLD` caractères est plutôt transmis par morceaux
+        à chaque destinataire (voir `gloclient.GloClient.send_batch`).
         """
         #Demande du destinataire et du sujet
-        destinataire = input("Entrez l'adresse email du destinataire : ")
+        destinataire = input("Entrez l'adresse email du destinataire "
+                             "(plusieurs adresses séparées par des virgules) : ")
+        destinataires = [adresse.strip().lower() for adresse in destinataire.split(",")
+                         if adresse.strip()]
         sujet = input("Entrez le sujet du message : ")
 
         #Entrer le corps du message
-        corps = ""
+        lignes = []
         print("Entrez le contenu du courriel (Terminer la saisie avec un '.' seul sur une ligne) :")
         while (line := input()) != ".":
-            corps += line + "\n"
+            lignes.append(line + "\n")
+        contenu = "".join(lignes)
         try :
             #Transmission des informations
-            message = gloutils.GloMessage(header=gloutils.Headers.EMAIL_SENDING,
-                                        payload=gloutils.EmailContentPayload(
-                                        sender=self._username + "@glo2000.ca",
-                                        destination=destinataire.lower(),
-                                        subject=sujet,
-                                        date=gloutils.get_current_utc_time(),
-                                        content=corps))
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-
-            #Traitement de la reponse
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
-            if reponse["header"] == gloutils.Headers.OK:
+            if len(destinataires) <= 1:
+                self._client.send_email(destinataire.strip().lower(), sujet, contenu)
                 print("Courriel envoyé avec succès !")
-            else:
-                print(reponse['payload']['error_message'])
+                return
+
+            for resultat in self._client.send_batch(destinataires, sujet, contenu):
+                if resultat["header"] == gloutils.Headers.OK:
+                    print(f"{resultat['destination']} : courriel envoyé avec succès !")
+                else:
+                    print(f"{resultat['destination']} : {resultat['error_message']}")
+        except gloclient.GloServerError as e:
+            print(e)
         except(glosocket.GLOSocketError) as e:
             print(f"Échec de l'envoi du courriel : {e}")
 
-
-
     def _check_stats(self) -> None:
         """
         Demande les statistiques au serveur avec l'entête `STATS_REQUEST`.
 
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
-        #Préparer la requête pour demander les statistiques
         try :
-            message = gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-
-            #Traitement de la reponse
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
-
-            if reponse["header"] == gloutils.Headers.OK:
-                stats = reponse["payload"]
-                print(gloutils.STATS_DISPLAY.format(
-                    count=stats["count"],
-                    size=stats["size"]))
-            else :
-                print(reponse["payload"]["error_message"])
+            stats = self._client.stats()
+            print(gloutils.STATS_DISPLAY.format(
+                count=stats["count"],
+                size=stats["size"]))
+        except gloclient.GloServerError as e:
+            print(e)
         except(glosocket.GLOSocketError):
             print("Échec de la requête de statistiques au serveur.")
 
     def _logout(self) -> None:
         """
-        Préviens le serveur avec l'entête `AUTH_LOGOUT`.
+        Ferme la session de l'utilisateur.
 
         Met à jour l'attribut `_username`.
         """
-        try:
-            #Requete de deconnexion
-            message = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT)
-            glosocket.snd_mesg(self._socket, json.dumps(message))
-            self._username = ""
-            print("Déconnexion au compte réussie!")
-        except glosocket.GLOSocketError as e :
-            print(f"Échec de la demande de déconnexion au serveur : {e}")
+        self._client.logout()
+        self._username = ""
+        print("Déconnexion au compte réussie!")
 
 
     def run(self) -> None:
@@ -316,6 +317,9 @@ class Client:
                 elif choice == "4":
                     # Se déconnecter
                     self._logout()
+                elif choice == "5":
+                    # Rechercher des courriels
+                    self._search_email()
                 else:
                     print("Choix invalide, veuillez réessayer.")
 
@@ -6,85 +6,569 @@ Noms et numéros étudiants:
 -
 -
 """
-import hashlib
-import hmac
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import json
+import multiprocessing
 import os
-import select
+import selectors
 import socket
 import sys
 import re
-import struct
-
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows: un seul processus, pas de verrou inter-processus
+    fcntl = None
+
+import gloauth
+import glocodec
+import glometrics
+import glosearch
 import glosocket
+import glostorage
 import gloutils
 
 
+_SENDING_HEADERS = (gloutils.Headers.EMAIL_SENDING, gloutils.Headers.EMAIL_BATCH_SENDING)
+_HEADER_NAMES = {header.value: header.name for header in gloutils.Headers}
+
+
+class _Connection:
+    """
+    État d'une connexion client non bloquante: le tampon des octets reçus
+    (`buffer`), les messages complets en attente de traitement (`pending`),
+    si un message est en cours de traitement dans le pool (`busy`), la
+    réponse en flux en cours de transmission (`stream`), les réponses
+    prêtes ou en attente de leur livraison (`deferred`, dans l'ordre), si
+    la première attend sa livraison (`waiting`), les octets des réponses
+    pas encore transmises (`outgoing`) et les événements actuellement
+    surveillés par le sélecteur (`events`).
+    """
+
+    def __init__(self, soc: socket.socket) -> None:
+        self.soc = soc
+        self.buffer = glosocket.FrameBuffer(gloutils.MAX_FRAME_SIZE)
+        self.pending: collections.deque[bytes] = collections.deque()
+        self.busy = False
+        self.stream: Optional[Iterator[gloutils.GloMessage]] = None
+        self.deferred: collections.deque[Union[bytes, concurrent.futures.Future]] = \
+            collections.deque()
+        self.waiting = False
+        self.outgoing = bytearray()
+        self.events = selectors.EVENT_READ
+
+
+_CONTENT_MARKER = b'"content": "'
+
+
+def _json_string_cut(data: bytes) -> int:
+    """
+    Retourne la taille du plus long début de `data` (contenu brut d'une
+    chaîne JSON) qui ne coupe ni un caractère UTF-8, ni une séquence
+    d'échappement, ni une paire de substitution `\\uD83D\\uDE00`.
+    """
+    cut = len(data)
+    # Caractère UTF-8 incomplet à la fin
+    start = cut
+    while start > 0 and cut - start < 3 and data[start - 1] & 0xC0 == 0x80:
+        start -= 1
+    if start > 0 and data[start - 1] >= 0xC0:
+        lead = data[start - 1]
+        if cut - start + 1 < (2 if lead < 0xE0 else 3 if lead < 0xF0 else 4):
+            cut = start - 1
+    # Séquence d'échappement incomplète, ou demi-paire de substitution
+    while True:
+        backslash = data.rfind(b"\\", max(0, cut - 6), cut)
+        if backslash < 0:
+            return cut
+        run = 1
+        while backslash - run >= 0 and data[backslash - run] == ord("\\"):
+            run += 1
+        if run % 2 == 0:
+            # La dernière barre oblique est elle-même échappée
+            return cut
+        if data[backslash + 1:backslash + 2] == b"u":
+            end = backslash + 6
+            if end < cut:
+                return cut
+            if end == cut and not 0xD800 <= int(data[backslash + 2:end], 16) < 0xDC00:
+                return cut
+        elif backslash + 2 <= cut:
+            return cut
+        cut = backslash
+
+
+def _decode_json_string(chunks: Iterable[bytes]) -> Iterator[str]:
+    """
+    Décode morceau par morceau le contenu brut (sans guillemets) d'une
+    chaîne JSON lue par blocs.
+
+    Lève une exception ValueError si le contenu est invalide.
+    """
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk
+        cut = _json_string_cut(data)
+        pending = data[cut:]
+        if cut:
+            yield json.loads(b'"' + data[:cut] + b'"')
+    if pending:
+        yield json.loads(b'"' + pending + b'"')
+
+
+def _tag_stream(messages: Iterator[gloutils.GloMessage],
+                request_id: int) -> Iterator[gloutils.GloMessage]:
+    """Recopie `request_id` dans chaque message d'une réponse en flux."""
+    for message in messages:
+        message["request_id"] = request_id
+        yield message
+
+
+def _then(future: concurrent.futures.Future,
+          callback: Callable[[object], object]) -> concurrent.futures.Future:
+    """
+    Retourne un futur résolu par `callback` appliqué au résultat de
+    `future`, ou par l'exception de l'un ou de l'autre.
+    """
+    chained = concurrent.futures.Future()
+
+    def resolve(done: concurrent.futures.Future) -> None:
+        try:
+            chained.set_result(callback(done.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(resolve)
+    return chained
+
+
+class _DeliveryQueue:
+    """
+    File de livraison à validation groupée (group commit).
+
+    Les livraisons soumises sont accumulées pendant au plus
+    `DELIVERY_MAX_LATENCY` secondes après la première, ou jusqu'à
+    `DELIVERY_MAX_BATCH` courriels, puis écrites par un fil dédié,
+    regroupées par boîte et synchronisées sur le disque (fsync) en une
+    seule fois pour tout le lot. Le futur de chaque livraison n'est résolu
+    qu'une fois le lot sur le disque.
+    """
+
+    def __init__(self, storage: glostorage.Storage) -> None:
+        self._storage = storage
+        self._condition = threading.Condition()
+        self._pending: list[tuple[dict[str, list[dict]], concurrent.futures.Future]] = []
+        self._count = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, deliveries: dict[str, list[dict]]) -> concurrent.futures.Future:
+        """
+        Soumet des courriels à livrer, par nom d'utilisateur, et retourne un
+        futur résolu par l'erreur de chaque boîte dont la livraison a échoué,
+        une fois le lot synchronisé sur le disque: OSError pour une erreur
+        d'écriture, toute autre exception pour un courriel refusé par le
+        stockage.
+        """
+        future = concurrent.futures.Future()
+        with self._condition:
+            self._pending.append((deliveries, future))
+            self._count += sum(map(len, deliveries.values()))
+            self._condition.notify()
+        return future
+
+    def _run(self) -> None:
+        """Boucle du fil de livraison: attend, regroupe et valide les lots."""
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = time.monotonic() + gloutils.DELIVERY_MAX_LATENCY
+                while self._count < gloutils.DELIVERY_MAX_BATCH:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending, self._count = self._pending, [], 0
+            self._commit(batch)
+
+    def _commit(self, batch: list[tuple[dict[str, list[dict]],
+                                        concurrent.futures.Future]]) -> None:
+        """Livre un lot regroupé par boîte et résout les futurs de ses livraisons."""
+        by_mailbox: dict[str, list[dict]] = {}
+        for deliveries, _ in batch:
+            for username, payloads in deliveries.items():
+                by_mailbox.setdefault(username, []).extend(payloads)
+        try:
+            errors: dict[str, Exception] = self._storage.deliver_many(by_mailbox, sync=True)
+        except Exception as e:
+            # Une livraison ne peut être isolée du lot sans risquer de livrer
+            # deux fois les autres: tout le lot échoue, sans arrêter le fil
+            print(f"Erreur : Livraison du lot impossible. {e}")
+            errors = {username: e for username in by_mailbox}
+        for deliveries, future in batch:
+            future.set_result({username: errors[username]
+                               for username in deliveries if username in errors})
+
+
+class _EmailUpload:
+    """
+    Courriel reçu par morceaux (`EMAIL_STREAM_*`).
+
+    Le fichier JSON du courriel est écrit au fil de la réception dans un
+    fichier temporaire du dossier des courriels perdus, puis livré à la fin
+    du transfert à la boîte `destination`. `failure` est la réponse d'échec
+    déjà connue au début du transfert (le courriel est tout de même conservé
+    si `destination` est le dossier des courriels perdus) et `error` une
+    erreur survenue pendant le transfert. Les mots du corps sont collectés
+    au passage pour l'index de recherche (`terms`). Les méthodes peuvent
+    être appelées depuis différents fils.
+    """
+
+    def __init__(self, payload: gloutils.EmailStreamPayload, destination: Optional[str],
+                 failure: Optional[gloutils.GloMessage]) -> None:
+        self.payload = payload
+        self.destination = destination
+        self.failure = failure
+        self.error: Optional[str] = None
+        self.size = 0
+        self.terms = glosearch.TermCollector()
+        self.temp_path: Optional[str] = None
+        self._file = None
+        self._lock = threading.Lock()
+        if destination is None:
+            return
+        try:
+            descriptor, self.temp_path = tempfile.mkstemp(
+                dir=os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR),
+                prefix=".", suffix=".part")
+            self._file = os.fdopen(descriptor, 'w', encoding='utf-8')
+            # En-tête du JSON jusqu'au guillemet ouvrant du corps
+            self._write(json.dumps(gloutils.EmailContentPayload(
+                sender=payload["sender"], destination=payload["destination"],
+                subject=payload["subject"], date=payload["date"], content=""))[:-2])
+        except OSError:
+            self.error = "Erreur lors de l'écriture du fichier de courriel."
+            self.abort()
+
+    def _write(self, text: str) -> None:
+        self._file.write(text)
+        self.size += len(text)
+
+    def write(self, data: str) -> None:
+        """Ajoute un morceau du corps, échappé comme dans une chaîne JSON."""
+        with self._lock:
+            if self._file is None:
+                return
+            if not isinstance(data, str):
+                self.error = "Morceau de courriel invalide."
+                return
+            try:
+                self._write(json.dumps(data)[1:-1])
+                self.terms.feed(data)
+            except OSError:
+                self.error = "Erreur lors de l'écriture du fichier de courriel."
+
+    def finish(self) -> int:
+        """
+        Termine et ferme le fichier temporaire, puis retourne sa taille.
+
+        Lève une exception OSError en cas d'erreur d'écriture.
+        """
+        with self._lock:
+            self._write('"}')
+            self._file.close()
+            self._file = None
+            return self.size
+
+    def abort(self) -> None:
+        """Abandonne le transfert et supprime le fichier temporaire."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.temp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(self.temp_path)
+                self.temp_path = None
+
+
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, shared: bool = False,
+                 threads: int = gloutils.SERVER_THREADS,
+                 compress_threshold: int = gloutils.COMPRESSION_THRESHOLD,
+                 storage: str = gloutils.SERVER_STORAGE,
+                 port: int = gloutils.APP_PORT,
+                 metrics_port: Optional[int] = None,
+                 metrics_admin: Optional[str] = None) -> None:
         """
-        Prépare le socket du serveur `_server_socket`
-        et le met en mode écoute.
+        Prépare le socket du serveur `_server_socket`, le met en mode écoute
+        sur le port `port` et l'enregistre auprès du sélecteur `_selector`
+        (epoll sous Linux).
+
+        Les réponses d'au moins `compress_threshold` octets sont compressées
+        pour les clients qui l'ont négocié.
+
+        Les traitements (disque) s'exécutent dans un pool de `threads` fils
+        `_executor`. Leurs résultats sont renvoyés à la boucle par la file
+        `_callbacks`, signalée par le socket `_wakeup_recv`. Le hachage des
+        mots de passe (voir gloauth) s'exécute dans son propre pool
+        `_hashing`, sans occuper celui des traitements.
+
+        Les comptes et les boîtes sont conservés par le moteur de stockage
+        `storage` (voir `glostorage.STORAGES`), `_storage`. Les courriels
+        envoyés y sont livrés par la file à validation groupée `_deliveries`.
+        Les comptes et leurs hachages sont gardés en mémoire par
+        l'annuaire `_users`, chargé au démarrage. Les jetons de session
+        sont signés par la clé `_session_secret`, lue (ou générée) dans le
+        dossier de données: tous les processus du serveur la partagent.
+
+        Les métriques du processus (voir glometrics) sont tenues par
+        `_metrics`: latence de chaque requête, octets, connexions, sessions
+        et durée des appels au stockage. Si `metrics_port` est donné, elles
+        sont servies en HTTP sur ce port, lié à la boucle locale. L'entête
+        `METRICS` ne les transmet qu'à la session du compte `metrics_admin`;
+        sans ce compte, il est refusé à tous.
+
+        Si `shared` est vrai, le serveur est un processus parmi d'autres:
+        le socket est lié avec SO_REUSEPORT et le stockage verrouille les
+        boîtes entre les processus (voir `glostorage.Storage`).
 
         Prépare les attributs suivants:
-        - `_client_socs` une liste des sockets clients.
+        - `_connections` un dictionnaire associant chaque socket client
+            à son état de connexion (`_Connection`).
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
-
-        S'assure que les dossiers de données du serveur existent.
+        - `_capabilities` un dictionnaire associant chaque socket client
+            à l'encodage et à la compression négociés pour ses réponses
+            (JSON sans compression par défaut).
+        - `_uploads` un dictionnaire associant chaque socket client au
+            courriel qu'il transfère par morceaux (`_EmailUpload`).
+        - `_deferred` un dictionnaire associant chaque socket client aux
+            futurs de ses réponses pas encore prêtes (voir `_dispatch_all`).
+
+        S'assure que les dossiers de données du serveur existent et charge
+        les compteurs des boîtes.
         """
-        self._client_socs = []
+        self._selector = selectors.DefaultSelector()
+        self._connections: dict[socket.socket, _Connection] = {}
         self._logged_users = {}
+        self._metrics = glometrics.Metrics()
+        self._metrics.gauge("glo_sessions", "Sessions authentifiées.",
+                            lambda: len(self._logged_users))
+        self._capabilities: dict[socket.socket, gloutils.CapabilitiesPayload] = {}
+        self._compress_threshold = compress_threshold
+        self._metrics_admin = None if metrics_admin is None else metrics_admin.lower()
+        self._uploads: dict[socket.socket, _EmailUpload] = {}
+        self._deferred: dict[socket.socket,
+                             list[tuple[concurrent.futures.Future, bool]]] = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._hashing = concurrent.futures.ThreadPoolExecutor(
+            max_workers=gloutils.SERVER_HASH_THREADS)
+        self._callbacks: collections.deque[Callable[[], None]] = collections.deque()
+        self._loop_thread: Optional[int] = None
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
         localhost = "127.0.0.1"
         try:
             # Création et configuration du socket serveur
             self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._server_socket.bind((localhost, gloutils.APP_PORT))
-            self._server_socket.listen()
-            print(f"Serveur démarré en mode écoute sur le port {gloutils.APP_PORT}.")
+            if shared:
+                self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._server_socket.bind((localhost, port))
+            self._server_socket.listen(socket.SOMAXCONN)
+            self._server_socket.setblocking(False)
+            self._selector.register(self._server_socket, selectors.EVENT_READ)
+            print(f"Serveur démarré en mode écoute sur le port {port}.")
         except (socket.error, glosocket.GLOSocketError) as e:
             print(f"Erreur : Impossible d'initialiser le serveur. {e}")
             sys.exit(1)
 
         try:
             # Vérification et creation des repertoires
-            if not os.path.exists(gloutils.SERVER_DATA_DIR):
-                os.makedirs(gloutils.SERVER_DATA_DIR)
+            self._storage = glometrics.TimedCalls(
+                glostorage.STORAGES[storage](gloutils.SERVER_DATA_DIR, shared),
+                self._metrics.observe_disk)
             lost_dir_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
-            if not os.path.exists(lost_dir_path):
-                os.makedirs(lost_dir_path)
-        except glosocket.GLOSocketError as e:
+            os.makedirs(lost_dir_path, exist_ok=True)
+            self._session_secret = gloauth.load_secret(
+                os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SESSION_SECRET_FILENAME))
+        except OSError as e:
             print(f"Erreur : Impossible d'initialiser les répertoires du serveur. {e}")
+            sys.exit(1)
+
+        self._deliveries = _DeliveryQueue(self._storage)
+
+        try:
+            self._users = glostorage.UserRegistry(self._storage, shared)
+            self._users.load()
+        except OSError as e:
+            print(f"Erreur : Impossible de charger les comptes. {e}")
+            sys.exit(1)
+
+        try:
+            self._storage.load()
+        except OSError as e:
+            print(f"Erreur : Impossible de charger les statistiques des boîtes. {e}")
+
+        if metrics_port is not None:
+            try:
+                glometrics.serve(self._metrics, metrics_port, localhost)
+            except OSError as e:
+                print(f"Erreur : Impossible de servir les métriques. {e}")
+                sys.exit(1)
 
     def cleanup(self) -> None:
         """Ferme toutes les connexions résiduelles."""
-        for client_soc in self._client_socs:
+        for client_soc in list(self._connections):
             client_soc.close()
         self._server_socket.close()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self._executor.shutdown(wait=False)
+        self._hashing.shutdown(wait=False)
 
     def _accept_client(self) -> None:
-        """Accepte un nouveau client."""
-        client_socket, _ = self._server_socket.accept()
-        self._client_socs.append(client_socket)
+        """
+        Accepte les nouveaux clients en attente, les passe en mode non
+        bloquant et les enregistre auprès du sélecteur.
+        """
+        while True:
+            try:
+                client_socket, _ = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client_socket.setblocking(False)
+            self._metrics.count("connections_opened")
+            connection = _Connection(client_socket)
+            self._connections[client_socket] = connection
+            self._selector.register(client_socket, selectors.EVENT_READ, connection)
+
+    def _call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        """Demande à la boucle du serveur d'exécuter `callback` (depuis n'importe quel fil)."""
+        self._callbacks.append(callback)
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # Le socket de réveil est déjà plein: la boucle va se réveiller
+            pass
+
+    def _run_callbacks(self) -> None:
+        """Vide le socket de réveil et exécute les rappels en attente."""
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._callbacks:
+            self._callbacks.popleft()()
 
     def _remove_client(self, client_soc: socket.socket) -> None:
-        """Retire le client des structures de données et ferme sa connexion."""
-        if client_soc in self._client_socs:
-            self._client_socs.remove(client_soc)
+        """
+        Retire le client des structures de données et ferme sa connexion.
+        Appelé depuis le pool, le retrait est délégué à la boucle du serveur.
+        """
+        if self._loop_thread is not None and threading.get_ident() != self._loop_thread:
+            self._call_soon_threadsafe(lambda: self._remove_client(client_soc))
+            return
+        connection = self._connections.pop(client_soc, None)
+        if connection is not None:
+            self._metrics.count("connections_closed")
+            if connection.events:
+                self._selector.unregister(client_soc)
+        self._forget_client(client_soc)
         client_soc.close()
 
+    def _is_connected(self, client_soc: socket.socket) -> bool:
+        """Indique si le client est encore connecté. À appeler depuis la boucle."""
+        return client_soc in self._connections
+
+    def _forget_client(self, client_soc: socket.socket) -> None:
+        """Oublie la session du client et abandonne son transfert en cours."""
+        self._logged_users.pop(client_soc, None)
+        self._capabilities.pop(client_soc, None)
+        self._deferred.pop(client_soc, None)
+        upload = self._uploads.pop(client_soc, None)
+        if upload is not None:
+            upload.abort()
+
+    def _update_events(self, connection: _Connection) -> None:
+        """
+        Surveille l'écriture sur le socket du client uniquement lorsque des
+        réponses sont en attente de transmission, et la lecture tant que ses
+        messages en attente de traitement ne dépassent pas
+        `SERVER_PENDING_LIMIT` octets.
+        """
+        client_soc = connection.soc
+        events = 0
+        if sum(map(len, connection.pending)) < gloutils.SERVER_PENDING_LIMIT:
+            events |= selectors.EVENT_READ
+        if connection.outgoing:
+            events |= selectors.EVENT_WRITE
+        if events == connection.events or client_soc not in self._connections:
+            return
+        if not events:
+            self._selector.unregister(client_soc)
+        elif not connection.events:
+            self._selector.register(client_soc, events, connection)
+        else:
+            self._selector.modify(client_soc, events, connection)
+        connection.events = events
+
+
+    def _open_session(self, client_soc: socket.socket,
+                      authenticated: concurrent.futures.Future) -> concurrent.futures.Future:
+        """
+        Retourne un futur résolu par la réponse de `authenticated` (futur
+        d'une réponse et du nom de l'utilisateur authentifié, ou de None)
+        une fois le client associé à cet utilisateur.
+
+        L'association est faite depuis la boucle du serveur et seulement si
+        le client est encore connecté: un client retiré pendant le hachage
+        de son mot de passe ne laisse aucune session derrière lui. Ses
+        requêtes suivantes attendent ce futur (voir `_dispatch_all`).
+        """
+        opened = concurrent.futures.Future()
+
+        def open_session() -> None:
+            try:
+                response, username = authenticated.result()
+            except BaseException as e:
+                opened.set_exception(e)
+                return
+            if username is not None and self._is_connected(client_soc):
+                self._logged_users[client_soc] = username
+            opened.set_result(response)
+
+        authenticated.add_done_callback(
+            lambda _: self._call_soon_threadsafe(open_session))
+        return opened
 
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
-                        ) -> gloutils.GloMessage:
+                        ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Crée un compte à partir des données du payload.
 
-        Si les identifiants sont valides, créee le dossier de l'utilisateur,
-        associe le socket au nouvel l'utilisateur et retourne un succès,
-        sinon retourne un message d'erreur.
+        Si les identifiants sont valides, hache le mot de passe dans le pool
+        `_hashing` et retourne un futur: le compte est alors créé, le socket
+        associé au nouvel utilisateur (voir `_open_session`) et le futur
+        résolu par un succès.
+        Sinon retourne un message d'erreur.
         """
         try:
             # Extraction des informations du payload
@@ -106,8 +590,7 @@ class Server:
 
         try:
             # Vérification de la disponibilité du nom d’utilisateur
-            client_folder = os.path.join(gloutils.SERVER_DATA_DIR, username.lower())
-            if os.path.exists(client_folder):
+            if self._users.user_exists(username.lower()):
                 return gloutils.GloMessage(
                     header=gloutils.Headers.ERROR,
                     payload=gloutils.ErrorPayload(
@@ -138,32 +621,44 @@ class Server:
                 )
             )
 
-        try:
-            # Création du dossier utilisateur et sauvegarde du mot de passe
-            os.makedirs(client_folder, exist_ok=True)
-            password_hashed = hashlib.sha3_512(password.encode('utf-8')).hexdigest()
-            password_path = os.path.join(client_folder, gloutils.PASSWORD_FILENAME)
-            with open(password_path, 'w') as password_file:
-                password_file.write(password_hashed)
-        except FileExistsError as e:
-            raise glosocket.GLOSocketError(
-                "Fichier déjà existant."
-            ) from e
-        except glosocket.GLOSocketError as e:
-                print(f"Erreur lors de la création du compte : {e} ")
+        def create(password_hashed: str) -> tuple[gloutils.GloMessage, Optional[str]]:
+            try:
+                # Création du compte (atomique entre les processus)
+                # et sauvegarde du mot de passe
+                created = self._users.create_user(username.lower(), password_hashed)
+            except OSError as e:
+                raise glosocket.GLOSocketError(
+                    "Erreur lors de la création du compte."
+                ) from e
+            if not created:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(
+                        error_message="Nom d'utilisateur déjà utilisé."
+                    )
+                ), None
 
-            # Association du client au nom d'utilisateur
-        self._logged_users[client_soc] = username
+                # Association du client au nom d'utilisateur (en minuscules)
+            return gloutils.GloMessage(header=gloutils.Headers.OK), username.lower()
 
-        return gloutils.GloMessage(header=gloutils.Headers.OK)
+        return self._open_session(client_soc, _then(
+            self._hashing.submit(gloauth.hash_password, password), create))
 
-    def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
-               ) -> gloutils.GloMessage:
+    def _login(self, client_soc: socket.socket, payload: gloutils.LoginPayload
+               ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Vérifie que les données fournies correspondent à un compte existant.
-
-        Si les identifiants sont valides, associe le socket à l'utilisateur et
-        retourne un succès, sinon retourne un message d'erreur.
+        Si le client le demande (`session`), le succès est accompagné d'un
+        jeton de session (`SessionPayload`) qui permet de reprendre la
+        session sur une autre connexion sans mot de passe (`_resume_session`).
+
+        Le compte est cherché dans l'annuaire `_users`, sans toucher le
+        disque. S'il existe, le mot de passe est vérifié dans le pool
+        `_hashing` et un futur est retourné, résolu par un succès (le socket
+        est alors associé à l'utilisateur, voir `_open_session`) ou par un
+        message d'erreur. Un
+        hachage ancien (voir `gloauth.needs_rehash`) est refait et remplacé
+        au passage.
         """
         try:
             # Extraction des informations du payload
@@ -184,62 +679,106 @@ class Server:
             )
 
         try:
-            # Validation du nom d'utilisateur dans la base de données
-            client_folder = os.path.join(gloutils.SERVER_DATA_DIR, username.lower())
-            if not os.path.exists(client_folder):
+            # Validation du nom d'utilisateur et lecture du mot de passe enregistré
+            stored_hashed_password = self._users.password_hash(username.lower())
+        except OSError as e:
+            raise glosocket.GLOSocketError(
+                "Fichier de mot de passe introuvable."
+            ) from e
+        if stored_hashed_password is None:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Nom d'utilisateur ou mot de passe incorrect."
+                )
+            )
+
+        def verify() -> tuple[gloutils.GloMessage, Optional[str]]:
+            # Vérification du mot de passe
+            if not gloauth.verify_password(password, stored_hashed_password):
                 return gloutils.GloMessage(
                     header=gloutils.Headers.ERROR,
                     payload=gloutils.ErrorPayload(
-                    error_message="Nom d'utilisateur ou mot de passe incorrect."
+                        error_message="Nom d'utilisateur ou mot de passe incorrect."
                     )
-                )
-        except OSError as e:
+                ), None
+
+            if gloauth.needs_rehash(stored_hashed_password):
+                # Hachage aux paramètres courants; l'ancien reste valide en cas d'échec
+                with contextlib.suppress(OSError):
+                    self._users.set_password_hash(username.lower(),
+                                                  gloauth.hash_password(password))
+
+            # Association du client à l'utilisateur connecté, en minuscules
+            # comme dans l'annuaire et les jetons de session
+            if payload.get("session"):
+                token, expires = gloauth.make_session_token(
+                    self._session_secret, username.lower(), gloutils.SESSION_TOKEN_LIFETIME)
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.OK,
+                    payload=gloutils.SessionPayload(token=token, expires=expires)
+                ), username.lower()
+            return gloutils.GloMessage(header=gloutils.Headers.OK), username.lower()
+
+        return self._open_session(client_soc, self._hashing.submit(verify))
+
+    def _resume_session(self, client_soc: socket.socket, payload: gloutils.SessionPayload
+                        ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Reprend une session à partir du jeton obtenu à la connexion. Le jeton
+        est vérifié par sa signature et son échéance, puis le compte dans
+        l'annuaire `_users`: ni hachage de mot de passe, ni accès au disque.
+        Le client est associé à l'utilisateur comme après une connexion
+        (voir `_open_session`).
+        """
+        try:
+            token = payload["token"]
+        except KeyError as e:
             raise glosocket.GLOSocketError(
-                "Echec d'accès au dossier utilisateur."
+                "payload['token'] manquant lors de la reprise de session."
             ) from e
 
+        username = gloauth.check_session_token(self._session_secret, token)
         try:
-            # Validation du mot de passe de l'utilisateur
-            password_file_path = os.path.join(client_folder, gloutils.PASSWORD_FILENAME)
-            with open(password_file_path, 'r') as password_file:
-                stored_hashed_password = password_file.read().strip()
+            known = username is not None and self._users.user_exists(username)
         except OSError as e:
             raise glosocket.GLOSocketError(
-                "Fichier de mot de passe introuvable."
+                "Impossible de vérifier le compte de la session."
             ) from e
-
-            # Vérification du mot de passe
-        received_hashed_password = hashlib.sha3_512(password.encode('utf-8')).hexdigest()
-        if not hmac.compare_digest(received_hashed_password, stored_hashed_password):
+        if not known:
             return gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
-                    error_message="Nom d'utilisateur ou mot de passe incorrect."
+                    error_message="Jeton de session invalide ou expiré."
                 )
             )
 
-        # Association du client à l'utilisateur connecté
-        self._logged_users[client_soc] = username
-
-        return gloutils.GloMessage(header=gloutils.Headers.OK)
+        # Association du client à l'utilisateur de la session
+        authenticated = concurrent.futures.Future()
+        authenticated.set_result((gloutils.GloMessage(header=gloutils.Headers.OK), username))
+        return self._open_session(client_soc, authenticated)
 
     def _logout(self, client_soc: socket.socket) -> None:
-        """Déconnecte un utilisateur."""
-        if client_soc in self._logged_users:
-            del self._logged_users[client_soc]
-        self._remove_client(client_soc)
+        """
+        Déconnecte un utilisateur. Le socket reste ouvert pour permettre une
+        nouvelle connexion au menu d'authentification. Appelé depuis le pool:
+        le retrait de la session ne peut en créer aucune.
+        """
+        self._logged_users.pop(client_soc, None)
 
-    def _get_email_list(self, client_soc: socket.socket
+    def _get_email_list(self, client_soc: socket.socket,
+                        payload: gloutils.InboxRequestPayload
                         ) -> gloutils.GloMessage:
         """
-        Récupère la liste des courriels de l'utilisateur associé au socket.
-        Les éléments de la liste sont construits à l'aide du gabarit
-        SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
+        Récupère une page de la liste des courriels de l'utilisateur associé
+        au socket. Les éléments de la liste sont construits à l'aide du
+        gabarit SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
+
+        La page est choisie par `offset`/`limit` ou par le curseur
+        `before_id` du payload. Le total de la boîte accompagne la page.
 
         Une absence de courriel n'est pas une erreur, mais une liste vide.
         """
-        #Initialisation dela liste de courriels
-        emails = []
         # Vérification de l'authentification de l'utilisateur
         username = self._logged_users.get(client_soc)
 
@@ -250,44 +789,54 @@ class Server:
                 error_message="Utilisateur non authentifié."
                 )
             )
-        try:
-            # Récupération du dossier utilisateur
-            client_folder = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        except OSError as e:
-            raise glosocket.GLOSocketError(
-                "Erreur lors de l'accès au dossier utilisateur pour la liste des courriels."
-            ) from e
+
+        # Validation des paramètres de pagination
+        offset = payload.get("offset", 0)
+        limit = payload.get("limit", gloutils.INBOX_PAGE_SIZE)
+        before_id = payload.get("before_id")
+        if (not isinstance(offset, int) or offset < 0
+                or not isinstance(limit, int) or limit < 1
+                or not (before_id is None or isinstance(before_id, int))):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Paramètres de pagination invalides."
+                )
+            )
+        limit = min(limit, gloutils.INBOX_MAX_PAGE_SIZE)
 
         try:
-            # Parcours des fichiers JSON (les courriels)
-            for email_file in os.listdir(client_folder):
-                if not email_file.endswith(".json"):
-                    continue
-                email_path = os.path.join(client_folder, email_file)
-                with open(email_path, 'r', encoding='utf-8') as email:
-                    email_data = json.load(email)
-                    sender = email_data.get("sender")
-                    subject = email_data.get("subject")
-                    date = email_data.get("date")
-                    emails.append([sender, subject, date])
+            # Page de l'index (curseur prioritaire sur l'offset), sans
+            # ouvrir de fichier de courriel
+            entries, offset, total = self._storage.inbox_page(username, offset, limit,
+                                                              before_id)
         except OSError as e:
             raise glosocket.GLOSocketError(
-                "Erreur lors de la lecture des fichiers de courriels."
+                "Erreur lors de la lecture de l'index des courriels."
             ) from e
 
-        # Si aucun courriel n'est trouvé
-        if not emails:
+        if before_id is not None and offset == 0:
             return gloutils.GloMessage(
-                header=gloutils.Headers.OK,
-                payload=gloutils.EmailListPayload(email_list=[])
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Curseur de pagination invalide."
+                )
             )
+        return self._email_list(entries, offset, total)
 
-        # Tri des courriels par date (ordre décroissant)
-        emails.sort(reverse=True, key=lambda x: x[2])
+    @staticmethod
+    def _email_list(entries: list[dict], offset: int, total: int) -> gloutils.GloMessage:
+        """
+        Retourne la réponse listant les entrées d'index `entries`, numérotées
+        à partir de `offset` + 1 à l'aide du gabarit SUBJECT_DISPLAY.
+        """
+        page = [[entry["sender"], entry["subject"], entry["date"], entry["id"]]
+                for entry in entries]
 
         # Formatage des courriels pour la réponse
         email_list = []
-        for n, email in enumerate(emails, 1):
+        email_ids = [email[3] for email in page]
+        for n, email in enumerate(page, offset + 1):
             email_list.append(
                 gloutils.SUBJECT_DISPLAY.format(
                     number=n,
@@ -299,105 +848,218 @@ class Server:
 
         return gloutils.GloMessage(
             header=gloutils.Headers.OK,
-            payload=gloutils.EmailListPayload(email_list=email_list)
+            payload=gloutils.EmailListPayload(email_list=email_list,
+                                              email_ids=email_ids,
+                                              offset=offset,
+                                              total=total)
         )
 
-    def _get_email(self, client_soc: socket.socket,
-                   payload: gloutils.EmailChoicePayload
-                   ) -> gloutils.GloMessage:
+    def _search_emails(self, client_soc: socket.socket,
+                       payload: gloutils.SearchPayload) -> gloutils.GloMessage:
         """
-        Récupère le contenu de l'email dans le dossier de l'utilisateur associé
-        au socket.
+        Cherche les courriels de l'utilisateur associé au socket contenant
+        tous les mots de la requête (voir `glosearch.parse_query`) dans
+        l'index de recherche de sa boîte, sans ouvrir de courriel. Une
+        requête de plus de `glosearch.MAX_QUERY_TERMS` termes est refusée.
+
+        Retourne au plus `limit` courriels, du plus récent au plus ancien,
+        comme une page de `_get_email_list` dont le total est le nombre de
+        courriels correspondants.
         """
-        try:
-            # Extraction du choix de l'utilisateur
-            choix = payload["choice"]
-        except KeyError as e:
-            raise glosocket.GLOSocketError(
-                "payload['choice'] manquant lors de la sélection du courriel."
-            ) from e
+        username = self._logged_users.get(client_soc)
 
-            # Validation du choix
-        if not str(choix).isdigit() or choix < 1:
+        if not username:
             return gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
-                error_message="Choix invalide. Réessayez."
+                error_message="Utilisateur non authentifié."
                 )
             )
 
-            # Vérification de l'authentification de l'utilisateur
-        username = self._logged_users.get(client_soc)
-        if not username:
+        query = payload.get("query")
+        limit = payload.get("limit", gloutils.INBOX_PAGE_SIZE)
+        terms = glosearch.parse_query(query) if isinstance(query, str) else []
+        if (not terms or len(terms) > glosearch.MAX_QUERY_TERMS
+                or not isinstance(limit, int) or limit < 1):
             return gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
-                error_message="Utilisateur non authentifié."
+                error_message="Recherche invalide."
                 )
             )
 
-        emails = []
         try:
-            # Récupération du dossier utilisateur
-            client_folder = os.path.join(gloutils.SERVER_DATA_DIR, username)
+            entries, total = self._storage.search(
+                username, terms, min(limit, gloutils.INBOX_MAX_PAGE_SIZE))
         except OSError as e:
             raise glosocket.GLOSocketError(
-                "Erreur d'accès au dossier utilisateur lors de la sélection d'un courriel."
+                "Erreur lors de la lecture de l'index de recherche."
             ) from e
+        return self._email_list(entries, 0, total)
 
+    def _open_chosen_email(self, client_soc: socket.socket,
+                           payload: gloutils.EmailChoicePayload
+                           ) -> tuple[Optional[BinaryIO], Optional[gloutils.GloMessage]]:
+        """
+        Ouvre en lecture binaire le courriel choisi dans la boîte de
+        l'utilisateur associé au socket (voir `glostorage.Storage.open_email`),
+        ou retourne None et le message d'échec.
+        """
         try:
-            # Lecture des fichiers JSON (les courriels)
-            for email_file in os.listdir(client_folder):
-                if not email_file.endswith(".json"):
-                    continue
-                email_path = os.path.join(client_folder, email_file)
-                with open(email_path, 'r', encoding='utf-8') as email:
-                    email_data = json.load(email)
-                    sender = email_data.get("sender")
-                    destination = email_data.get("destination")
-                    subject = email_data.get("subject")
-                    date = email_data.get("date")
-                    content = email_data.get("content")
-                    emails.append([sender, destination, subject, date, content])
-        except OSError as e:
+            # Extraction de l'identifiant choisi par l'utilisateur
+            email_id = payload["email_id"]
+        except KeyError as e:
             raise glosocket.GLOSocketError(
-                "Erreur lors de la lecture des courriels."
+                "payload['email_id'] manquant lors de la sélection du courriel."
             ) from e
 
-        # Vérification si la boîte de courriels est vide
-        if not emails:
-            return gloutils.GloMessage(
+            # Validation de l'identifiant
+        if not isinstance(email_id, int) or email_id < 1:
+            return None, gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
-                error_message="Aucun courriel."
+                error_message="Choix invalide. Réessayez."
                 )
             )
 
-        # Validation de la portée du choix
-        if choix < 1 or choix > len(emails):
-            return gloutils.GloMessage(
+            # Vérification de l'authentification de l'utilisateur
+        username = self._logged_users.get(client_soc)
+        if not username:
+            return None, gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Utilisateur non authentifié."
+                )
+            )
+
+        try:
+            email_file = self._storage.open_email(username, email_id)
+        except OSError as e:
+            raise glosocket.GLOSocketError(
+                "Erreur lors de la lecture du courriel."
+            ) from e
+        if email_file is None:
+            return None, gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
                 error_message="Choix de courriel invalide."
                 )
             )
+        return email_file, None
 
-        # Tri des courriels par date et sélection du courriel
-        emails.sort(reverse=True, key=lambda x: x[3])
-        selected_email = emails[choix - 1]
+    def _get_email(self, client_soc: socket.socket,
+                   payload: gloutils.EmailChoicePayload
+                   ) -> gloutils.GloMessage:
+        """
+        Récupère le contenu de l'email dans le dossier de l'utilisateur associé
+        au socket.
+        """
+        email_file, failure = self._open_chosen_email(client_soc, payload)
+        if failure is not None:
+            return failure
+
+        try:
+            # Lecture directe du courriel choisi
+            with email_file:
+                email_data = json.load(email_file)
+        except (OSError, ValueError) as e:
+            raise glosocket.GLOSocketError(
+                "Erreur lors de la lecture du courriel."
+            ) from e
 
         # Construction du message de réponse avec le courriel
         return gloutils.GloMessage(
             header=gloutils.Headers.OK,
             payload=gloutils.EmailContentPayload(
-            sender=selected_email[0],
-            destination=selected_email[1],
-            subject=selected_email[2],
-            date=selected_email[3],
-            content=selected_email[4]
+            sender=email_data.get("sender"),
+            destination=email_data.get("destination"),
+            subject=email_data.get("subject"),
+            date=email_data.get("date"),
+            content=email_data.get("content")
             )
         )
 
+    def _stream_email(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChoicePayload
+                      ) -> Union[gloutils.GloMessage, Iterator[gloutils.GloMessage]]:
+        """
+        Retourne le courriel choisi sous forme de flux de messages (voir
+        `_email_messages`), ou le message d'échec.
+        """
+        email_file, failure = self._open_chosen_email(client_soc, payload)
+        if failure is not None:
+            return failure
+        return self._email_messages(email_file)
+
+    @staticmethod
+    def _email_messages(email_file: BinaryIO) -> Iterator[gloutils.GloMessage]:
+        """
+        Relit un courriel depuis le disque, bloc par bloc: ses entêtes
+        (`EmailStreamPayload`), les morceaux de son corps
+        (`EMAIL_STREAM_CHUNK`) puis `EMAIL_STREAM_END`.
+
+        Le corps est décodé directement dans le fichier lorsqu'il y est écrit
+        en dernier (voir `glostorage`); sinon le fichier est lu d'un bloc.
+        """
+        chunk_size = gloutils.EMAIL_STREAM_CHUNK_SIZE
+        try:
+            with email_file:
+                file_size = email_file.seek(0, os.SEEK_END)
+                email_file.seek(0)
+                head = email_file.read(chunk_size)
+                email_data, body = None, None
+                marker = head.find(_CONTENT_MARKER)
+                if marker >= 0 and file_size - marker >= len(_CONTENT_MARKER) + 2:
+                    with contextlib.suppress(ValueError):
+                        email_data = json.loads(head[:marker] + b'"content": null}')
+                    email_file.seek(file_size - 2)
+                    tail = email_file.read(2)
+                    email_file.seek(len(head))
+                    if (tail != b'"}' or not isinstance(email_data, dict)
+                            or not {"sender", "destination", "subject", "date"} <= email_data.keys()):
+                        email_data = None
+                if email_data is not None:
+                    # Corps brut entre le marqueur et le `"}` final
+                    start, end = marker + len(_CONTENT_MARKER), file_size - 2
+
+                    def blocks() -> Iterator[bytes]:
+                        position = min(len(head), end)
+                        yield head[start:position]
+                        while position < end:
+                            block = email_file.read(min(chunk_size, end - position))
+                            if not block:
+                                raise ValueError("truncated email file")
+                            position += len(block)
+                            yield block
+
+                    body = _decode_json_string(blocks())
+                else:
+                    email_file.seek(0)
+                    email_data = json.load(email_file)
+                    content = email_data.get("content") or ""
+                    body = (content[index:index + chunk_size]
+                            for index in range(0, len(content), chunk_size))
+
+                yield gloutils.GloMessage(
+                    header=gloutils.Headers.OK,
+                    payload=gloutils.EmailStreamPayload(
+                        sender=email_data.get("sender"),
+                        destination=email_data.get("destination"),
+                        subject=email_data.get("subject"),
+                        date=email_data.get("date")
+                    )
+                )
+                for data in body:
+                    if data:
+                        yield gloutils.GloMessage(
+                            header=gloutils.Headers.EMAIL_STREAM_CHUNK,
+                            payload=gloutils.EmailChunkPayload(data=data))
+        except (OSError, ValueError) as e:
+            raise glosocket.GLOSocketError(
+                "Erreur lors de la lecture du courriel."
+            ) from e
+        yield gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_END)
+
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
@@ -413,22 +1075,9 @@ class Server:
                 )
             )
 
+        # Statistiques maintenues à chaque livraison
         try:
-            # Récupération du dossier utilisateur
-            client_folder = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        except OSError as e:
-            raise glosocket.GLOSocketError(
-                "Erreur d'accès au dossier utilisateur."
-            ) from e
-
-        # Calcul des statistiques
-        nb_emails, total_size = 0, 0
-        try:
-            for file in os.listdir(client_folder):
-                if file.endswith(".json"):
-                    nb_emails += 1
-                    file_path = os.path.join(client_folder, file)
-                    total_size += os.path.getsize(file_path)
+            stats = self._storage.stats(username)
         except OSError as e:
             raise glosocket.GLOSocketError(
                 "Erreur lors de l'accès aux fichiers des courriels."
@@ -438,30 +1087,49 @@ class Server:
         return gloutils.GloMessage(
             header=gloutils.Headers.OK,
             payload=gloutils.StatsPayload(
-            count=nb_emails,
-            size=total_size
+            count=stats["count"],
+            size=stats["size"]
             )
         )
 
-    def _send_email(self, payload: gloutils.EmailContentPayload
-                    ) -> gloutils.GloMessage:
+    def _route(self, payload: gloutils.EmailContentPayload
+               ) -> tuple[Optional[str], Optional[gloutils.GloMessage]]:
         """
-        Détermine si l'envoi est interne ou externe et:
-        - Si l'envoi est interne, écris le message tel quel dans le dossier
-        du destinataire.
+        Détermine si l'envoi est interne ou externe et retourne le nom du
+        destinataire interne, ou le message d'échec de l'envoi:
         - Si le destinataire n'existe pas, place le message dans le dossier
         SERVER_LOST_DIR et considère l'envoi comme un échec.
         - Si le destinataire est externe, considère l'envoi comme un échec.
+        """
+        destination, failure = self._find_destination(payload["destination"])
+        if failure is None or destination is None:
+            return destination, failure
 
-        Retourne un messange indiquant le succès ou l'échec de l'opération.
+        # Si le destinataire est introuvable, déplacer dans le dossier "perdu"
+        try:
+            with open(self._lost_email_path(payload), 'w') as lost_email_file:
+                json.dump(payload, lost_email_file)
+        except OSError as e:
+            raise glosocket.GLOSocketError(
+                "Erreur lors de la gestion du dossier des courriels perdus."
+            ) from e
+        return None, failure
+
+    def _find_destination(self, destination: str
+                          ) -> tuple[Optional[str], Optional[gloutils.GloMessage]]:
+        """
+        Retourne le nom du destinataire interne `destination` et None, ou
+        None et le message d'échec si l'envoi est impossible. Pour un
+        destinataire interne introuvable, retourne SERVER_LOST_DIR (dossier
+        créé au besoin) avec le message d'échec: le courriel y est conservé.
         """
         # Validation de l'adresse email du destinataire
-        match = re.match(r'^([^@]+)@(.+)$', payload["destination"])
+        match = re.match(r'^([^@]+)@(.+)$', destination)
         if match:
             destination_username = match.group(1)
             destination_domain = match.group(2)
         else:
-            return gloutils.GloMessage(
+            return None, gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
                 error_message="Destinataire invalide."
@@ -469,121 +1137,854 @@ class Server:
             )
 
         try:
-            # Récupération du dossier du destinataire
-            destination_folder = os.path.join(gloutils.SERVER_DATA_DIR, destination_username)
+            #Verification du destinaire dans l'annuaire
+            if self._users.user_exists(destination_username):
+                return destination_username, None
         except OSError as e:
             raise glosocket.GLOSocketError(
                 "Erreur lors de l'accès au dossier du destinataire."
             ) from e
 
-        # Générer un nom de fichier sécurisé
-        time_file_name = re.sub(r'[<>:"/\\|?*]', '_', payload["date"])
-
-        #Verification du destinaire dans le dossier
-        if os.path.exists(destination_folder):
-            email_filename = payload["subject"] + "_" + time_file_name + ".json"
-            email_path = os.path.join(destination_folder, email_filename)
-            try:
-                with open(email_path, 'w') as email_file:
-                    json.dump(payload, email_file)
-            except OSError as e:
-                raise glosocket.GLOSocketError(
-                    "Erreur lors de l'écriture du fichier de courriel."
-                ) from e
-            return gloutils.GloMessage(header=gloutils.Headers.OK)
-
         # Si le domaine est externe a glo2000
         if destination_domain != "glo2000.ca":
-            return gloutils.GloMessage(
+            return None, gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=gloutils.ErrorPayload(
                     error_message="Destinataire non pris en charge."
                 )
             )
 
-        # Si le destinataire est introuvable, déplacer dans le dossier "perdu"
         try:
             lost_email_path = os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR)
             os.makedirs(lost_email_path, exist_ok=True)
-
-            lost_email_filename = payload["subject"] + "_" + time_file_name + ".json"
-            lost_email_full_path = os.path.join(lost_email_path, lost_email_filename)
-            with open(lost_email_full_path, 'w') as lost_email_file:
-                json.dump(payload, lost_email_file)
         except OSError as e:
             raise glosocket.GLOSocketError(
                 "Erreur lors de la gestion du dossier des courriels perdus."
             ) from e
 
-        return gloutils.GloMessage(
+        return gloutils.SERVER_LOST_DIR, gloutils.GloMessage(
             header=gloutils.Headers.ERROR,
             payload=gloutils.ErrorPayload(
             error_message="Destinataire introuvable, courriel déplacé vers le dossier perdu."
             )
         )
 
+    @staticmethod
+    def _lost_email_path(payload: gloutils.EmailStreamPayload) -> str:
+        """Retourne le chemin où conserver un courriel au destinataire introuvable."""
+        # Générer un nom de fichier sécurisé
+        time_file_name = re.sub(r'[<>:"/\\|?*]', '_', payload["date"])
+        lost_email_filename = payload["subject"] + "_" + time_file_name + ".json"
+        return os.path.join(gloutils.SERVER_DATA_DIR, gloutils.SERVER_LOST_DIR,
+                            lost_email_filename)
+
+    def _send_email(self, payload: gloutils.EmailContentPayload
+                    ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Achemine le courriel (voir `_route`) et, si l'envoi est interne,
+        soumet le message tel quel à la file de livraison `_deliveries`.
+
+        Retourne un messange indiquant l'échec de l'opération, ou un futur
+        résolu par le message de succès une fois le courriel sur le disque.
+        Un courriel dont un champ n'est pas une chaîne est refusé.
+        """
+        if not all(isinstance(payload.get(key), str)
+                   for key in ("sender", "destination", "subject", "date", "content")):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Courriel invalide."
+                )
+            )
+        destination, failure = self._route(payload)
+        if failure is not None:
+            return failure
+
+        def delivered(errors: dict[str, Exception]) -> gloutils.GloMessage:
+            error = errors.get(destination)
+            if isinstance(error, OSError):
+                raise glosocket.GLOSocketError(
+                    "Erreur lors de l'écriture du fichier de courriel."
+                ) from error
+            if error is not None:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(
+                    error_message="Courriel refusé par le stockage."
+                    )
+                )
+            return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+        return _then(self._deliveries.submit({destination: [payload]}), delivered)
+
+    def _send_email_batch(self, payload: gloutils.EmailBatchPayload
+                          ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Achemine un lot de courriels, chacun vers un ou plusieurs
+        destinataires, puis soumet les courriels internes regroupés par boîte
+        de destination à la file de livraison `_deliveries`.
+
+        Retourne un résultat par livraison, dans l'ordre des courriels puis
+        des destinataires, dès que les copies internes sont sur le disque
+        (par un futur s'il y en a). Chaque copie livrée indique son
+        destinataire. Un courriel dont un champ n'est pas une chaîne est
+        refusé pour chacun de ses destinataires.
+        """
+        messages = payload.get("messages")
+        destinations = payload.get("destinations")
+        if (not isinstance(messages, list)
+                or not all(isinstance(message, dict) for message in messages)
+                or not (destinations is None or isinstance(destinations, list))):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Envoi groupé invalide."
+                )
+            )
+        if len(messages) * max(1, len(destinations or [])) > gloutils.EMAIL_BATCH_MAX:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message=f"Envoi groupé limité à {gloutils.EMAIL_BATCH_MAX} livraisons."
+                )
+            )
+
+        # Acheminement de chaque copie et regroupement par boîte
+        results: list[gloutils.EmailResultPayload] = []
+        by_mailbox: dict[str, list[tuple[int, gloutils.EmailContentPayload]]] = {}
+        for index, message in enumerate(messages):
+            valid = all(isinstance(message.get(key), str)
+                        for key in ("sender", "subject", "date", "content"))
+            for destination in destinations or [message.get("destination")]:
+                result = gloutils.EmailResultPayload(
+                    message_index=index, destination=destination,
+                    header=gloutils.Headers.OK)
+                if not valid:
+                    result["header"] = gloutils.Headers.ERROR
+                    result["error_message"] = "Courriel invalide."
+                    results.append(result)
+                    continue
+                if not isinstance(destination, str):
+                    result["header"] = gloutils.Headers.ERROR
+                    result["error_message"] = "Destinataire invalide."
+                    results.append(result)
+                    continue
+                email = gloutils.EmailContentPayload(
+                    sender=message.get("sender"),
+                    destination=destination,
+                    subject=message.get("subject"),
+                    date=message.get("date"),
+                    content=message.get("content"))
+                mailbox, failure = self._route(email)
+                if failure is not None:
+                    result["header"] = gloutils.Headers.ERROR
+                    result["error_message"] = failure["payload"]["error_message"]
+                else:
+                    by_mailbox.setdefault(mailbox, []).append((len(results), email))
+                results.append(result)
+
+        response = gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailBatchResultPayload(results=results)
+        )
+        if not by_mailbox:
+            return response
+
+        def delivered(errors: dict[str, Exception]) -> gloutils.GloMessage:
+            for mailbox, error in errors.items():
+                for result_index, _ in by_mailbox[mailbox]:
+                    results[result_index]["header"] = gloutils.Headers.ERROR
+                    results[result_index]["error_message"] = (
+                        "Erreur lors de l'écriture du fichier de courriel."
+                        if isinstance(error, OSError)
+                        else "Courriel refusé par le stockage.")
+            return response
+
+        # Écriture groupée par boîte de destination
+        return _then(self._deliveries.submit({
+            mailbox: [email for _, email in emails]
+            for mailbox, emails in by_mailbox.items()}), delivered)
+
+    def _begin_email_stream(self, client_soc: socket.socket,
+                            payload: gloutils.EmailStreamPayload) -> None:
+        """
+        Commence la réception par morceaux d'un courriel: achemine le
+        courriel (voir `_find_destination`) et ouvre son fichier temporaire.
+        Un transfert précédent non terminé est abandonné. Le résultat n'est
+        transmis qu'à la fin du transfert (`_end_email_stream`).
+        """
+        previous = self._uploads.pop(client_soc, None)
+        if previous is not None:
+            previous.abort()
+
+        destination, failure = None, None
+        if not all(isinstance(payload.get(key), str)
+                   for key in ("sender", "destination", "subject", "date")):
+            failure = gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Courriel invalide."
+                )
+            )
+        else:
+            destination, failure = self._find_destination(payload["destination"])
+        self._uploads[client_soc] = _EmailUpload(payload, destination, failure)
+
+    def _write_email_chunk(self, client_soc: socket.socket,
+                           payload: gloutils.EmailChunkPayload) -> None:
+        """Écrit un morceau du courriel en cours de réception, s'il y en a un."""
+        upload = self._uploads.get(client_soc)
+        if upload is not None:
+            upload.write(payload.get("data"))
+
+    def _end_email_stream(self, client_soc: socket.socket) -> gloutils.GloMessage:
+        """
+        Termine la réception par morceaux d'un courriel et le livre dans la
+        boîte du destinataire, ou dans le dossier des courriels perdus.
+
+        Retourne un message indiquant le succès ou l'échec de l'opération,
+        comme `_send_email`.
+        """
+        upload = self._uploads.pop(client_soc, None)
+        if upload is None:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                error_message="Aucun envoi de courriel en cours."
+                )
+            )
+        if upload.error is not None or upload.destination is None:
+            upload.abort()
+            return upload.failure or gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(error_message=upload.error)
+            )
+
+        try:
+            upload.finish()
+            if upload.failure is not None:
+                # Destinataire introuvable: courriel conservé dans le dossier perdu
+                os.replace(upload.temp_path, self._lost_email_path(upload.payload))
+                return upload.failure
+            # Gros courriel: synchronisé seul plutôt que par la file de livraison
+            self._storage.deliver_file(upload.destination, upload.payload,
+                                       upload.temp_path, sync=True,
+                                       body_terms=upload.terms.finish())
+        except OSError as e:
+            upload.abort()
+            raise glosocket.GLOSocketError(
+                "Erreur lors de l'écriture du fichier de courriel."
+            ) from e
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _negotiate(self, client_soc: socket.socket,
+                   payload: gloutils.CapabilitiesPayload) -> gloutils.GloMessage:
+        """
+        Retient le premier encodage (JSON à défaut) et la première
+        compression (aucune à défaut) proposés par le client que le serveur
+        connaît et les retourne. Les réponses suivantes du client les
+        utiliseront.
+        """
+        encodings = payload.get("encodings")
+        if not isinstance(encodings, list):
+            encodings = []
+        compressions = payload.get("compressions")
+        if not isinstance(compressions, list):
+            compressions = []
+        capabilities = gloutils.CapabilitiesPayload(
+            encoding=next((encoding for encoding in encodings
+                           if encoding in glocodec.ENCODINGS),
+                          glocodec.JSON_ENCODING))
+        compression = next((compression for compression in compressions
+                            if compression in glosocket.COMPRESSIONS), None)
+        if compression is not None:
+            capabilities["compression"] = compression
+        self._capabilities[client_soc] = capabilities
+        return gloutils.GloMessage(header=gloutils.Headers.OK, payload=capabilities)
+
+    def _dispatch(self, client_soc: socket.socket, request: gloutils.GloMessage
+                  ) -> Optional[Union[gloutils.GloMessage, Iterator[gloutils.GloMessage],
+                                      concurrent.futures.Future]]:
+        """
+        Traite un message décodé reçu du client et retourne la réponse à lui
+        transmettre, un flux de messages (`INBOX_READING_STREAM`), un futur
+        de la réponse (envois, résolu une fois les courriels sur le disque)
+        ou None si l'entête n'appelle pas de réponse.
+
+        Le `request_id` éventuel de la requête est recopié dans la réponse.
+        La latence du traitement est enregistrée (voir `_observe`).
+        """
+        start = time.perf_counter()
+        response = None
+        match request:
+            case {"header": gloutils.Headers.AUTH_REGISTER, "payload": payload}:
+                response = self._create_account(client_soc, payload)
+
+            case {"header": gloutils.Headers.AUTH_LOGIN, "payload": payload}:
+                response = self._login(client_soc, payload)
+
+            case {"header": gloutils.Headers.AUTH_RESUME, "payload": payload}:
+                response = self._resume_session(client_soc, payload)
+
+            case {"header": gloutils.Headers.BYE}:
+                self._remove_client(client_soc)
+
+            case {"header": gloutils.Headers.AUTH_LOGOUT}:
+                self._logout(client_soc)
+
+            case {"header": gloutils.Headers.EMAIL_SENDING, "payload": payload}:
+                response = self._send_email(payload)
+
+            case {"header": gloutils.Headers.EMAIL_BATCH_SENDING, "payload": payload}:
+                response = self._send_email_batch(payload)
+
+            case {"header": gloutils.Headers.INBOX_READING_REQUEST, **message}:
+                response = self._get_email_list(client_soc, message.get("payload", {}))
+
+            case {"header": gloutils.Headers.INBOX_READING_CHOICE, "payload": payload}:
+                response = self._get_email(client_soc, payload)
+
+            case {"header": gloutils.Headers.INBOX_SEARCH, "payload": payload}:
+                response = self._search_emails(client_soc, payload)
+
+            case {"header": gloutils.Headers.STATS_REQUEST}:
+                response = self._get_stats(client_soc)
+
+            case {"header": gloutils.Headers.CAPABILITIES, "payload": payload}:
+                response = self._negotiate(client_soc, payload)
+
+            case {"header": gloutils.Headers.EMAIL_STREAM_BEGIN, "payload": payload}:
+                self._begin_email_stream(client_soc, payload)
+
+            case {"header": gloutils.Headers.EMAIL_STREAM_CHUNK, "payload": payload}:
+                self._write_email_chunk(client_soc, payload)
+
+            case {"header": gloutils.Headers.EMAIL_STREAM_END}:
+                response = self._end_email_stream(client_soc)
+
+            case {"header": gloutils.Headers.INBOX_READING_STREAM, "payload": payload}:
+                response = self._stream_email(client_soc, payload)
+
+            case {"header": gloutils.Headers.METRICS}:
+                response = self._get_metrics(client_soc)
+
+        self._observe(request, response, start)
+        if response is not None and "request_id" in request:
+            request_id = request["request_id"]
+            if isinstance(response, dict):
+                response["request_id"] = request_id
+            elif isinstance(response, concurrent.futures.Future):
+                response = _then(response, lambda message: {**message,
+                                                            "request_id": request_id})
+            else:
+                response = _tag_stream(response, request_id)
+        return response
+
+    def _observe(self, request: gloutils.GloMessage,
+                 response: Optional[Union[gloutils.GloMessage, Iterator[gloutils.GloMessage],
+                                          concurrent.futures.Future]],
+                 start: float) -> None:
+        """
+        Enregistre la latence d'une requête traitée depuis `start`, et si sa
+        réponse est une erreur. Une réponse différée est mesurée jusqu'à sa
+        résolution; une réponse en flux, jusqu'à l'ouverture du courriel.
+        """
+        header = request.get("header") if isinstance(request, dict) else None
+        name = _HEADER_NAMES.get(header, "UNKNOWN") if isinstance(header, int) else "UNKNOWN"
+        if not isinstance(response, concurrent.futures.Future):
+            error = isinstance(response, dict) and response.get("header") == gloutils.Headers.ERROR
+            self._metrics.observe_request(name, time.perf_counter() - start, error)
+            return
+
+        def resolved(future: concurrent.futures.Future) -> None:
+            error = (future.exception() is not None
+                     or future.result().get("header") == gloutils.Headers.ERROR)
+            self._metrics.observe_request(name, time.perf_counter() - start, error)
+
+        response.add_done_callback(resolved)
+
+    def _get_metrics(self, client_soc: socket.socket) -> gloutils.GloMessage:
+        """
+        Retourne les métriques du processus au format texte de Prometheus,
+        à la session du compte d'administration (`--metrics-admin`) uniquement.
+        """
+        username = self._logged_users.get(client_soc)
+        if self._metrics_admin is None or username != self._metrics_admin:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Métriques réservées à l'administration."
+                )
+            )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.MetricsPayload(text=self._metrics.render())
+        )
+
+    def _encode_response(self, capabilities: gloutils.CapabilitiesPayload,
+                         response: gloutils.GloMessage) -> bytes:
+        """Encode, compresse et trame une réponse selon les capacités données."""
+        encoding = capabilities.get("encoding", glocodec.JSON_ENCODING)
+        compress_threshold = (self._compress_threshold
+                              if "compression" in capabilities else None)
+        return glosocket.encode_frame(glocodec.encode(response, encoding),
+                                      compress_threshold)
+
+    def _pump(self, client_soc: socket.socket,
+              stream: Iterator[gloutils.GloMessage], responses: list[bytes]) -> bool:
+        """
+        Encode dans `responses` les messages suivants d'une réponse en flux,
+        jusqu'à `SERVER_STREAM_WINDOW` octets. Retourne vrai si le flux est
+        terminé.
+        """
+        capabilities = self._capabilities.get(client_soc, {})
+        window = 0
+        for message in stream:
+            response = self._encode_response(capabilities, message)
+            responses.append(response)
+            window += len(response)
+            if window >= gloutils.SERVER_STREAM_WINDOW:
+                return False
+        return True
+
+    def _dispatch_all(self, client_soc: socket.socket, frames: list[bytes],
+                      stream: Optional[Iterator[gloutils.GloMessage]] = None
+                      ) -> tuple[list[Union[bytes, concurrent.futures.Future]],
+                                 Optional[Exception],
+                                 Optional[Iterator[gloutils.GloMessage]], list[bytes]]:
+        """
+        Décode et traite dans l'ordre toutes les trames reçues d'un client et
+        retourne leurs réponses encodées et tramées (prêtes à être
+        transmises, ou futurs de celles-ci pour les envois en attente de
+        livraison), l'erreur qui a interrompu le traitement, le cas échéant,
+        la réponse en flux inachevée et les trames pas encore traitées.
+
+        Chaque réponse est encodée et compressée selon les capacités en
+        vigueur à la réception de sa requête: la réponse à `CAPABILITIES`
+        utilise encore les anciennes.
+
+        Une réponse en flux n'est encodée que par fenêtres (voir `_pump`):
+        le traitement s'arrête alors et reprend par un nouvel appel avec
+        `stream`, une fois les réponses transmises, ce qui borne la mémoire
+        utilisée par un gros courriel.
+
+        Les réponses différées (futurs) ne bloquent pas le traitement des
+        requêtes suivantes, sauf lorsqu'elles doivent en voir le résultat:
+        les envois consécutifs sont soumis ensemble à la file de livraison,
+        mais toute autre requête attend d'abord les réponses différées
+        précédentes du client (`_deferred`), et toute requête attend une
+        connexion ou une création de compte en cours.
+        """
+        responses: list[Union[bytes, concurrent.futures.Future]] = []
+        deferred = self._deferred.pop(client_soc, [])
+        try:
+            if stream is not None and not self._pump(client_soc, stream, responses):
+                return responses, None, stream, frames
+            for index, data in enumerate(frames):
+                capabilities = self._capabilities.get(client_soc, {})
+                request = glocodec.decode(data)
+                sending = (isinstance(request, dict)
+                           and request.get("header") in _SENDING_HEADERS)
+                if deferred and not (sending and all(sent for _, sent in deferred)):
+                    concurrent.futures.wait([future for future, _ in deferred])
+                    deferred = []
+                response = self._dispatch(client_soc, request)
+                if response is None:
+                    continue
+                if isinstance(response, dict):
+                    responses.append(self._encode_response(capabilities, response))
+                elif isinstance(response, concurrent.futures.Future):
+                    deferred.append((response, sending))
+                    responses.append(_then(response, functools.partial(
+                        self._encode_response, capabilities)))
+                elif not self._pump(client_soc, response, responses):
+                    self._keep_deferred(client_soc, deferred)
+                    return responses, None, response, frames[index + 1:]
+        except glosocket.GLOSocketError as e:
+            return responses, e, None, []
+        self._keep_deferred(client_soc, deferred)
+        return responses, None, None, []
+
+    def _keep_deferred(self, client_soc: socket.socket,
+                       deferred: list[tuple[concurrent.futures.Future, bool]]) -> None:
+        """
+        Retient les réponses différées du client pas encore prêtes, chacune
+        avec l'indication qu'il s'agit d'un envoi.
+        """
+        deferred = [(future, sending) for future, sending in deferred if not future.done()]
+        if deferred:
+            self._deferred[client_soc] = deferred
+
+    def _read_client(self, connection: _Connection) -> None:
+        """
+        Lit les octets disponibles sur le socket du client sans bloquer et
+        traite chaque message complet accumulé dans son tampon.
+        """
+        client_soc = connection.soc
+        try:
+            data = client_soc.recv(gloutils.RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._remove_client(client_soc)
+            return
+        if not data:
+            self._remove_client(client_soc)
+            return
+        self._metrics.count("received_bytes", len(data))
+
+        try:
+            connection.pending.extend(connection.buffer.feed(data))
+        except glosocket.GLOSocketError as e:
+            print(f"Client retiré : {e}")
+            self._remove_client(client_soc)
+            return
+        self._process_next(connection)
+
+    def _process_next(self, connection: _Connection) -> None:
+        """
+        Soumet au pool, en une seule tâche, tous les messages en attente du
+        client, si aucun de ses messages n'est déjà en traitement (les
+        réponses restent ordonnées).
+
+        Si une réponse en flux est en cours, sa fenêtre suivante n'est
+        soumise qu'une fois les réponses précédentes presque transmises.
+        """
+        self._update_events(connection)
+        if connection.busy:
+            return
+        if connection.stream is not None:
+            if len(connection.outgoing) >= gloutils.SERVER_STREAM_WINDOW:
+                return
+            messages = []
+        elif connection.pending:
+            messages = list(connection.pending)
+            connection.pending.clear()
+        else:
+            return
+        connection.busy = True
+        future = self._executor.submit(self._dispatch_all, connection.soc, messages,
+                                       connection.stream)
+        future.add_done_callback(lambda done: self._call_soon_threadsafe(
+            lambda: self._complete(connection, done)))
+        self._update_events(connection)
+
+    def _complete(self, connection: _Connection,
+                  future: concurrent.futures.Future) -> None:
+        """Transmet au client les réponses d'un traitement terminé dans le pool."""
+        connection.busy = False
+        client_soc = connection.soc
+        if client_soc not in self._connections:
+            return
+        try:
+            responses, error, connection.stream, remaining = future.result()
+        except Exception as e:
+            print(f"Client retiré : {e}")
+            self._remove_client(client_soc)
+            return
+        connection.pending.extendleft(reversed(remaining))
+        connection.deferred.extend(responses)
+        if not self._release(connection):
+            return
+        self._flush_client(connection)
+        if error is not None:
+            print(f"Client retiré : {error}")
+            self._remove_client(client_soc)
+            return
+        self._process_next(connection)
+
+    def _release(self, connection: _Connection) -> bool:
+        """
+        Déplace vers `outgoing`, dans l'ordre, les réponses différées déjà
+        prêtes. Si la première attend encore sa livraison, la transmission
+        reprend quand elle est prête (voir `_resume`). Retourne faux si le
+        client a été retiré à cause d'une livraison échouée: une exception
+        d'un futur ne doit jamais interrompre la boucle du serveur.
+        """
+        while connection.deferred:
+            response = connection.deferred[0]
+            if isinstance(response, concurrent.futures.Future):
+                if not response.done():
+                    if not connection.waiting:
+                        connection.waiting = True
+                        response.add_done_callback(lambda _: self._call_soon_threadsafe(
+                            lambda: self._resume(connection)))
+                    return True
+                try:
+                    response = response.result()
+                except Exception as e:
+                    print(f"Client retiré : {e}")
+                    self._remove_client(connection.soc)
+                    return False
+            connection.outgoing += response
+            connection.deferred.popleft()
+        return True
+
+    def _resume(self, connection: _Connection) -> None:
+        """Transmet les réponses différées devenues prêtes."""
+        connection.waiting = False
+        if connection.soc in self._connections and self._release(connection):
+            self._flush_client(connection)
+            self._update_events(connection)
+
+    def _flush_client(self, connection: _Connection) -> None:
+        """Transmet sans bloquer autant de réponses en attente que possible."""
+        if not connection.outgoing:
+            return
+        try:
+            sent = connection.soc.send(connection.outgoing)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._remove_client(connection.soc)
+            return
+        del connection.outgoing[:sent]
+        self._metrics.count("sent_bytes", sent)
+        self._update_events(connection)
+        if connection.stream is not None:
+            self._process_next(connection)
+
     def run(self):
         """Point d'entrée du serveur."""
 
-        waiters = []
+        self._loop_thread = threading.get_ident()
         while True:
-            result = select.select(self._client_socs + [self._server_socket], [], [])
-            waiters: list[socket.socket] = result[0]
-
-            for waiter in waiters:
-                if waiter == self._server_socket:
+            for key, events in self._selector.select():
+                if key.fileobj is self._wakeup_recv:
+                    self._run_callbacks()
+                    continue
+                if key.data is None:
                     self._accept_client()
+                    continue
+                connection: _Connection = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._flush_client(connection)
+                if events & selectors.EVENT_READ and connection.soc in self._connections:
+                    self._read_client(connection)
+
+
+class AsyncServer(Server):
+    """
+    Serveur mail @glo2000.ca reposant sur asyncio.
+
+    Réutilise les traitements de `Server` (via `_dispatch_all`). Le tramage
+    passe par `asyncio.StreamReader`/`StreamWriter` et le travail sur le
+    disque est attendu dans un exécuteur. Le StreamWriter de chaque client
+    joue le rôle du socket client dans `_logged_users`; les clients
+    connectés sont retenus par `_clients`, modifié depuis la boucle asyncio
+    seulement.
+    """
+
+    def __init__(self, shared: bool = False,
+                 threads: int = gloutils.SERVER_THREADS,
+                 compress_threshold: int = gloutils.COMPRESSION_THRESHOLD,
+                 storage: str = gloutils.SERVER_STORAGE,
+                 port: int = gloutils.APP_PORT,
+                 metrics_port: Optional[int] = None,
+                 metrics_admin: Optional[str] = None) -> None:
+        """
+        Prépare le serveur de base puis retire ses sockets du sélecteur,
+        la boucle asyncio prenant le relais. Le travail sur le disque est
+        attendu dans le pool `_executor` du serveur de base.
+        """
+        super().__init__(shared, threads, compress_threshold, storage, port, metrics_port,
+                         metrics_admin)
+        self._selector.unregister(self._server_socket)
+        self._selector.unregister(self._wakeup_recv)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: set[asyncio.StreamWriter] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def _call_soon_threadsafe(self, callback: Callable[[], None]) -> None:
+        # La boucle est fermée si le serveur s'arrête pendant un traitement
+        with contextlib.suppress(RuntimeError):
+            self._loop.call_soon_threadsafe(callback)
+
+    def _is_connected(self, client_soc: asyncio.StreamWriter) -> bool:
+        return client_soc in self._clients
+
+    def _remove_client(self, client_soc: asyncio.StreamWriter) -> None:
+        """
+        Retire le client des structures de données et ferme sa connexion.
+        Appelé depuis l'exécuteur, le retrait est délégué à la boucle asyncio.
+        """
+        if threading.get_ident() != self._loop_thread:
+            self._call_soon_threadsafe(lambda: self._remove_client(client_soc))
+            return
+        self._clients.discard(client_soc)
+        self._forget_client(client_soc)
+        client_soc.close()
 
-                else:
-                    try:
-                        data = glosocket.recv_mesg(waiter)
-                    except glosocket.GLOSocketError:
-                        self._client_socs.remove(waiter)
-                        waiter.close()
-                        continue
-
-                    try:
-                        match json.loads(data):
-                            case {"header": gloutils.Headers.AUTH_REGISTER, "payload": payload}:
-                                message = self._create_account(waiter, payload)
-                                glosocket.snd_mesg(waiter, json.dumps(message))
-
-                            case {"header": gloutils.Headers.AUTH_LOGIN, "payload": payload}:
-                                message = self._login(waiter, payload)
-                                glosocket.snd_mesg(waiter, json.dumps(message))
-
-                            case {"header": gloutils.Headers.BYE, "payload": payload}:
-                                self._remove_client(waiter)
-
-                            case {"header": gloutils.Headers.AUTH_LOGOUT, "payload": payload}:
-                                self._logout(waiter)
-
-                            case {"header": gloutils.Headers.EMAIL_SENDING, "payload": payload}:
-                                message = self._send_email(payload)
-                                glosocket.snd_mesg(waiter, json.dumps(message))
-
-                            case {"header": gloutils.Headers.INBOX_READING_REQUEST, "payload": payload}:
-                                message = self._get_email_list(waiter)
-                                glosocket.snd_mesg(waiter, json.dumps(message))
-
-                            case {"header": gloutils.Headers.INBOX_READING_CHOICE, "payload": payload}:
-                                message = self._get_email(waiter, payload)
-                                glosocket.snd_mesg(waiter, json.dumps(message))
-
-                            case {"header": gloutils.Headers.STATS_REQUEST, "payload": payload}:
-                                message = self._get_stats(waiter)
-                                glosocket.snd_mesg(waiter, json.dumps(message))
-                    except (socket.error, struct.error) as e:
-                        raise glosocket.GLOSocketError("Échec lors de l'envoi de réponse!") from e
-                pass
+    async def _write_responses(self, writer: asyncio.StreamWriter,
+                               previous: Optional[asyncio.Future],
+                               responses: list[Union[bytes, concurrent.futures.Future]]
+                               ) -> None:
+        """
+        Transmet des réponses après celles de l'écriture `previous`, en
+        attendant la livraison des envois différés. Une livraison échouée,
+        quelle que soit son exception, ferme la connexion.
+        """
+        if previous is not None:
+            await previous
+        if writer.is_closing():
+            return
+        try:
+            for response in responses:
+                if not isinstance(response, bytes):
+                    response = await asyncio.wrap_future(response)
+                writer.write(response)
+                self._metrics.count("sent_bytes", len(response))
+            await writer.drain()
+        except Exception as e:
+            print(f"Client retiré : {e}")
+            writer.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        """
+        Traite les messages d'un client jusqu'à sa déconnexion. Les réponses
+        sont transmises dans l'ordre par une chaîne de tâches d'écriture
+        (`_write_responses`), la lecture continuant pendant l'attente des
+        livraisons. La tâche est annulée à l'arrêt du serveur (voir `_serve`).
+        """
+        writing: Optional[asyncio.Future] = None
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self._clients.add(writer)
+        self._metrics.count("connections_opened")
+        try:
+            while not writer.is_closing():
+                data = await glosocket.recv_frame_async(reader, gloutils.MAX_FRAME_SIZE)
+                # Taille de la trame décompressée, préfixe compris
+                self._metrics.count("received_bytes", len(data) + 4)
+                frames, stream = [data], None
+                # Une réponse en flux est transmise fenêtre par fenêtre
+                while frames or stream is not None:
+                    responses, error, stream, frames = await self._loop.run_in_executor(
+                        self._executor, self._dispatch_all, writer, frames, stream)
+                    if writer.is_closing():
+                        return
+                    writing = asyncio.ensure_future(
+                        self._write_responses(writer, writing, responses))
+                    if stream is not None or error is not None:
+                        await writing
+                    if error is not None:
+                        raise error
+        except (glosocket.GLOSocketError, OSError) as e:
+            if not writer.is_closing() and not reader.at_eof():
+                print(f"Client retiré : {e}")
+        except asyncio.CancelledError:
+            # Arrêt du serveur: la connexion est fermée sans attendre ses réponses
+            writing = None
+        finally:
+            if writing is not None and not writer.is_closing():
+                with contextlib.suppress(OSError):
+                    await writing
+            self._tasks.discard(task)
+            self._metrics.count("connections_closed")
+            self._remove_client(writer)
+
+    async def _serve(self) -> None:
+        """
+        Sert les clients sur le socket déjà en écoute. À l'interruption
+        (Ctrl-C annule cette tâche), les tâches des clients sont annulées et
+        attendues avant que l'annulation ne remonte.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        server = await asyncio.start_server(self._handle_client,
+                                            sock=self._server_socket)
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            # Avant la fermeture du serveur, qui attend ses connexions
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def run(self):
+        """
+        Point d'entrée du serveur asyncio. Ctrl-C lève KeyboardInterrupt
+        une fois les clients arrêtés, comme pour le serveur de base.
+        """
+        asyncio.run(self._serve())
 
 
-def _main() -> int:
-    server = Server()
+def _run_server(engine: str, shared: bool, threads: int,
+                compress_threshold: int, storage: str, port: int,
+                metrics_port: Optional[int], metrics_admin: Optional[str]) -> None:
+    """Crée et exécute un serveur avec les moteurs réseau et de stockage demandés."""
+    server_class = AsyncServer if engine == "asyncio" else Server
+    server = server_class(shared, threads, compress_threshold, storage, port, metrics_port,
+                          metrics_admin)
     try:
         server.run()
     except KeyboardInterrupt:
         server.cleanup()
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", action="store", dest="engine",
+                        choices=("select", "asyncio"), default="select",
+                        help="Moteur réseau du serveur.")
+    parser.add_argument("--workers", action="store", dest="workers",
+                        type=int, default=1,
+                        help="Nombre de processus serveurs (SO_REUSEPORT).")
+    parser.add_argument("--threads", action="store", dest="threads",
+                        type=int, default=gloutils.SERVER_THREADS,
+                        help="Taille du pool de traitement (disque et hachage).")
+    parser.add_argument("--compress-threshold", action="store", dest="compress_threshold",
+                        type=int, default=gloutils.COMPRESSION_THRESHOLD,
+                        help="Taille (octets) à partir de laquelle les réponses sont"
+                             " compressées pour les clients qui l'acceptent.")
+    parser.add_argument("--storage", action="store", dest="storage",
+                        choices=tuple(glostorage.STORAGES), default=gloutils.SERVER_STORAGE,
+                        help="Moteur de stockage des boîtes (voir migrate_storage.py). Une"
+                             " livraison synchronisée coûte un fsync par courriel avec"
+                             " file, un seul par lot avec segment et sqlite.")
+    parser.add_argument("--port", action="store", dest="port",
+                        type=int, default=gloutils.APP_PORT,
+                        help="Port d'écoute du serveur.")
+    parser.add_argument("--metrics-port", action="store", dest="metrics_port",
+                        type=int, default=None,
+                        help="Port HTTP local des métriques (GET /metrics). Avec --workers,"
+                             " le processus i utilise le port suivant + i.")
+    parser.add_argument("--metrics-admin", action="store", dest="metrics_admin",
+                        default=None,
+                        help="Compte existant dont la session peut lire les métriques par"
+                             " l'entête METRICS (refusé à tous par défaut).")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.workers <= 1:
+        _run_server(args.engine, False, args.threads, args.compress_threshold,
+                    args.storage, args.port, args.metrics_port, args.metrics_admin)
+        return 0
+
+    if not hasattr(socket, "SO_REUSEPORT") or fcntl is None:
+        print("Erreur : --workers nécessite SO_REUSEPORT et fcntl.")
+        return 1
+    workers = [multiprocessing.Process(target=_run_server,
+                                       args=(args.engine, True, args.threads,
+                                             args.compress_threshold, args.storage,
+                                             args.port,
+                                             None if args.metrics_port is None
+                                             else args.metrics_port + index,
+                                             args.metrics_admin))
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
     return 0
 
 
@@ -0,0 +1,100 @@
+"""\
+Micro-benchmark de glocodec: compare l'encodage JSON et l'encodage binaire
+(temps CPU d'encodage et de décodage, taille des trames) sur des messages
+représentatifs du protocole.
+
+Utilisation: python bench_glocodec.py [--number N] [--repeat N] [--json]
+"""
+import argparse
+import json
+import sys
+import timeit
+
+import glocodec
+import gloutils
+
+_DATE = "Sun, 18 Oct 2026 09:32:04 +0000"
+
+
+def _email(index: int, size: int) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+        subject=f"Sujet {index}", date=_DATE, content="x" * size)
+
+
+MESSAGES = {
+    "ok": gloutils.GloMessage(header=gloutils.Headers.OK, request_id=42),
+    "error": gloutils.GloMessage(
+        header=gloutils.Headers.ERROR, request_id=42,
+        payload=gloutils.ErrorPayload(error_message="Utilisateur non authentifié.")),
+    "login": gloutils.GloMessage(
+        header=gloutils.Headers.AUTH_LOGIN, request_id=42,
+        payload=gloutils.AuthPayload(username="alice", password="MotDePasse123")),
+    "stats": gloutils.GloMessage(
+        header=gloutils.Headers.OK, request_id=42,
+        payload=gloutils.StatsPayload(count=1234, size=5678901)),
+    "email_1k": gloutils.GloMessage(
+        header=gloutils.Headers.EMAIL_SENDING, request_id=42, payload=_email(0, 1000)),
+    "email_100k": gloutils.GloMessage(
+        header=gloutils.Headers.EMAIL_SENDING, request_id=42, payload=_email(0, 100_000)),
+    "inbox_page": gloutils.GloMessage(
+        header=gloutils.Headers.OK, request_id=42,
+        payload=gloutils.EmailListPayload(
+            email_list=[gloutils.SUBJECT_DISPLAY.format(
+                number=i, sender="alice@glo2000.ca", subject=f"Sujet {i}", date=_DATE)
+                for i in range(1, gloutils.INBOX_MAX_PAGE_SIZE + 1)],
+            email_ids=list(range(1, gloutils.INBOX_MAX_PAGE_SIZE + 1)),
+            offset=0, total=5000)),
+    "batch_result": gloutils.GloMessage(
+        header=gloutils.Headers.OK, request_id=42,
+        payload=gloutils.EmailBatchResultPayload(results=[
+            gloutils.EmailResultPayload(message_index=0, destination=f"user{i}@glo2000.ca",
+                                        header=gloutils.Headers.OK)
+            for i in range(100)])),
+}
+
+
+def _best(statement, number: int, repeat: int) -> float:
+    """Retourne la meilleure durée moyenne (s) d'un appel de `statement`."""
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000,
+                        help="Nombre d'appels par mesure.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Nombre de mesures (la meilleure est gardée).")
+    parser.add_argument("--json", action="store_true",
+                        help="Affiche les résultats en JSON.")
+    args = parser.parse_args(sys.argv[1:])
+
+    results = []
+    for name, message in MESSAGES.items():
+        result = {"message": name}
+        for encoding in (glocodec.JSON_ENCODING, glocodec.BINARY_ENCODING):
+            data = glocodec.encode(message, encoding)
+            assert glocodec.decode(data) == json.loads(json.dumps(message))
+            number = max(1, args.number * 1000 // max(len(data), 1000))
+            result[f"{encoding}_bytes"] = len(data)
+            result[f"{encoding}_encode_us"] = 1e6 * _best(
+                lambda: glocodec.encode(message, encoding), number, args.repeat)
+            result[f"{encoding}_decode_us"] = 1e6 * _best(
+                lambda: glocodec.decode(data), number, args.repeat)
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print(f"{'message':>12} {'octets json/bin':>18} "
+          f"{'encode json/bin (us)':>22} {'decode json/bin (us)':>22}")
+    for result in results:
+        sizes = f"{result['json_bytes']}/{result['binary_bytes']}"
+        encode = f"{result['json_encode_us']:.1f}/{result['binary_encode_us']:.1f}"
+        decode = f"{result['json_decode_us']:.1f}/{result['binary_decode_us']:.1f}"
+        print(f"{result['message']:>12} {sizes:>18} {encode:>22} {decode:>22}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,100 @@
+"""\
+Micro-benchmark de glosocket: compare l'envoi et la réception de messages
+de 1 Ko à 50 Mo entre l'implémentation actuelle (recv_into + sendmsg) et
+l'implémentation d'origine (concaténation par blocs de 4096 octets).
+L'implémentation d'origine étant quadratique, elle n'est mesurée que
+jusqu'à --legacy-max octets.
+
+Utilisation: python bench_glosocket.py [--repeat N] [--legacy-max N] [--json]
+"""
+import argparse
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+
+import glosocket
+
+SIZES = [1_000, 64_000, 1_000_000, 10_000_000, 50_000_000]
+
+
+def _legacy_recvall(source: socket.socket, size: int) -> bytes:
+    """Réception d'origine: `msg += buffer` par blocs de 4096 octets."""
+    msg = b""
+    while size > 0:
+        buffer = source.recv(min(size, 4096))
+        if not buffer:
+            raise glosocket.GLOSocketError("The other socket is closed.")
+        msg += buffer
+        size -= len(buffer)
+    return msg
+
+
+def _legacy_snd_mesg(dest_soc: socket.socket, message: str) -> None:
+    """Envoi d'origine: l'entête est concaténée au message."""
+    data = message.encode(encoding='utf-8')
+    dest_soc.sendall(struct.pack("!I", len(data)) + data)
+
+
+def _legacy_recv_mesg(source_soc: socket.socket) -> str:
+    """Réception d'origine d'un message complet."""
+    length, = struct.unpack("!I", _legacy_recvall(source_soc, 4))
+    return _legacy_recvall(source_soc, length).decode('utf-8')
+
+
+def _measure(send, recv, message: str, repeat: int) -> float:
+    """Retourne la meilleure durée (s) d'un aller simple de `message`."""
+    sender, receiver = socket.socketpair()
+    best = float("inf")
+    try:
+        for _ in range(repeat):
+            result = []
+            thread = threading.Thread(target=lambda: result.append(recv(receiver)))
+            start = time.perf_counter()
+            thread.start()
+            send(sender, message)
+            thread.join()
+            best = min(best, time.perf_counter() - start)
+            assert len(result[0]) == len(message)
+    finally:
+        sender.close()
+        receiver.close()
+    return best
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Nombre de mesures par taille (la meilleure est gardée).")
+    parser.add_argument("--legacy-max", type=int, default=10_000_000,
+                        help="Taille maximale mesurée avec l'implémentation d'origine.")
+    parser.add_argument("--json", action="store_true",
+                        help="Affiche les résultats en JSON.")
+    args = parser.parse_args(sys.argv[1:])
+
+    results = []
+    for size in SIZES:
+        message = "x" * size
+        legacy = None
+        if size <= args.legacy_max:
+            legacy = _measure(_legacy_snd_mesg, _legacy_recv_mesg, message, args.repeat)
+        current = _measure(glosocket.snd_mesg, glosocket.recv_mesg, message, args.repeat)
+        results.append({"size": size, "legacy_s": legacy, "current_s": current,
+                        "speedup": legacy / current if legacy else None})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print(f"{'taille':>12} {'origine (ms)':>14} {'actuel (ms)':>14} {'gain':>8}")
+    for result in results:
+        legacy = "-" if result["legacy_s"] is None else f"{result['legacy_s'] * 1000:.2f}"
+        speedup = "-" if result["speedup"] is None else f"{result['speedup']:.1f}x"
+        print(f"{result['size']:>12} {legacy:>14} "
+              f"{result['current_s'] * 1000:>14.2f} {speedup:>8}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
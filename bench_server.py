@@ -0,0 +1,353 @@
+"""\
+Banc d'essai de charge du serveur: démarre un serveur local sur un dossier
+de données temporaire, y crée des comptes dont les boîtes contiennent
+--mailbox-size courriels, puis fait tourner --clients clients simultanés
+(des fils répartis sur --processes processus) qui enchaînent pendant
+--duration secondes des requêtes tirées selon --mix.
+
+Chaque taille de boîte (--mailbox-size 100,10000) donne une mesure sur un
+serveur neuf. Les résultats donnent le débit et les latences p50/p99 par
+entête; --json les affiche en JSON pour les comparer d'un commit à l'autre.
+
+Utilisation: python bench_server.py [--clients N] [--duration S]
+    [--mailbox-size N[,N...]] [--mix send=40,list=30,read=20,stats=10]
+    [--engine select|asyncio] [--storage file|segment|sqlite] [--json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import gloauth
+import gloclient
+import glosocket
+import glostorage
+import gloutils
+
+_PASSWORD = "MotDePasse123"
+_DATE = "Sun, 18 Oct 2026 09:32:04 +0000"
+_WORDS = ("budget", "réunion", "projet", "rapport", "facture", "livraison",
+          "contrat", "serveur", "sauvegarde", "vacances", "équipe", "client")
+_OPERATIONS = ("send", "list", "read", "stats", "search")
+_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TP4_server.py")
+
+
+def _username(index: int) -> str:
+    return f"bench{index}"
+
+
+def _text(rng: random.Random, size: int) -> str:
+    """Retourne un texte d'environ `size` caractères tiré du vocabulaire."""
+    words = []
+    length = 0
+    while length < size:
+        words.append(rng.choice(_WORDS))
+        length += len(words[-1]) + 1
+    return " ".join(words)
+
+
+def _seed(data_dir: str, storage: str, users: int, mailbox_size: int,
+          body_size: int) -> None:
+    """Crée les comptes et remplit leurs boîtes directement dans le stockage."""
+    store = glostorage.STORAGES[storage](data_dir)
+    password_hash = gloauth.hash_password(_PASSWORD)
+    rng = random.Random(0)
+    for index in range(users):
+        username = _username(index)
+        store.create_user(username, password_hash)
+        for start in range(0, mailbox_size, 1000):
+            store.deliver(username, [
+                {"sender": f"{_username(rng.randrange(users))}@{gloutils.SERVER_DOMAIN}",
+                 "destination": f"{username}@{gloutils.SERVER_DOMAIN}",
+                 "subject": _text(rng, 30), "date": _DATE,
+                 "content": _text(rng, body_size)}
+                for _ in range(min(1000, mailbox_size - start))])
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def _start_server(workdir: str, port: int, server_args: list[str]) -> subprocess.Popen:
+    """Démarre le serveur dans `workdir` et attend qu'il accepte les connexions."""
+    server = subprocess.Popen([sys.executable, _SERVER, "--port", str(port), *server_args],
+                              cwd=workdir, stdout=subprocess.DEVNULL,
+                              start_new_session=True)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Le serveur s'est arrêté au démarrage.")
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Le serveur ne répond pas.")
+
+
+def _stop_server(server: subprocess.Popen) -> None:
+    """Interrompt le serveur et ses éventuels processus (--workers)."""
+    os.killpg(server.pid, signal.SIGINT)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+
+class _Results:
+    """Latences (s) et nombre d'erreurs par entête, partagés par les fils d'un processus."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def merge(self, latencies: dict[str, list[float]], errors: dict[str, int]) -> None:
+        with self._lock:
+            for name, values in latencies.items():
+                self.latencies.setdefault(name, []).extend(values)
+            for name, count in errors.items():
+                self.errors[name] = self.errors.get(name, 0) + count
+
+    def fail(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+
+def _request(operation: str, rng: random.Random, username: str, users: int,
+             mailbox_size: int, body_size: int) -> tuple[gloutils.Headers, Optional[dict]]:
+    """Construit la requête d'une opération du mélange."""
+    if operation == "send":
+        return gloutils.Headers.EMAIL_SENDING, gloutils.EmailContentPayload(
+            sender=f"{username}@{gloutils.SERVER_DOMAIN}",
+            destination=f"{_username(rng.randrange(users))}@{gloutils.SERVER_DOMAIN}",
+            subject=_text(rng, 30), date=_DATE, content=_text(rng, body_size))
+    if operation == "list":
+        return gloutils.Headers.INBOX_READING_REQUEST, gloutils.InboxRequestPayload(
+            offset=0, limit=gloutils.INBOX_PAGE_SIZE)
+    if operation == "read":
+        return gloutils.Headers.INBOX_READING_CHOICE, gloutils.EmailChoicePayload(
+            email_id=rng.randint(1, max(1, mailbox_size)))
+    if operation == "search":
+        return gloutils.Headers.INBOX_SEARCH, gloutils.SearchPayload(
+            query=" ".join(rng.sample(_WORDS, 2)), limit=gloutils.INBOX_PAGE_SIZE)
+    return gloutils.Headers.STATS_REQUEST, None
+
+
+def _client(index: int, config: dict, results: _Results) -> None:
+    """
+    Client simulé: se connecte au compte `bench<index % users>` puis envoie
+    des requêtes une à une jusqu'à la fin de la mesure.
+    """
+    rng = random.Random(index)
+    username = _username(index % config["users"])
+    latencies: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    operations, weights = zip(*config["mix"].items())
+    try:
+        connection = gloclient.GloConnection("127.0.0.1", config["port"])
+        if config["negotiate"]:
+            connection.negotiate()
+        start = time.perf_counter()
+        response = connection.request(gloutils.Headers.AUTH_LOGIN, gloutils.AuthPayload(
+            username=username, password=_PASSWORD))
+        latencies["AUTH_LOGIN"] = [time.perf_counter() - start]
+        if response.get("header") != gloutils.Headers.OK:
+            errors["AUTH_LOGIN"] = 1
+            results.merge(latencies, errors)
+            return
+        deadline = time.perf_counter() + config["duration"]
+        while (start := time.perf_counter()) < deadline:
+            header, payload = _request(rng.choices(operations, weights)[0], rng, username,
+                                       config["users"], config["mailbox_size"],
+                                       config["body_size"])
+            response = connection.request(header, payload)
+            latencies.setdefault(header.name, []).append(time.perf_counter() - start)
+            if response.get("header") != gloutils.Headers.OK:
+                errors[header.name] = errors.get(header.name, 0) + 1
+        connection.notify(gloutils.Headers.BYE)
+        connection.close()
+    except glosocket.GLOSocketError:
+        results.fail()
+    results.merge(latencies, errors)
+
+
+def _run_clients(config: dict, indexes: list[int]) -> tuple[dict, dict, int]:
+    """Fait tourner les clients `indexes` dans des fils du processus courant."""
+    results = _Results()
+    threads = [threading.Thread(target=_client, args=(index, config, results))
+               for index in indexes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.latencies, results.errors, results.failures
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    """Percentile par rang le plus proche d'une liste triée."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _summary(latencies: dict[str, list[float]], errors: dict[str, int],
+             duration: float) -> dict:
+    headers = {}
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        headers[name] = {
+            "count": len(values),
+            "errors": errors.get(name, 0),
+            "throughput": len(values) / duration if name != "AUTH_LOGIN" else None,
+            "mean_ms": 1e3 * sum(values) / len(values),
+            "p50_ms": 1e3 * _percentile(values, 0.50),
+            "p99_ms": 1e3 * _percentile(values, 0.99),
+            "max_ms": 1e3 * values[-1],
+        }
+    return headers
+
+
+def _bench(config: dict, server_args: list[str], processes: int) -> dict:
+    """Mesure un serveur neuf avec des boîtes de `config['mailbox_size']` courriels."""
+    with tempfile.TemporaryDirectory(prefix="glo_bench_") as workdir:
+        started = time.perf_counter()
+        _seed(os.path.join(workdir, gloutils.SERVER_DATA_DIR), config["storage"],
+              config["users"], config["mailbox_size"], config["body_size"])
+        seed_time = time.perf_counter() - started
+        server = _start_server(workdir, config["port"], server_args)
+        try:
+            indexes = list(range(config["clients"]))
+            shares = [indexes[start::processes] for start in range(processes)]
+            with multiprocessing.Pool(processes) as pool:
+                outcomes = pool.starmap(_run_clients,
+                                        [(config, share) for share in shares if share])
+        finally:
+            _stop_server(server)
+
+    latencies: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    failures = 0
+    for process_latencies, process_errors, process_failures in outcomes:
+        for name, values in process_latencies.items():
+            latencies.setdefault(name, []).extend(values)
+        for name, count in process_errors.items():
+            errors[name] = errors.get(name, 0) + count
+        failures += process_failures
+    headers = _summary(latencies, errors, config["duration"])
+    requests = sum(summary["count"] for name, summary in headers.items()
+                   if name != "AUTH_LOGIN")
+    return {
+        "mailbox_size": config["mailbox_size"],
+        "seed_s": seed_time,
+        "requests": requests,
+        "throughput": requests / config["duration"],
+        "errors": sum(summary["errors"] for summary in headers.values()),
+        "failed_clients": failures,
+        "headers": headers,
+    }
+
+
+def _parse_mix(text: str) -> dict[str, int]:
+    mix = {}
+    for item in text.split(","):
+        operation, _, weight = item.partition("=")
+        if operation.strip() not in _OPERATIONS or not weight.strip().isdigit():
+            raise argparse.ArgumentTypeError(
+                f"Opération invalide '{item}' (choix : {', '.join(_OPERATIONS)}).")
+        if int(weight):
+            mix[operation.strip()] = int(weight)
+    if not mix:
+        raise argparse.ArgumentTypeError("Le mélange ne contient aucune opération.")
+    return mix
+
+
+def _commit() -> Optional[str]:
+    """Retourne le commit mesuré, si le dossier est un dépôt git."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(_SERVER), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=16,
+                        help="Nombre de clients simultanés.")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Nombre de processus qui font tourner les clients.")
+    parser.add_argument("--users", type=int, default=16,
+                        help="Nombre de comptes créés.")
+    parser.add_argument("--mailbox-size", default="1000",
+                        help="Courriels par boîte, plusieurs tailles séparées par des virgules.")
+    parser.add_argument("--body-size", type=int, default=1000,
+                        help="Taille (caractères) du corps des courriels.")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="Durée (s) de chaque mesure.")
+    parser.add_argument("--mix", type=_parse_mix,
+                        default=_parse_mix("send=40,list=30,read=20,stats=10"),
+                        help="Poids des opérations (send, list, read, stats, search).")
+    parser.add_argument("--json-frames", action="store_false", dest="negotiate",
+                        help="Garde les trames JSON sans compression.")
+    parser.add_argument("--engine", choices=("select", "asyncio"), default="select",
+                        help="Moteur réseau du serveur.")
+    parser.add_argument("--storage", choices=tuple(glostorage.STORAGES),
+                        default=gloutils.SERVER_STORAGE,
+                        help="Moteur de stockage du serveur.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Nombre de processus serveurs.")
+    parser.add_argument("--json", action="store_true",
+                        help="Affiche les résultats en JSON.")
+    args = parser.parse_args(sys.argv[1:])
+
+    try:
+        sizes = [int(size) for size in args.mailbox_size.split(",")]
+    except ValueError:
+        parser.error("--mailbox-size attend des entiers séparés par des virgules.")
+    config = {
+        "clients": args.clients, "users": args.users, "body_size": args.body_size,
+        "duration": args.duration, "mix": args.mix, "negotiate": args.negotiate,
+        "engine": args.engine, "storage": args.storage, "workers": args.workers,
+    }
+    server_args = ["--engine", args.engine, "--storage", args.storage,
+                   "--workers", str(args.workers)]
+    processes = max(1, min(args.processes, args.clients))
+    runs = []
+    for size in sizes:
+        try:
+            runs.append(_bench(dict(config, mailbox_size=size, port=_free_port()),
+                               server_args, processes))
+        except (OSError, RuntimeError) as e:
+            print(f"Erreur : Mesure impossible. {e}", file=sys.stderr)
+            return 1
+
+    if args.json:
+        print(json.dumps({"commit": _commit(), "config": config, "runs": runs}, indent=2))
+        return 0
+    for run in runs:
+        print(f"Boîtes de {run['mailbox_size']} courriels : {run['throughput']:.0f} requêtes/s, "
+              f"{run['errors']} erreur(s), {run['failed_clients']} client(s) en échec")
+        print(f"{'entête':>22} {'requêtes':>9} {'req/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for name, summary in run["headers"].items():
+            throughput = "-" if summary["throughput"] is None else f"{summary['throughput']:.0f}"
+            print(f"{name:>22} {summary['count']:>9} {throughput:>9} "
+                  f"{summary['p50_ms']:>9.2f} {summary['p99_ms']:>9.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,154 @@
+"""\
+Module fournissant le hachage des mots de passe du serveur mail @glo2000.ca.
+
+Les mots de passe sont hachés par une fonction de dérivation de clé salée
+et coûteuse: scrypt (`hashlib.scrypt`) ou, si OpenSSL ne la fournit pas,
+PBKDF2-HMAC-SHA256. Un hachage enregistré a la forme
+`scrypt$n$r$p$sel$clé` ou `pbkdf2_sha256$itérations$sel$clé` (sel et clé
+en hexadécimal): ses paramètres l'accompagnent, de sorte que ceux de
+gloutils (`SCRYPT_*`, `PBKDF2_ITERATIONS`) peuvent être augmentés sans
+invalider les comptes existants. Un hachage aux anciens paramètres, ou un
+SHA3-512 non salé des premières versions du serveur, est refait à la
+connexion suivante (`needs_rehash`).
+
+Ces fonctions sont volontairement lentes: le serveur les appelle hors de
+sa boucle, dans un pool dédié. hashlib relâche le GIL pendant le calcul.
+
+Le module fournit aussi les jetons de session (`make_session_token`): le
+nom d'utilisateur et l'échéance du jeton, signés par HMAC-SHA256 avec la
+clé secrète du serveur (`load_secret`). Un jeton se vérifie sans hachage
+de mot de passe ni accès au disque. Il ne peut pas être révoqué seul:
+supprimer le fichier de la clé invalide tous les jetons au redémarrage.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+from typing import Optional
+
+import gloutils
+
+SCRYPT = "scrypt"
+PBKDF2 = "pbkdf2_sha256"
+
+
+def _scrypt(password: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=gloutils.PASSWORD_KEY_SIZE)
+
+
+def _pbkdf2(password: bytes, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password, salt, iterations,
+                               dklen=gloutils.PASSWORD_KEY_SIZE)
+
+
+def hash_password(password: str) -> str:
+    """Retourne le hachage salé du mot de passe `password`, aux paramètres courants."""
+    password_data = password.encode('utf-8')
+    salt = os.urandom(gloutils.PASSWORD_SALT_SIZE)
+    if hasattr(hashlib, "scrypt"):
+        n, r, p = gloutils.SCRYPT_N, gloutils.SCRYPT_R, gloutils.SCRYPT_P
+        key = _scrypt(password_data, salt, n, r, p)
+        return f"{SCRYPT}${n}${r}${p}${salt.hex()}${key.hex()}"
+    iterations = gloutils.PBKDF2_ITERATIONS
+    key = _pbkdf2(password_data, salt, iterations)
+    return f"{PBKDF2}${iterations}${salt.hex()}${key.hex()}"
+
+
+def verify_password(password: str, stored_hash: str) -> bool:
+    """
+    Vérifie en temps constant le mot de passe `password` contre le hachage
+    enregistré `stored_hash`, quel que soit son format. Un hachage
+    illisible ne correspond à aucun mot de passe.
+    """
+    password_data = password.encode('utf-8')
+    algorithm, _, parameters = stored_hash.partition("$")
+    try:
+        if algorithm == SCRYPT:
+            n, r, p, salt, key = parameters.split("$")
+            computed = _scrypt(password_data, bytes.fromhex(salt), int(n), int(r), int(p))
+        elif algorithm == PBKDF2:
+            iterations, salt, key = parameters.split("$")
+            computed = _pbkdf2(password_data, bytes.fromhex(salt), int(iterations))
+        elif not parameters:
+            # Ancien format: SHA3-512 non salé, en hexadécimal
+            computed, key = hashlib.sha3_512(password_data).digest(), stored_hash
+        else:
+            return False
+        return hmac.compare_digest(computed, bytes.fromhex(key))
+    except ValueError:
+        return False
+
+
+def needs_rehash(stored_hash: str) -> bool:
+    """
+    Indique si le hachage enregistré doit être refait avec l'algorithme et
+    les paramètres courants.
+    """
+    algorithm, _, parameters = stored_hash.partition("$")
+    if hasattr(hashlib, "scrypt"):
+        current = f"{gloutils.SCRYPT_N}${gloutils.SCRYPT_R}${gloutils.SCRYPT_P}$"
+        return algorithm != SCRYPT or not parameters.startswith(current)
+    return algorithm != PBKDF2 or not parameters.startswith(f"{gloutils.PBKDF2_ITERATIONS}$")
+
+
+def load_secret(path: str) -> bytes:
+    """
+    Retourne la clé secrète enregistrée dans le fichier `path`, générée au
+    besoin. La clé est écrite dans un fichier temporaire (lisible par son
+    seul propriétaire) puis liée à `path`: des processus lancés ensemble
+    retiennent tous la même clé.
+
+    Lève une exception OSError en cas d'erreur d'accès au disque.
+    """
+    if not os.path.exists(path):
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(descriptor, 'wb') as secret_file:
+                secret_file.write(os.urandom(gloutils.SESSION_SECRET_SIZE))
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                pass
+        finally:
+            os.remove(temp_path)
+    with open(path, 'rb') as secret_file:
+        return secret_file.read()
+
+
+def _sign(secret: bytes, claims: str) -> str:
+    return hmac.new(secret, b"glo-session:" + claims.encode('ascii'),
+                    hashlib.sha256).hexdigest()
+
+
+def make_session_token(secret: bytes, username: str, lifetime: int) -> tuple[str, int]:
+    """
+    Retourne un jeton de session de `username` valide `lifetime` secondes,
+    et son échéance (secondes depuis l'époque Unix).
+    """
+    expires = int(time.time()) + lifetime
+    claims = base64.urlsafe_b64encode(f"{username}:{expires}".encode('utf-8'))
+    claims = claims.rstrip(b"=").decode('ascii')
+    return f"{claims}.{_sign(secret, claims)}", expires
+
+
+def check_session_token(secret: bytes, token: str) -> Optional[str]:
+    """
+    Retourne le nom d'utilisateur du jeton de session `token`, ou None si
+    sa signature est invalide ou s'il est expiré.
+    """
+    if not isinstance(token, str) or not token.isascii():
+        return None
+    claims, _, signature = token.rpartition(".")
+    if not hmac.compare_digest(_sign(secret, claims), signature):
+        return None
+    try:
+        decoded = base64.urlsafe_b64decode(claims + "=" * (-len(claims) % 4))
+        username, _, expires = decoded.decode('utf-8').rpartition(":")
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    return username or None
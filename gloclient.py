@@ -0,0 +1,991 @@
+"""\
+Module fournissant une API cliente programmatique pour le serveur mail
+@glo2000.ca, sans menus interactifs.
+
+`GloConnection` numérote ses requêtes (`request_id`) et peut en garder
+plusieurs en vol sur le même socket: les réponses sont associées à leur
+requête par l'identifiant que le serveur leur recopie. `negotiate` permet
+de passer à l'encodage binaire compact de glocodec et à la compression des
+grandes trames. Les gros courriels peuvent être envoyés et lus par morceaux.
+`AsyncGloConnection` en est l'équivalent asyncio.
+
+`GloClient` (et son équivalent asyncio `AsyncGloClient`) expose les
+opérations du serveur (compte, envoi, liste, lecture, recherche,
+statistiques) au-dessus d'un pool de connexions authentifiées: chaque
+opération emprunte une connexion libre, ou en ouvre une tant que le pool
+n'est pas plein, et la rend ensuite. Les connexions supplémentaires
+reprennent la session par son jeton (`AUTH_RESUME`), sans renvoyer le mot
+de passe; une connexion rompue est simplement remplacée. Les erreurs
+retournées par le serveur sont levées sous forme de `GloServerError`.
+"""
+import asyncio
+import contextlib
+import itertools
+import socket
+import threading
+from typing import AsyncIterator, Iterable, Iterator, Optional
+
+import glocodec
+import glosocket
+import gloutils
+
+_Request = tuple[gloutils.Headers, Optional[dict]]
+
+
+class GloServerError(Exception):
+    """Erreur retournée par le serveur (entête `ERROR`), avec son message."""
+
+
+class _Connection:
+    """
+    État commun aux connexions synchrone et asyncio: numérotation des
+    requêtes, association des réponses et capacités négociées.
+    """
+
+    def __init__(self, compress_threshold: int) -> None:
+        """
+        Une fois la compression négociée, les requêtes d'au moins
+        `compress_threshold` octets sont compressées.
+
+        Prépare les attributs suivants:
+        - `session` le jeton de la session authentifiée sur la connexion,
+            None sinon (tenu par `GloClient`).
+        - `_request_ids` le générateur des identifiants de requête.
+        - `_in_flight` les identifiants des requêtes envoyées dont la
+            réponse n'a pas encore été lue, dans l'ordre d'envoi.
+        - `_responses` les réponses lues en avance, par identifiant.
+        - `_encoding` l'encodage des requêtes (JSON jusqu'à `negotiate`).
+        - `_compress_threshold` le seuil de compression des requêtes, None
+            tant que la compression n'est pas négociée.
+        """
+        self.session: Optional[str] = None
+        self._request_ids = itertools.count(1)
+        self._in_flight: list[int] = []
+        self._responses: dict[int, gloutils.GloMessage] = {}
+        self._encoding = glocodec.JSON_ENCODING
+        self._compress_threshold: Optional[int] = None
+        self._negotiated_threshold = compress_threshold
+
+    def _frame(self, header: gloutils.Headers, payload: Optional[dict],
+               request_id: Optional[int]) -> bytes:
+        """Construit la trame d'une requête."""
+        message = gloutils.GloMessage(header=header)
+        if payload is not None:
+            message["payload"] = payload
+        if request_id is not None:
+            message["request_id"] = request_id
+        return glosocket.encode_frame(glocodec.encode(message, self._encoding),
+                                      self._compress_threshold)
+
+    def _frames(self, requests: list[_Request]) -> tuple[list[int], bytes]:
+        """Numérote des requêtes et retourne leurs identifiants et leurs trames."""
+        request_ids = [next(self._request_ids) for _ in requests]
+        frames = b"".join(self._frame(header, payload, request_id)
+                          for (header, payload), request_id in zip(requests, request_ids))
+        return request_ids, frames
+
+    def _check_pending(self, request_id: int) -> None:
+        """Vérifie que la réponse à `request_id` est attendue."""
+        if request_id not in self._in_flight:
+            raise glosocket.GLOSocketError(
+                f"Aucune requête {request_id} en attente de réponse.")
+
+    def _store(self, response: gloutils.GloMessage) -> None:
+        """
+        Met de côté une réponse lue. Une réponse sans `request_id` (ancien
+        serveur) est associée à la plus ancienne requête en vol, les
+        réponses étant ordonnées; sans requête en vol, elle est inattendue.
+        """
+        if "request_id" in response:
+            response_id = response["request_id"]
+        elif self._in_flight:
+            response_id = self._in_flight[0]
+        else:
+            raise glosocket.GLOSocketError("Réponse inattendue du serveur.")
+        if response_id in self._in_flight:
+            self._in_flight.remove(response_id)
+        self._responses[response_id] = response
+
+    @staticmethod
+    def _capabilities(encodings: tuple[str, ...], compressions: tuple[str, ...]
+                      ) -> gloutils.CapabilitiesPayload:
+        return gloutils.CapabilitiesPayload(encodings=list(encodings),
+                                            compressions=list(compressions))
+
+    def _apply_capabilities(self, response: gloutils.GloMessage
+                            ) -> gloutils.CapabilitiesPayload:
+        """Retient les capacités de la réponse à `CAPABILITIES`."""
+        capabilities = gloutils.CapabilitiesPayload(encoding=glocodec.JSON_ENCODING)
+        if response.get("header") == gloutils.Headers.OK:
+            capabilities.update(response["payload"])
+        self._encoding = capabilities["encoding"]
+        if "compression" in capabilities:
+            self._compress_threshold = self._negotiated_threshold
+        return capabilities
+
+    @staticmethod
+    def _chunk_data(message: gloutils.GloMessage) -> Optional[str]:
+        """
+        Retourne le morceau de courriel du message, ou None à la fin du
+        courriel (`EMAIL_STREAM_END`).
+        """
+        header = message.get("header")
+        if header == gloutils.Headers.EMAIL_STREAM_END:
+            return None
+        if header != gloutils.Headers.EMAIL_STREAM_CHUNK:
+            raise glosocket.GLOSocketError(
+                "Réponse inattendue pendant la lecture du courriel.")
+        return message["payload"]["data"]
+
+
+class GloConnection(_Connection):
+    """Connexion au serveur mail permettant le pipelining des requêtes."""
+
+    def __init__(self, destination: str, port: int = gloutils.APP_PORT,
+                 compress_threshold: int = gloutils.COMPRESSION_THRESHOLD) -> None:
+        """
+        Connecte le socket `_socket` au serveur (voir `_Connection`).
+
+        Lève une exception GLOSocketError si la connexion échoue.
+        """
+        super().__init__(compress_threshold)
+        try:
+            self._socket = socket.create_connection((destination, port))
+        except OSError as ex:
+            raise glosocket.GLOSocketError(
+                f"Connexion au serveur {destination} impossible.") from ex
+
+    def close(self) -> None:
+        """Ferme le socket de la connexion."""
+        self._socket.close()
+
+    def negotiate(self, encodings: tuple[str, ...] = glocodec.ENCODINGS,
+                  compressions: tuple[str, ...] = glosocket.COMPRESSIONS
+                  ) -> gloutils.CapabilitiesPayload:
+        """
+        Propose au serveur les `encodings` et `compressions` acceptés, par
+        ordre de préférence, et retourne les capacités retenues, utilisées
+        ensuite dans les deux sens. Un serveur qui ne connaît pas
+        `CAPABILITIES` reste en JSON sans compression.
+
+        À appeler sans requête en vol. Lève une exception GLOSocketError en
+        cas de problème de communication.
+        """
+        response = self.request(gloutils.Headers.CAPABILITIES,
+                                self._capabilities(encodings, compressions))
+        return self._apply_capabilities(response)
+
+    def notify(self, header: gloutils.Headers, payload: Optional[dict] = None) -> None:
+        """
+        Envoie une requête qui n'appelle pas de réponse (`BYE`, `AUTH_LOGOUT`).
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        try:
+            self._socket.sendall(self._frame(header, payload, None))
+        except OSError as ex:
+            raise glosocket.GLOSocketError("Cannot send data with socket") from ex
+
+    def submit(self, header: gloutils.Headers, payload: Optional[dict] = None) -> int:
+        """
+        Envoie une requête sans attendre sa réponse et retourne son
+        identifiant, à passer ensuite à `result`.
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        return self.submit_many([(header, payload)])[0]
+
+    def submit_many(self, requests: list[_Request]) -> list[int]:
+        """
+        Envoie plusieurs requêtes en un seul envoi, sans attendre leurs
+        réponses, et retourne leurs identifiants dans le même ordre.
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        request_ids, frames = self._frames(requests)
+        try:
+            self._socket.sendall(frames)
+        except OSError as ex:
+            raise glosocket.GLOSocketError("Cannot send data with socket") from ex
+        self._in_flight.extend(request_ids)
+        return request_ids
+
+    def result(self, request_id: int) -> gloutils.GloMessage:
+        """
+        Retourne la réponse à la requête `request_id`, en lisant et en
+        mettant de côté les réponses des autres requêtes au besoin.
+
+        Une réponse sans `request_id` (ancien serveur) est associée à la
+        plus ancienne requête en vol, les réponses étant ordonnées.
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        while request_id not in self._responses:
+            self._check_pending(request_id)
+            self._store(glocodec.decode(glosocket.recv_frame(self._socket)))
+        return self._responses.pop(request_id)
+
+    def request(self, header: gloutils.Headers,
+                payload: Optional[dict] = None) -> gloutils.GloMessage:
+        """
+        Envoie une requête et attend sa réponse.
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        return self.result(self.submit(header, payload))
+
+    def pipeline(self, requests: list[_Request]) -> list[gloutils.GloMessage]:
+        """
+        Envoie toutes les requêtes d'un coup puis retourne leurs réponses
+        dans le même ordre: un seul aller-retour pour tout le lot.
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        return [self.result(request_id) for request_id in self.submit_many(requests)]
+
+    def send_email_stream(self, email: gloutils.EmailStreamPayload,
+                          chunks: Iterable[str]) -> gloutils.GloMessage:
+        """
+        Envoie un courriel dont le corps est transmis par morceaux
+        (`EMAIL_STREAM_*`), sans jamais le garder en entier en mémoire, et
+        retourne la réponse du serveur (comme pour `EMAIL_SENDING`).
+
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        self.notify(gloutils.Headers.EMAIL_STREAM_BEGIN, email)
+        for data in chunks:
+            self.notify(gloutils.Headers.EMAIL_STREAM_CHUNK,
+                        gloutils.EmailChunkPayload(data=data))
+        return self.request(gloutils.Headers.EMAIL_STREAM_END)
+
+    def read_email_stream(self, email_id: int
+                          ) -> tuple[gloutils.GloMessage, Iterator[str]]:
+        """
+        Demande le courriel `email_id` par morceaux (`INBOX_READING_STREAM`)
+        et retourne la réponse du serveur (entêtes du courriel ou erreur)
+        ainsi qu'un itérateur sur les morceaux du corps.
+
+        Les morceaux doivent être lus en entier avant toute autre réponse.
+        Lève une exception GLOSocketError en cas de problème de communication.
+        """
+        request_id = self.submit(gloutils.Headers.INBOX_READING_STREAM,
+                                 gloutils.EmailChoicePayload(email_id=email_id))
+        response = self.result(request_id)
+        if response.get("header") != gloutils.Headers.OK:
+            return response, iter(())
+        return response, self._read_chunks()
+
+    def _read_chunks(self) -> Iterator[str]:
+        """Lit les morceaux d'un courriel jusqu'à `EMAIL_STREAM_END`."""
+        while (data := self._chunk_data(
+                glocodec.decode(glosocket.recv_frame(self._socket)))) is not None:
+            yield data
+
+
+class AsyncGloConnection(_Connection):
+    """Équivalent asyncio de `GloConnection`, sur un couple de flux."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 compress_threshold: int = gloutils.COMPRESSION_THRESHOLD) -> None:
+        """Prépare la connexion établie sur `reader` et `writer` (voir `_Connection`)."""
+        super().__init__(compress_threshold)
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def open(cls, destination: str, port: int = gloutils.APP_PORT,
+                   compress_threshold: int = gloutils.COMPRESSION_THRESHOLD
+                   ) -> "AsyncGloConnection":
+        """
+        Connecte une nouvelle connexion au serveur.
+
+        Lève une exception GLOSocketError si la connexion échoue.
+        """
+        try:
+            reader, writer = await asyncio.open_connection(destination, port)
+        except OSError as ex:
+            raise glosocket.GLOSocketError(
+                f"Connexion au serveur {destination} impossible.") from ex
+        return cls(reader, writer, compress_threshold)
+
+    async def close(self) -> None:
+        """Ferme la connexion."""
+        self._writer.close()
+        with contextlib.suppress(OSError):
+            await self._writer.wait_closed()
+
+    async def _send(self, frames: bytes) -> None:
+        try:
+            self._writer.write(frames)
+            await self._writer.drain()
+        except OSError as ex:
+            raise glosocket.GLOSocketError("Cannot send data with stream") from ex
+
+    async def _receive(self) -> gloutils.GloMessage:
+        return glocodec.decode(await glosocket.recv_frame_async(self._reader))
+
+    async def negotiate(self, encodings: tuple[str, ...] = glocodec.ENCODINGS,
+                        compressions: tuple[str, ...] = glosocket.COMPRESSIONS
+                        ) -> gloutils.CapabilitiesPayload:
+        """Voir `GloConnection.negotiate`."""
+        response = await self.request(gloutils.Headers.CAPABILITIES,
+                                      self._capabilities(encodings, compressions))
+        return self._apply_capabilities(response)
+
+    async def notify(self, header: gloutils.Headers, payload: Optional[dict] = None) -> None:
+        """Voir `GloConnection.notify`."""
+        await self._send(self._frame(header, payload, None))
+
+    async def submit(self, header: gloutils.Headers, payload: Optional[dict] = None) -> int:
+        """Voir `GloConnection.submit`."""
+        return (await self.submit_many([(header, payload)]))[0]
+
+    async def submit_many(self, requests: list[_Request]) -> list[int]:
+        """Voir `GloConnection.submit_many`."""
+        request_ids, frames = self._frames(requests)
+        await self._send(frames)
+        self._in_flight.extend(request_ids)
+        return request_ids
+
+    async def result(self, request_id: int) -> gloutils.GloMessage:
+        """Voir `GloConnection.result`."""
+        while request_id not in self._responses:
+            self._check_pending(request_id)
+            self._store(await self._receive())
+        return self._responses.pop(request_id)
+
+    async def request(self, header: gloutils.Headers,
+                      payload: Optional[dict] = None) -> gloutils.GloMessage:
+        """Voir `GloConnection.request`."""
+        return await self.result(await self.submit(header, payload))
+
+    async def pipeline(self, requests: list[_Request]) -> list[gloutils.GloMessage]:
+        """Voir `GloConnection.pipeline`."""
+        return [await self.result(request_id)
+                for request_id in await self.submit_many(requests)]
+
+    async def send_email_stream(self, email: gloutils.EmailStreamPayload,
+                                chunks: Iterable[str]) -> gloutils.GloMessage:
+        """Voir `GloConnection.send_email_stream`."""
+        await self.notify(gloutils.Headers.EMAIL_STREAM_BEGIN, email)
+        for data in chunks:
+            await self.notify(gloutils.Headers.EMAIL_STREAM_CHUNK,
+                              gloutils.EmailChunkPayload(data=data))
+        return await self.request(gloutils.Headers.EMAIL_STREAM_END)
+
+    async def read_email_stream(self, email_id: int
+                                ) -> tuple[gloutils.GloMessage, AsyncIterator[str]]:
+        """Voir `GloConnection.read_email_stream`."""
+        request_id = await self.submit(gloutils.Headers.INBOX_READING_STREAM,
+                                       gloutils.EmailChoicePayload(email_id=email_id))
+        response = await self.result(request_id)
+        if response.get("header") != gloutils.Headers.OK:
+            return response, _no_chunks()
+        return response, self._read_chunks()
+
+    async def _read_chunks(self) -> AsyncIterator[str]:
+        """Lit les morceaux d'un courriel jusqu'à `EMAIL_STREAM_END`."""
+        while (data := self._chunk_data(await self._receive())) is not None:
+            yield data
+
+
+async def _no_chunks() -> AsyncIterator[str]:
+    return
+    yield
+
+
+class _Client:
+    """
+    Traitements communs à `GloClient` et `AsyncGloClient`, sans
+    entrées-sorties: construction des requêtes et lecture des réponses.
+    """
+
+    def __init__(self, destination: str, port: int, pool_size: int,
+                 negotiate: bool) -> None:
+        """
+        Prépare un pool d'au plus `pool_size` connexions au serveur
+        `destination`. Si `negotiate` est vrai, chaque connexion négocie
+        l'encodage binaire et la compression.
+
+        Prépare les attributs suivants:
+        - `_idle` les connexions libres.
+        - `_username` et `_password` le compte connecté, gardés pour rouvrir
+            la session si son jeton expire.
+        - `_session` le jeton de la session courante, None hors session.
+            Une connexion dont la `session` diffère est fermée plutôt que
+            réutilisée.
+        """
+        self._destination = destination
+        self._port = port
+        self._pool_size = pool_size
+        self._negotiate = negotiate
+        self._idle: list = []
+        self._username = ""
+        self._password = ""
+        self._session: Optional[str] = None
+
+    @property
+    def username(self) -> str:
+        """Nom de l'utilisateur connecté, vide hors session."""
+        return self._username
+
+    @staticmethod
+    def _payload(response: gloutils.GloMessage) -> dict:
+        """
+        Retourne le payload d'une réponse `OK`.
+
+        Lève une exception GloServerError si le serveur a répondu `ERROR`.
+        """
+        if response.get("header") != gloutils.Headers.OK:
+            raise GloServerError(response.get("payload", {}).get(
+                "error_message", "Erreur inconnue du serveur."))
+        return response.get("payload", {})
+
+    def _login_request(self) -> _Request:
+        return (gloutils.Headers.AUTH_LOGIN,
+                gloutils.LoginPayload(username=self._username,
+                                      password=self._password, session=True))
+
+    def _start_session(self, username: str, password: str, payload: dict) -> None:
+        """Retient le compte et le jeton de la session ouverte par `AUTH_LOGIN`."""
+        self._username = username
+        self._password = password
+        self._session = payload.get("token")
+
+    def _end_session(self) -> list:
+        """
+        Oublie la session et retourne les connexions libres, à fermer. Hors
+        session, les connexions libres sont gardées.
+        """
+        if self._session is None and not self._username:
+            return []
+        self._username = self._password = ""
+        self._session = None
+        idle, self._idle = self._idle, []
+        return idle
+
+    def _take_idle(self) -> tuple[Optional[_Connection], list]:
+        """
+        Retourne une connexion libre de la session courante, ou None, et
+        les connexions libres d'une autre session, à fermer.
+        """
+        stale = []
+        while self._idle:
+            connection = self._idle.pop()
+            if connection.session == self._session:
+                return connection, stale
+            stale.append(connection)
+        return None, stale
+
+    def _keep(self, connection: _Connection) -> bool:
+        """Rend une connexion au pool si elle appartient à la session courante."""
+        if connection.session != self._session:
+            return False
+        self._idle.append(connection)
+        return True
+
+    def _email(self, destination: str, subject: str,
+               content: str) -> gloutils.EmailContentPayload:
+        return gloutils.EmailContentPayload(
+            sender=f"{self._username}@{gloutils.SERVER_DOMAIN}",
+            destination=destination,
+            subject=subject,
+            date=gloutils.get_current_utc_time(),
+            content=content)
+
+    @staticmethod
+    def _stream_parts(email: gloutils.EmailContentPayload
+                      ) -> tuple[gloutils.EmailStreamPayload, Iterator[str]]:
+        """Découpe un courriel en entêtes et en morceaux de corps."""
+        headers = gloutils.EmailStreamPayload(
+            {key: value for key, value in email.items() if key != "content"})
+        content = email["content"]
+        size = gloutils.EMAIL_STREAM_CHUNK_SIZE
+        return headers, (content[start:start + size] for start in range(0, len(content), size))
+
+    @staticmethod
+    def _is_large(content: str) -> bool:
+        return len(content) >= gloutils.EMAIL_STREAM_THRESHOLD
+
+    @staticmethod
+    def _batch_requests(email: gloutils.EmailContentPayload,
+                        destinations: list[str]) -> list[_Request]:
+        """Requêtes `EMAIL_BATCH_SENDING` d'au plus `EMAIL_BATCH_MAX` destinataires."""
+        return [(gloutils.Headers.EMAIL_BATCH_SENDING,
+                 gloutils.EmailBatchPayload(
+                     messages=[email],
+                     destinations=destinations[start:start + gloutils.EMAIL_BATCH_MAX]))
+                for start in range(0, len(destinations), gloutils.EMAIL_BATCH_MAX)]
+
+    @staticmethod
+    def _result(index: int, destination: str,
+                response: gloutils.GloMessage) -> gloutils.EmailResultPayload:
+        """Résultat de l'envoi d'un courriel, sur le modèle d'`EMAIL_BATCH_SENDING`."""
+        result = gloutils.EmailResultPayload(message_index=index, destination=destination,
+                                             header=response.get("header"))
+        if result["header"] != gloutils.Headers.OK:
+            result["error_message"] = response.get("payload", {}).get(
+                "error_message", "Erreur inconnue du serveur.")
+        return result
+
+    @staticmethod
+    def _batch_results(responses: list[gloutils.GloMessage]
+                       ) -> list[gloutils.EmailResultPayload]:
+        results = []
+        for response in responses:
+            results.extend(_Client._payload(response)["results"])
+        return results
+
+    @staticmethod
+    def _list_request(offset: int, limit: int,
+                      before_id: Optional[int]) -> gloutils.InboxRequestPayload:
+        payload = gloutils.InboxRequestPayload(offset=offset, limit=limit)
+        if before_id is not None:
+            payload["before_id"] = before_id
+        return payload
+
+
+class GloClient(_Client):
+    """
+    Client programmatique du serveur mail, utilisable par plusieurs fils:
+    chacun emprunte sa propre connexion du pool.
+    """
+
+    def __init__(self, destination: str, port: int = gloutils.APP_PORT,
+                 pool_size: int = gloutils.CLIENT_POOL_SIZE,
+                 negotiate: bool = True) -> None:
+        """
+        Prépare le pool (voir `_Client`), sans se connecter: `_lock` protège
+        son état et `_slots` limite le nombre de connexions ouvertes.
+        """
+        super().__init__(destination, port, pool_size, negotiate)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def __enter__(self) -> "GloClient":
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        """
+        Ouvre une première connexion, pour vérifier que le serveur répond.
+
+        Lève une exception GLOSocketError si la connexion échoue.
+        """
+        with self._connection():
+            pass
+
+    def close(self) -> None:
+        """Ferme les connexions libres; celles en cours d'usage le seront à leur retour."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._close(connection)
+
+    @staticmethod
+    def _close(connection: GloConnection) -> None:
+        """Prévient le serveur (`BYE`) et ferme la connexion."""
+        with contextlib.suppress(glosocket.GLOSocketError):
+            connection.notify(gloutils.Headers.BYE)
+        connection.close()
+
+    def _open(self) -> GloConnection:
+        """
+        Ouvre une connexion, négocie ses capacités et y reprend la session
+        courante. Si le jeton est refusé (expiré, clé du serveur changée),
+        la session est rouverte avec le mot de passe.
+        """
+        connection = GloConnection(self._destination, self._port)
+        try:
+            if self._negotiate:
+                connection.negotiate()
+            session = self._session
+            if session is not None:
+                response = connection.request(gloutils.Headers.AUTH_RESUME,
+                                              gloutils.SessionPayload(token=session))
+                if response.get("header") != gloutils.Headers.OK:
+                    self._relogin(connection)
+                else:
+                    connection.session = session
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def _relogin(self, connection: GloConnection) -> None:
+        with self._lock:
+            username, password = self._username, self._password
+        payload = self._payload(connection.request(*self._login_request()))
+        with self._lock:
+            if self._username == username:
+                self._start_session(username, password, payload)
+        connection.session = payload.get("token")
+
+    @contextlib.contextmanager
+    def _connection(self) -> Iterator[GloConnection]:
+        """
+        Emprunte une connexion du pool, ouverte au besoin, et la rend à la
+        fin du bloc. Une connexion dans un état inconnu après une exception
+        autre que GloServerError est fermée.
+        """
+        with self._slots:
+            with self._lock:
+                connection, stale = self._take_idle()
+            for old in stale:
+                self._close(old)
+            if connection is None:
+                connection = self._open()
+            try:
+                yield connection
+            except GloServerError:
+                self._release(connection)
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            self._release(connection)
+
+    def _release(self, connection: GloConnection) -> None:
+        with self._lock:
+            kept = self._keep(connection)
+        if not kept:
+            self._close(connection)
+
+    def _request(self, header: gloutils.Headers, payload: Optional[dict] = None) -> dict:
+        """
+        Envoie une requête sans effet de bord et retourne le payload de sa
+        réponse. Elle est renvoyée une fois sur une nouvelle connexion si
+        la connexion empruntée a été fermée entre-temps par le serveur.
+        """
+        try:
+            with self._connection() as connection:
+                return self._payload(connection.request(header, payload))
+        except glosocket.GLOSocketError:
+            with self._connection() as connection:
+                return self._payload(connection.request(header, payload))
+
+    def register(self, username: str, password: str) -> None:
+        """
+        Crée le compte `username` et ouvre sa session.
+
+        Lève une exception GloServerError si le serveur refuse le compte.
+        """
+        self.logout()
+        with self._connection() as connection:
+            register, login = connection.pipeline([
+                (gloutils.Headers.AUTH_REGISTER,
+                 gloutils.AuthPayload(username=username, password=password)),
+                (gloutils.Headers.AUTH_LOGIN,
+                 gloutils.LoginPayload(username=username, password=password, session=True))])
+            self._payload(register)
+            payload = self._payload(login)
+            with self._lock:
+                self._start_session(username, password, payload)
+            connection.session = self._session
+
+    def login(self, username: str, password: str) -> None:
+        """
+        Ouvre la session de `username`.
+
+        Lève une exception GloServerError si le serveur refuse la connexion.
+        """
+        self.logout()
+        with self._connection() as connection:
+            payload = self._payload(connection.request(
+                gloutils.Headers.AUTH_LOGIN,
+                gloutils.LoginPayload(username=username, password=password, session=True)))
+            with self._lock:
+                self._start_session(username, password, payload)
+            connection.session = self._session
+
+    def logout(self) -> None:
+        """Ferme la session: les connexions libres sont fermées."""
+        with self._lock:
+            idle = self._end_session()
+        for connection in idle:
+            self._close(connection)
+
+    def send_email(self, destination: str, subject: str, content: str) -> None:
+        """
+        Envoie un courriel à `destination`. Un corps d'au moins
+        `EMAIL_STREAM_THRESHOLD` caractères est transmis par morceaux.
+
+        Lève une exception GloServerError si le serveur refuse l'envoi.
+        """
+        email = self._email(destination, subject, content)
+        with self._connection() as connection:
+            if self._is_large(content):
+                self._payload(connection.send_email_stream(*self._stream_parts(email)))
+            else:
+                self._payload(connection.request(gloutils.Headers.EMAIL_SENDING, email))
+
+    def send_batch(self, destinations: list[str], subject: str,
+                   content: str) -> list[gloutils.EmailResultPayload]:
+        """
+        Envoie le même courriel à chacune des `destinations` et retourne le
+        résultat de chaque livraison. Les lots d'`EMAIL_BATCH_SENDING` sont
+        envoyés d'un coup; un gros courriel est transmis par morceaux à
+        chaque destinataire.
+        """
+        with self._connection() as connection:
+            if not self._is_large(content):
+                email = self._email(", ".join(destinations), subject, content)
+                return self._batch_results(connection.pipeline(
+                    self._batch_requests(email, destinations)))
+            results = []
+            for destination in destinations:
+                email = self._email(destination, subject, content)
+                response = connection.send_email_stream(*self._stream_parts(email))
+                results.append(self._result(0, destination, response))
+            return results
+
+    def send_emails(self, emails: list[gloutils.EmailContentPayload]
+                    ) -> list[gloutils.EmailResultPayload]:
+        """
+        Envoie des courriels déjà construits (voir `email`) en pipelinant
+        les `EMAIL_SENDING` sur une même connexion: le serveur les livre
+        ensemble. Retourne le résultat de chacun, dans le même ordre.
+        """
+        with self._connection() as connection:
+            responses = connection.pipeline(
+                [(gloutils.Headers.EMAIL_SENDING, email) for email in emails])
+        return [self._result(index, email["destination"], response)
+                for index, (email, response) in enumerate(zip(emails, responses))]
+
+    def email(self, destination: str, subject: str,
+              content: str) -> gloutils.EmailContentPayload:
+        """Construit un courriel de l'utilisateur connecté, daté de maintenant."""
+        return self._email(destination, subject, content)
+
+    def list_emails(self, offset: int = 0, limit: int = gloutils.INBOX_PAGE_SIZE,
+                    before_id: Optional[int] = None) -> gloutils.EmailListPayload:
+        """Retourne une page de la liste des courriels (voir `InboxRequestPayload`)."""
+        return self._request(gloutils.Headers.INBOX_READING_REQUEST,
+                             self._list_request(offset, limit, before_id))
+
+    def search(self, query: str,
+               limit: int = gloutils.INBOX_PAGE_SIZE) -> gloutils.EmailListPayload:
+        """Retourne les courriels correspondant à `query` (voir `SearchPayload`)."""
+        return self._request(gloutils.Headers.INBOX_SEARCH,
+                             gloutils.SearchPayload(query=query, limit=limit))
+
+    def stats(self) -> gloutils.StatsPayload:
+        """Retourne les statistiques de la boîte."""
+        return self._request(gloutils.Headers.STATS_REQUEST)
+
+    @contextlib.contextmanager
+    def open_email(self, email_id: int
+                   ) -> Iterator[tuple[gloutils.EmailStreamPayload, Iterator[str]]]:
+        """
+        Ouvre le courriel `email_id`: le bloc reçoit ses entêtes et un
+        itérateur sur les morceaux de son corps, lus au fur et à mesure.
+
+        Lève une exception GloServerError si le courriel n'existe pas.
+        """
+        with self._connection() as connection:
+            response, chunks = connection.read_email_stream(email_id)
+            yield self._payload(response), chunks
+            # Les morceaux non lus sont consommés pour réutiliser la connexion
+            for _ in chunks:
+                pass
+
+    def fetch_email(self, email_id: int) -> gloutils.EmailContentPayload:
+        """Retourne le courriel `email_id` en entier (voir `open_email`)."""
+        with self.open_email(email_id) as (email, chunks):
+            return gloutils.EmailContentPayload(email, content="".join(chunks))
+
+
+class AsyncGloClient(_Client):
+    """Équivalent asyncio de `GloClient`, utilisable par plusieurs tâches."""
+
+    def __init__(self, destination: str, port: int = gloutils.APP_PORT,
+                 pool_size: int = gloutils.CLIENT_POOL_SIZE,
+                 negotiate: bool = True) -> None:
+        """Prépare le pool (voir `_Client`); `_slots` limite les connexions ouvertes."""
+        super().__init__(destination, port, pool_size, negotiate)
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def __aenter__(self) -> "AsyncGloClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.close()
+
+    async def connect(self) -> None:
+        """Voir `GloClient.connect`."""
+        async with self._connection():
+            pass
+
+    async def close(self) -> None:
+        """Voir `GloClient.close`."""
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await self._close(connection)
+
+    @staticmethod
+    async def _close(connection: AsyncGloConnection) -> None:
+        with contextlib.suppress(glosocket.GLOSocketError):
+            await connection.notify(gloutils.Headers.BYE)
+        await connection.close()
+
+    async def _open(self) -> AsyncGloConnection:
+        """Voir `GloClient._open`."""
+        connection = await AsyncGloConnection.open(self._destination, self._port)
+        try:
+            if self._negotiate:
+                await connection.negotiate()
+            session = self._session
+            if session is not None:
+                response = await connection.request(gloutils.Headers.AUTH_RESUME,
+                                                    gloutils.SessionPayload(token=session))
+                if response.get("header") != gloutils.Headers.OK:
+                    await self._relogin(connection)
+                else:
+                    connection.session = session
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    async def _relogin(self, connection: AsyncGloConnection) -> None:
+        username, password = self._username, self._password
+        payload = self._payload(await connection.request(*self._login_request()))
+        if self._username == username:
+            self._start_session(username, password, payload)
+        connection.session = payload.get("token")
+
+    @contextlib.asynccontextmanager
+    async def _connection(self) -> AsyncIterator[AsyncGloConnection]:
+        """Voir `GloClient._connection`."""
+        async with self._slots:
+            connection, stale = self._take_idle()
+            for old in stale:
+                await self._close(old)
+            if connection is None:
+                connection = await self._open()
+            try:
+                yield connection
+            except GloServerError:
+                await self._release(connection)
+                raise
+            except BaseException:
+                await connection.close()
+                raise
+            await self._release(connection)
+
+    async def _release(self, connection: AsyncGloConnection) -> None:
+        if not self._keep(connection):
+            await self._close(connection)
+
+    async def _request(self, header: gloutils.Headers,
+                       payload: Optional[dict] = None) -> dict:
+        """Voir `GloClient._request`."""
+        try:
+            async with self._connection() as connection:
+                return self._payload(await connection.request(header, payload))
+        except glosocket.GLOSocketError:
+            async with self._connection() as connection:
+                return self._payload(await connection.request(header, payload))
+
+    async def register(self, username: str, password: str) -> None:
+        """Voir `GloClient.register`."""
+        await self.logout()
+        async with self._connection() as connection:
+            register, login = await connection.pipeline([
+                (gloutils.Headers.AUTH_REGISTER,
+                 gloutils.AuthPayload(username=username, password=password)),
+                (gloutils.Headers.AUTH_LOGIN,
+                 gloutils.LoginPayload(username=username, password=password, session=True))])
+            self._payload(register)
+            self._start_session(username, password, self._payload(login))
+            connection.session = self._session
+
+    async def login(self, username: str, password: str) -> None:
+        """Voir `GloClient.login`."""
+        await self.logout()
+        async with self._connection() as connection:
+            payload = self._payload(await connection.request(
+                gloutils.Headers.AUTH_LOGIN,
+                gloutils.LoginPayload(username=username, password=password, session=True)))
+            self._start_session(username, password, payload)
+            connection.session = self._session
+
+    async def logout(self) -> None:
+        """Voir `GloClient.logout`."""
+        for connection in self._end_session():
+            await self._close(connection)
+
+    async def send_email(self, destination: str, subject: str, content: str) -> None:
+        """Voir `GloClient.send_email`."""
+        email = self._email(destination, subject, content)
+        async with self._connection() as connection:
+            if self._is_large(content):
+                self._payload(await connection.send_email_stream(*self._stream_parts(email)))
+            else:
+                self._payload(await connection.request(gloutils.Headers.EMAIL_SENDING, email))
+
+    async def send_batch(self, destinations: list[str], subject: str,
+                         content: str) -> list[gloutils.EmailResultPayload]:
+        """Voir `GloClient.send_batch`."""
+        async with self._connection() as connection:
+            if not self._is_large(content):
+                email = self._email(", ".join(destinations), subject, content)
+                return self._batch_results(await connection.pipeline(
+                    self._batch_requests(email, destinations)))
+            results = []
+            for destination in destinations:
+                email = self._email(destination, subject, content)
+                response = await connection.send_email_stream(*self._stream_parts(email))
+                results.append(self._result(0, destination, response))
+            return results
+
+    async def send_emails(self, emails: list[gloutils.EmailContentPayload]
+                          ) -> list[gloutils.EmailResultPayload]:
+        """Voir `GloClient.send_emails`."""
+        async with self._connection() as connection:
+            responses = await connection.pipeline(
+                [(gloutils.Headers.EMAIL_SENDING, email) for email in emails])
+        return [self._result(index, email["destination"], response)
+                for index, (email, response) in enumerate(zip(emails, responses))]
+
+    def email(self, destination: str, subject: str,
+              content: str) -> gloutils.EmailContentPayload:
+        """Voir `GloClient.email`."""
+        return self._email(destination, subject, content)
+
+    async def list_emails(self, offset: int = 0, limit: int = gloutils.INBOX_PAGE_SIZE,
+                          before_id: Optional[int] = None) -> gloutils.EmailListPayload:
+        """Voir `GloClient.list_emails`."""
+        return await self._request(gloutils.Headers.INBOX_READING_REQUEST,
+                                   self._list_request(offset, limit, before_id))
+
+    async def search(self, query: str,
+                     limit: int = gloutils.INBOX_PAGE_SIZE) -> gloutils.EmailListPayload:
+        """Voir `GloClient.search`."""
+        return await self._request(gloutils.Headers.INBOX_SEARCH,
+                                   gloutils.SearchPayload(query=query, limit=limit))
+
+    async def stats(self) -> gloutils.StatsPayload:
+        """Voir `GloClient.stats`."""
+        return await self._request(gloutils.Headers.STATS_REQUEST)
+
+    @contextlib.asynccontextmanager
+    async def open_email(self, email_id: int
+                         ) -> AsyncIterator[tuple[gloutils.EmailStreamPayload,
+                                                  AsyncIterator[str]]]:
+        """Voir `GloClient.open_email`."""
+        async with self._connection() as connection:
+            response, chunks = await connection.read_email_stream(email_id)
+            yield self._payload(response), chunks
+            async for _ in chunks:
+                pass
+
+    async def fetch_email(self, email_id: int) -> gloutils.EmailContentPayload:
+        """Voir `GloClient.fetch_email`."""
+        async with self.open_email(email_id) as (email, chunks):
+            return gloutils.EmailContentPayload(email, content="".join(
+                [data async for data in chunks]))
@@ -0,0 +1,406 @@
+"""\
+Module fournissant les encodages des messages `GloMessage` échangés dans
+les trames de glosocket.
+
+Deux encodages sont disponibles:
+- `json` (par défaut), le message sérialisé en JSON UTF-8;
+- `binary`, un encodage compact négocié par l'entête `CAPABILITIES`.
+
+Une trame binaire a la forme suivante (entiers gros-boutistes):
+- 1 octet: la valeur de l'entête (`Headers`);
+- 1 octet: les indicateurs (`_HAS_PAYLOAD`, `_HAS_REQUEST_ID`);
+- le `request_id` (tableau d'entiers d'un élément), s'il est présent;
+- 1 octet: le type de payload (`_SCHEMAS`), puis le payload, s'il est présent.
+
+Les entiers sont écrits en tableaux: un octet de format struct (`b`, `h`,
+`i`, `q` ou leurs variantes non signées) choisi selon les valeurs, suivi des
+valeurs. Une chaîne est sa taille (tableau d'un élément) suivie de son
+UTF-8. Un payload est un masque des champs présents suivi de ses champs
+dans l'ordre de déclaration de son TypedDict.
+
+Les listes sont écrites par colonnes pour limiter le travail en Python: une
+liste de chaînes est sa taille, le tableau des tailles puis les octets mis
+bout à bout; une liste de payloads est le tableau de leurs masques puis,
+pour chaque champ, la liste des valeurs présentes.
+
+Les messages qui ne correspondent à aucun gabarit de gloutils sont envoyés
+en JSON. Le décodage reconnaît les deux encodages: une trame JSON commence
+toujours par `{`, qui n'est la valeur d'aucune entête.
+"""
+import itertools
+import json
+import struct
+import typing
+from typing import Any, Optional
+
+import glosocket
+import gloutils
+
+JSON_ENCODING = "json"
+BINARY_ENCODING = "binary"
+ENCODINGS = (BINARY_ENCODING, JSON_ENCODING)
+
+_HAS_PAYLOAD = 0x01
+_HAS_REQUEST_ID = 0x02
+_JSON_FIRST_BYTE = ord("{")
+
+# L'ordre fixe le numéro de type de chaque payload: n'ajouter qu'à la fin.
+_SCHEMAS = (
+    gloutils.ErrorPayload,
+    gloutils.AuthPayload,
+    gloutils.EmailContentPayload,
+    gloutils.InboxRequestPayload,
+    gloutils.EmailBatchPayload,
+    gloutils.EmailResultPayload,
+    gloutils.EmailBatchResultPayload,
+    gloutils.EmailListPayload,
+    gloutils.EmailChoicePayload,
+    gloutils.StatsPayload,
+    gloutils.CapabilitiesPayload,
+    gloutils.EmailStreamPayload,
+    gloutils.EmailChunkPayload,
+    gloutils.SearchPayload,
+    gloutils.LoginPayload,
+    gloutils.SessionPayload,
+    gloutils.MetricsPayload,
+)
+
+# Erreurs levées en encodant une valeur qui ne correspond pas au gabarit
+_UNFIT = (AttributeError, TypeError, ValueError, OverflowError, struct.error)
+
+_FRAME_HEAD = struct.Struct("!BB")
+_SIGNED_FORMATS = ((-2**7, 2**7, "b"), (-2**15, 2**15, "h"),
+                   (-2**31, 2**31, "i"), (-2**63, 2**63, "q"))
+_UNSIGNED_FORMATS = ((2**8, "B"), (2**16, "H"), (2**32, "I"))
+_FORMAT_SIZES = {code: struct.calcsize(code) for code in "bhiqBHI"}
+_SCALARS = {code: (code.encode("ascii"), struct.Struct("!" + code))
+            for code in "bhiqBHI"}
+
+
+def _int_code(value: int) -> str:
+    """Retourne le plus petit format struct capable de contenir `value`."""
+    if value >= 0:
+        return "B" if value < 2**8 else "H" if value < 2**16 else "I" if value < 2**32 else "q"
+    return "b" if value >= -2**7 else "h" if value >= -2**15 else "i" if value >= -2**31 else "q"
+
+
+def _pack_ints(values: list[int], parts: list) -> None:
+    """Ajoute à `parts` le tableau d'entiers `values` (dont la taille est connue)."""
+    if bool in set(map(type, values)):
+        raise TypeError("bool is not an integer field")
+    code = "b"
+    if values:
+        low, high = min(values), max(values)
+        if low >= 0:
+            code = next((code for limit, code in _UNSIGNED_FORMATS if high < limit), "q")
+        else:
+            code = next(code for lower, upper, code in _SIGNED_FORMATS
+                        if low >= lower and high < upper)
+    parts.append(code.encode("ascii"))
+    parts.append(struct.pack(f"!{len(values)}{code}", *values))
+
+
+def _unpack_ints(data: memoryview, position: int, count: int
+                 ) -> tuple[list[int], int]:
+    """Lit un tableau de `count` entiers écrit par `_pack_ints`."""
+    code = chr(data[position])
+    values = list(struct.unpack_from(f"!{count}{code}", data, position + 1))
+    return values, position + 1 + count * _FORMAT_SIZES[code]
+
+
+class _Field:
+    """
+    Encodeur d'un type de champ.
+
+    `encode_many` ajoute à une liste de morceaux les valeurs d'une colonne
+    (leur nombre est écrit par l'appelant) et `decode_many` retourne les
+    `count` valeurs lues à une position avec la position suivante. Une
+    valeur qui ne correspond pas au type lève une des erreurs `_UNFIT`.
+    """
+
+    def encode_many(self, values: list, parts: list) -> None:
+        raise NotImplementedError
+
+    def decode_many(self, data: memoryview, position: int, count: int
+                    ) -> tuple[list, int]:
+        raise NotImplementedError
+
+    def encode(self, value: Any, parts: list) -> None:
+        self.encode_many([value], parts)
+
+    def decode(self, data: memoryview, position: int) -> tuple[Any, int]:
+        values, position = self.decode_many(data, position, 1)
+        return values[0], position
+
+
+class _IntField(_Field):
+    """Entier (dont les `IntEnum` comme `Headers`)."""
+
+    def encode(self, value: Any, parts: list) -> None:
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise TypeError("expected int")
+        prefix, packer = _SCALARS[_int_code(value)]
+        parts.append(prefix)
+        parts.append(packer.pack(value))
+
+    def decode(self, data: memoryview, position: int) -> tuple[Any, int]:
+        packer = _SCALARS[chr(data[position])][1]
+        return packer.unpack_from(data, position + 1)[0], position + 1 + packer.size
+
+    def encode_many(self, values: list, parts: list) -> None:
+        _pack_ints(values, parts)
+
+    def decode_many(self, data: memoryview, position: int, count: int
+                    ) -> tuple[list, int]:
+        return _unpack_ints(data, position, count)
+
+
+class _StrField(_Field):
+    """Chaîne UTF-8."""
+
+    def encode(self, value: Any, parts: list) -> None:
+        if not isinstance(value, str):
+            raise TypeError("expected str")
+        data = value.encode("utf-8")
+        _INT_FIELD.encode(len(data), parts)
+        parts.append(data)
+
+    def decode(self, data: memoryview, position: int) -> tuple[Any, int]:
+        length, position = _INT_FIELD.decode(data, position)
+        end = position + length
+        if end > len(data):
+            raise ValueError("truncated string")
+        return str(data[position:end], "utf-8"), end
+
+    def encode_many(self, values: list, parts: list) -> None:
+        # Une valeur autre qu'une chaîne lève AttributeError
+        encoded = [value.encode("utf-8") for value in values]
+        _pack_ints([len(data) for data in encoded], parts)
+        parts.extend(encoded)
+
+    def decode_many(self, data: memoryview, position: int, count: int
+                    ) -> tuple[list, int]:
+        lengths, position = _unpack_ints(data, position, count)
+        end = position + sum(lengths)
+        if end > len(data):
+            raise ValueError("truncated string")
+        chunk = data[position:end]
+        text = str(chunk, "utf-8")
+        # En ASCII, les positions en octets et en caractères coïncident
+        source = text if len(text) == len(chunk) else chunk
+        offsets = list(itertools.accumulate(lengths, initial=0))
+        if source is text:
+            values = [text[offsets[i]:offsets[i + 1]] for i in range(count)]
+        else:
+            values = [str(chunk[offsets[i]:offsets[i + 1]], "utf-8")
+                      for i in range(count)]
+        return values, end
+
+
+class _ListField(_Field):
+    """Liste d'éléments d'un même type, écrite par colonne."""
+
+    def __init__(self, item: _Field) -> None:
+        self.item = item
+
+    def encode(self, value: Any, parts: list) -> None:
+        if not isinstance(value, list):
+            raise TypeError("expected list")
+        _INT_FIELD.encode(len(value), parts)
+        self.item.encode_many(value, parts)
+
+    def decode(self, data: memoryview, position: int) -> tuple[Any, int]:
+        count, position = _INT_FIELD.decode(data, position)
+        return self.item.decode_many(data, position, count)
+
+    def encode_many(self, values: list, parts: list) -> None:
+        if not all(isinstance(value, list) for value in values):
+            raise TypeError("expected list")
+        _pack_ints([len(value) for value in values], parts)
+        self.item.encode_many([element for value in values for element in value], parts)
+
+    def decode_many(self, data: memoryview, position: int, count: int
+                    ) -> tuple[list, int]:
+        lengths, position = _unpack_ints(data, position, count)
+        elements, position = self.item.decode_many(data, position, sum(lengths))
+        values = []
+        start = 0
+        for length in lengths:
+            values.append(elements[start:start + length])
+            start += length
+        return values, position
+
+
+class _Schema(_Field):
+    """Payload TypedDict de gloutils, écrit par colonne."""
+
+    def __init__(self, payload_type: type) -> None:
+        self.keys: list[str] = []
+        self.fields: list[_Field] = []
+        for key, annotation in typing.get_type_hints(payload_type).items():
+            self.keys.append(key)
+            self.fields.append(_field_for(annotation))
+        self.required = frozenset(payload_type.__required_keys__)
+        self.all_keys = frozenset(self.keys)
+
+    def accepts_keys(self, keys) -> bool:
+        """Indique si un payload ayant ces clés peut suivre ce gabarit."""
+        return self.required <= keys <= self.all_keys
+
+    def encode(self, value: Any, parts: list) -> None:
+        if not isinstance(value, dict) or not self.accepts_keys(value.keys()):
+            raise TypeError("payload does not match schema")
+        mask = 0
+        body: list = []
+        for bit, (key, field) in enumerate(zip(self.keys, self.fields)):
+            if key in value:
+                mask |= 1 << bit
+                field.encode(value[key], body)
+        _INT_FIELD.encode(mask, parts)
+        parts.extend(body)
+
+    def decode(self, data: memoryview, position: int) -> tuple[Any, int]:
+        mask, position = _INT_FIELD.decode(data, position)
+        value = {}
+        for bit, (key, field) in enumerate(zip(self.keys, self.fields)):
+            if mask >> bit & 1:
+                value[key], position = field.decode(data, position)
+        return value, position
+
+    def encode_many(self, values: list, parts: list) -> None:
+        # dict.keys lève TypeError sur une valeur autre qu'un dictionnaire
+        if not all(map(self.accepts_keys, map(dict.keys, values))):
+            raise TypeError("payload does not match schema")
+        masks = [0] * len(values)
+        columns = []
+        for bit, (key, field) in enumerate(zip(self.keys, self.fields)):
+            present = [key in value for value in values]
+            if not any(present):
+                continue
+            masks = [mask | (has_key << bit) for mask, has_key in zip(masks, present)]
+            columns.append((field, [value[key] for value in values if key in value]))
+        _pack_ints(masks, parts)
+        for field, column in columns:
+            field.encode_many(column, parts)
+
+    def decode_many(self, data: memoryview, position: int, count: int
+                    ) -> tuple[list, int]:
+        masks, position = _unpack_ints(data, position, count)
+        values: list[dict] = [{} for _ in range(count)]
+        for bit, (key, field) in enumerate(zip(self.keys, self.fields)):
+            owners = [value for value, mask in zip(values, masks) if mask >> bit & 1]
+            if not owners:
+                continue
+            column, position = field.decode_many(data, position, len(owners))
+            for value, element in zip(owners, column):
+                value[key] = element
+        return values, position
+
+
+def _field_for(annotation: Any) -> _Field:
+    """Retourne l'encodeur correspondant à l'annotation d'un champ."""
+    if annotation is str:
+        return _StrField()
+    if isinstance(annotation, type) and issubclass(annotation, int):
+        return _IntField()
+    if typing.get_origin(annotation) is list:
+        item, = typing.get_args(annotation)
+        return _ListField(_field_for(item))
+    if typing.is_typeddict(annotation):
+        return _Schema(annotation)
+    raise TypeError(f"Type de champ non supporté: {annotation!r}")
+
+
+_SCHEMA_BY_KIND = {kind: _Schema(payload_type)
+                   for kind, payload_type in enumerate(_SCHEMAS, start=1)}
+_INT_FIELD = _IntField()
+# Types de payload candidats selon les clés présentes, calculés au besoin
+_CANDIDATES: dict[frozenset, list[tuple[int, _Schema]]] = {}
+
+
+def _candidates(keys: frozenset) -> list[tuple[int, _Schema]]:
+    """Retourne les gabarits dont les clés admettent celles d'un payload."""
+    if keys not in _CANDIDATES:
+        _CANDIDATES[keys] = [(kind, schema) for kind, schema in _SCHEMA_BY_KIND.items()
+                             if schema.accepts_keys(keys)]
+    return _CANDIDATES[keys]
+
+
+def _encode_binary(message: gloutils.GloMessage) -> Optional[bytes]:
+    """Encode `message` en binaire, ou retourne None s'il ne s'y prête pas."""
+    header = message.get("header")
+    if (not isinstance(header, int) or isinstance(header, bool)
+            or not 0 < header < _JSON_FIRST_BYTE):
+        return None
+    if not message.keys() <= {"header", "payload", "request_id"}:
+        return None
+    flags = 0
+    parts: list = []
+    try:
+        if "request_id" in message:
+            flags |= _HAS_REQUEST_ID
+            _INT_FIELD.encode(message["request_id"], parts)
+    except _UNFIT:
+        return None
+    if "payload" in message:
+        payload = message["payload"]
+        if not isinstance(payload, dict):
+            return None
+        for kind, schema in _candidates(frozenset(payload)):
+            payload_parts = [bytes((kind,))]
+            try:
+                schema.encode(payload, payload_parts)
+            except _UNFIT:
+                continue
+            flags |= _HAS_PAYLOAD
+            parts.extend(payload_parts)
+            break
+        else:
+            return None
+    parts.insert(0, _FRAME_HEAD.pack(header, flags))
+    return b"".join(parts)
+
+
+def _decode_binary(data: memoryview) -> gloutils.GloMessage:
+    """Décode une trame binaire."""
+    header, flags = _FRAME_HEAD.unpack_from(data, 0)
+    position = 2
+    message = gloutils.GloMessage(header=header)
+    if flags & _HAS_REQUEST_ID:
+        message["request_id"], position = _INT_FIELD.decode(data, position)
+    if flags & _HAS_PAYLOAD:
+        schema = _SCHEMA_BY_KIND[data[position]]
+        message["payload"], position = schema.decode(data, position + 1)
+    if position != len(data):
+        raise ValueError("trailing data")
+    return message
+
+
+def encode(message: gloutils.GloMessage, encoding: str = JSON_ENCODING) -> bytes:
+    """
+    Encode `message` pour une trame glosocket selon `encoding`.
+
+    Un message qui ne correspond à aucun gabarit est encodé en JSON.
+    """
+    if encoding == BINARY_ENCODING:
+        data = _encode_binary(message)
+        if data is not None:
+            return data
+    return json.dumps(message).encode("utf-8")
+
+
+def decode(data: bytes) -> gloutils.GloMessage:
+    """
+    Décode une trame glosocket, quel que soit son encodage.
+
+    Lève une exception GLOSocketError si la trame est invalide.
+    """
+    try:
+        if data[:1] == b"{":
+            message = json.loads(data)
+            if not isinstance(message, dict):
+                raise ValueError("not a message")
+            return message
+        return _decode_binary(memoryview(data))
+    except (ValueError, KeyError, IndexError, struct.error) as ex:
+        raise glosocket.GLOSocketError("The received frame is invalid") from ex
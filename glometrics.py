@@ -0,0 +1,209 @@
+"""\
+Module fournissant les métriques du serveur mail @glo2000.ca.
+
+`Metrics` compte les requêtes traitées et leurs latences par entête, les
+octets reçus et transmis, les connexions et la durée des opérations du
+stockage (`TimedCalls`). Les latences sont rangées dans des histogrammes à
+bornes fixes (`Histogram`): une mesure ne coûte qu'une recherche
+dichotomique et quelques additions, sous un verrou rarement disputé.
+
+`Metrics.render` produit le format texte de Prometheus, transmis par
+l'entête `METRICS` ou servi en HTTP par `serve` (`GET /metrics`).
+"""
+import bisect
+import http.server
+import threading
+import time
+from typing import Any, Callable
+
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                  0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Histogramme cumulable: `counts[i]` compte les valeurs d'au plus
+    `bounds[i]` (et supérieures à la borne précédente), la dernière case les
+    valeurs au-delà de la dernière borne.
+    """
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BOUNDS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Ajoute une valeur à l'histogramme."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.bounds)
+        histogram.counts = list(self.counts)
+        histogram.total = self.total
+        histogram.count = self.count
+        return histogram
+
+
+class Metrics:
+    """Métriques d'un processus serveur, mises à jour depuis n'importe quel fil."""
+
+    def __init__(self) -> None:
+        """
+        Prépare les attributs suivants:
+        - `_requests` l'histogramme des latences de chaque entête.
+        - `_errors` le nombre de réponses `ERROR` de chaque entête.
+        - `_disk` l'histogramme des durées de chaque opération du stockage.
+        - `_counters` les compteurs d'octets et de connexions.
+        - `_gauges` les valeurs lues au moment du rendu (voir `gauge`).
+        """
+        self._lock = threading.Lock()
+        self._requests: dict[str, Histogram] = {}
+        self._errors: dict[str, int] = {}
+        self._disk: dict[str, Histogram] = {}
+        self._counters = {"received_bytes": 0, "sent_bytes": 0,
+                          "connections_opened": 0, "connections_closed": 0}
+        self._gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+        self._started = time.time()
+
+    def observe_request(self, header: str, seconds: float, error: bool = False) -> None:
+        """Enregistre une requête traitée, sa latence et si elle a échoué."""
+        with self._lock:
+            histogram = self._requests.get(header)
+            if histogram is None:
+                histogram = self._requests[header] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                self._errors[header] = self._errors.get(header, 0) + 1
+
+    def observe_disk(self, operation: str, seconds: float) -> None:
+        """Enregistre la durée d'une opération du stockage."""
+        with self._lock:
+            histogram = self._disk.get(operation)
+            if histogram is None:
+                histogram = self._disk[operation] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        """Augmente un compteur (`received_bytes`, `sent_bytes`, `connections_*`)."""
+        with self._lock:
+            self._counters[counter] += amount
+
+    def gauge(self, name: str, description: str, read: Callable[[], float]) -> None:
+        """Ajoute une valeur instantanée, lue par `read` au moment du rendu."""
+        self._gauges[name] = (description, read)
+
+    def render(self) -> str:
+        """Retourne les métriques au format texte de Prometheus."""
+        with self._lock:
+            requests = {name: histogram.copy() for name, histogram in self._requests.items()}
+            errors = dict(self._errors)
+            disk = {name: histogram.copy() for name, histogram in self._disk.items()}
+            counters = dict(self._counters)
+        lines: list[str] = []
+        _histograms(lines, "glo_request_seconds", "Latence de traitement des requêtes.",
+                    "header", requests)
+        _family(lines, "glo_request_errors_total", "counter",
+                "Réponses ERROR par entête.",
+                [(f'{{header="{name}"}}', errors.get(name, 0)) for name in requests])
+        _family(lines, "glo_received_bytes_total", "counter",
+                "Octets reçus des clients.", [("", counters["received_bytes"])])
+        _family(lines, "glo_sent_bytes_total", "counter",
+                "Octets transmis aux clients.", [("", counters["sent_bytes"])])
+        _family(lines, "glo_connections_total", "counter",
+                "Connexions acceptées.", [("", counters["connections_opened"])])
+        _family(lines, "glo_connections", "gauge", "Connexions ouvertes.",
+                [("", counters["connections_opened"] - counters["connections_closed"])])
+        for name, (description, read) in self._gauges.items():
+            _family(lines, name, "gauge", description, [("", read())])
+        _histograms(lines, "glo_storage_seconds", "Durée des opérations du stockage.",
+                    "operation", disk)
+        _family(lines, "glo_start_time_seconds", "gauge",
+                "Démarrage du serveur (secondes depuis l'époque Unix).",
+                [("", self._started)])
+        return "\n".join(lines) + "\n"
+
+
+def _family(lines: list[str], name: str, kind: str, description: str,
+            samples: list[tuple[str, float]]) -> None:
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {kind}")
+    lines.extend(f"{name}{labels} {_number(value)}" for labels, value in samples)
+
+
+def _histograms(lines: list[str], name: str, description: str, label: str,
+                histograms: dict[str, Histogram]) -> None:
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + (None,), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound is None else _number(bound)
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {_number(histogram.total)}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+
+
+def _number(value: float) -> str:
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class TimedCalls:
+    """
+    Mandataire de l'objet `target` qui mesure la durée de chacun des appels
+    de ses méthodes publiques et la transmet à `observe(nom, secondes)`.
+    Les autres attributs sont ceux de `target`.
+    """
+
+    def __init__(self, target: Any, observe: Callable[[str, float], None]) -> None:
+        self._target = target
+        self._observe = observe
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._target, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        observe = self._observe
+
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+
+        # Les méthodes suivantes ne passent plus par __getattr__
+        self.__dict__[name] = timed
+        return timed
+
+
+def serve(metrics: Metrics, port: int,
+          host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """
+    Sert les métriques en texte (`GET /metrics`) sur `host`:`port`, dans un
+    fil dédié, et retourne le serveur HTTP.
+
+    Lève une exception OSError si le port ne peut être ouvert.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
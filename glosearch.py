@@ -0,0 +1,143 @@
+"""\
+Module fournissant la recherche plein texte dans les boîtes du serveur mail
+@glo2000.ca.
+
+Chaque courriel est réduit à l'ensemble de ses termes (`email_terms`): les
+mots, en minuscules, de son expéditeur, de son sujet et de son corps, ainsi
+que les mots de l'expéditeur et du sujet préfixés par leur champ (`from:`,
+`subject:`). Une requête (`parse_query`) est une suite de mots, chacun
+éventuellement restreint à un champ par le même préfixe; un courriel
+correspond s'il contient tous les termes de la requête, limités à
+`MAX_QUERY_TERMS`. Les mots de plus de `MAX_WORD_SIZE` caractères
+(encodages, identifiants) ne sont pas indexés.
+
+`SearchIndex` est l'index inversé d'une boîte: pour chaque terme, la liste
+triée des identifiants des courriels qui le contiennent. Une recherche ne
+parcourt que la plus courte des listes des termes demandés, sans jamais
+parcourir la boîte. Les moteurs de glostorage le tiennent à jour à chaque
+livraison et savent le reconstruire à partir des courriels.
+"""
+import bisect
+import re
+from typing import Iterable, Optional
+
+FIELD_PREFIXES = {"from": "sender", "subject": "subject"}
+MAX_WORD_SIZE = 100
+MAX_QUERY_TERMS = 32
+
+_WORD = re.compile(r"\b\w{1,%d}\b" % MAX_WORD_SIZE)
+_WORD_CHARS = re.compile(r"\w*")
+
+
+def tokens(text: Optional[str]) -> set[str]:
+    """Retourne les mots, en minuscules, du texte `text`."""
+    if not isinstance(text, str):
+        return set()
+    return set(_WORD.findall(text.casefold()))
+
+
+def email_terms(email: dict, body_terms: Iterable[str] = ()) -> set[str]:
+    """
+    Retourne les termes du courriel `email`. `body_terms` complète les mots
+    du corps lorsque celui-ci a été reçu par morceaux (voir `TermCollector`).
+    """
+    terms = tokens(email.get("content"))
+    terms.update(body_terms)
+    for prefix, field in FIELD_PREFIXES.items():
+        words = tokens(email.get(field))
+        terms.update(words)
+        terms.update(f"{prefix}:{word}" for word in words)
+    return terms
+
+
+def parse_query(query: str) -> list[str]:
+    """
+    Retourne les termes de la requête `query`, par exemple
+    `from:alice subject:réunion budget`.
+    """
+    terms = []
+    for word in query.split():
+        prefix, _, rest = word.partition(":")
+        if rest and prefix.casefold() in FIELD_PREFIXES:
+            terms.extend(f"{prefix.casefold()}:{token}" for token in sorted(tokens(rest)))
+        else:
+            terms.extend(sorted(tokens(word)))
+    return list(dict.fromkeys(terms))
+
+
+class TermCollector:
+    """
+    Collecte les mots d'un texte reçu par morceaux: un mot coupé entre deux
+    morceaux est retenu jusqu'au morceau suivant. Un mot trop long pour être
+    indexé n'est retenu que sur `MAX_WORD_SIZE + 1` caractères, assez pour
+    l'écarter jusqu'au bout.
+    """
+
+    def __init__(self) -> None:
+        self.terms: set[str] = set()
+        self._partial = ""
+
+    def feed(self, text: str) -> None:
+        """Ajoute un morceau du texte."""
+        text = self._partial + text.casefold()
+        # Début du dernier mot, cherché dans le texte renversé
+        end = len(text) - _WORD_CHARS.match(text[::-1]).end()
+        self._partial = text[end:end + MAX_WORD_SIZE + 1]
+        self.terms.update(_WORD.findall(text, 0, end))
+
+    def finish(self) -> set[str]:
+        """Termine le texte et retourne tous ses mots."""
+        if self._partial and len(self._partial) <= MAX_WORD_SIZE:
+            self.terms.add(self._partial)
+            self._partial = ""
+        return self.terms
+
+
+class SearchIndex:
+    """
+    Index inversé d'une boîte: `postings` associe chaque terme à la liste
+    triée des identifiants des courriels qui le contiennent. `max_id` est le
+    plus grand identifiant indexé.
+    """
+
+    def __init__(self) -> None:
+        self.postings: dict[str, list[int]] = {}
+        self.max_id = 0
+
+    def add(self, email_id: int, terms: Iterable[str]) -> None:
+        """
+        Indexe le courriel `email_id`. Les identifiants arrivent presque
+        toujours en ordre croissant et sont alors simplement ajoutés à la
+        fin des listes.
+        """
+        for term in terms:
+            postings = self.postings.setdefault(term, [])
+            if not postings or email_id > postings[-1]:
+                postings.append(email_id)
+            elif not _contains(postings, email_id):
+                bisect.insort(postings, email_id)
+        self.max_id = max(self.max_id, email_id)
+
+    def search(self, terms: list[str], limit: int) -> tuple[list[int], int]:
+        """
+        Retourne les identifiants d'au plus `limit` courriels contenant tous
+        les `terms`, du plus récent au plus ancien (par identifiant), et le
+        nombre total de courriels correspondants.
+
+        La plus courte liste est parcourue et chacun de ses identifiants est
+        cherché par dichotomie dans les autres: le coût dépend du terme le
+        plus rare, pas de la taille de la boîte.
+        """
+        if not terms:
+            return [], 0
+        lists = sorted((self.postings.get(term, []) for term in terms), key=len)
+        shortest, others = lists[0], lists[1:]
+        matches = [email_id for email_id in reversed(shortest)
+                   if all(_contains(postings, email_id) for postings in others)]
+        return matches[:limit], len(matches)
+
+
+def _contains(postings: list[int], email_id: int) -> bool:
+    """Indique si la liste triée `postings` contient `email_id`."""
+    position = bisect.bisect_left(postings, email_id)
+    return position < len(postings) and postings[position] == email_id
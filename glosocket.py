@@ -1,9 +1,21 @@
 """\
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
+
+Chaque message est précédé de sa taille sur 4 octets. Le bit de poids fort
+de la taille indique un message compressé avec zlib: les fonctions d'envoi
+compressent les messages d'au moins `compress_threshold` octets si cela les
+raccourcit, et la réception les décompresse toujours.
+
+Les fonctions de réception acceptent une taille maximale `max_size`: un
+message plus grand (avant ou après décompression) est refusé avant d'être
+mis en mémoire.
 """
+import asyncio
 import socket
 import struct
+import zlib
+from typing import Optional
 
 
 class GLOSocketError(Exception):
@@ -13,45 +25,201 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+_MIN_CHUNK_SIZE = 64 * 1024
+_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+_SMALL_MESSAGE_SIZE = 64 * 1024
+# Algorithmes de compression pris en charge, pour la négociation
+COMPRESSIONS = ("zlib",)
+_COMPRESSED_FLAG = 0x80000000
+_MAX_LENGTH = 0x7FFFFFFF
+
+
+def _recvall(source: socket.socket, size: int) -> bytearray:
     """
     Fonction utilitaire pour recv_mesg.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Applique socket.recv_into en boucle jusqu'à la réception d'un message
+    de la taille voulue, directement dans un tampon préalloué. La taille
+    des lectures double tant que le socket remplit les lectures demandées.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    msg = bytearray(size)
+    view = memoryview(msg)
+    position = 0
+    chunk_size = _MIN_CHUNK_SIZE
+    while position < size:
+        wanted = min(size - position, chunk_size)
         try:
-            buffer = source.recv(chunk_size)
+            received = source.recv_into(view[position:], wanted)
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if not received:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
+        position += received
+        if received == wanted:
+            chunk_size = min(chunk_size * 2, _MAX_CHUNK_SIZE)
     return msg
 
 
-def snd_mesg(dest_soc: socket.socket, message: str) -> None:
+def _frame_parts(data: bytes, compress_threshold: Optional[int]) -> list[bytes]:
     """
-    Encode le message puis le transmet à la destination.
+    Retourne l'entête de taille et le corps d'un message, compressé si
+    `compress_threshold` est fourni, atteint et que la compression est utile.
+    """
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return [struct.pack("!I", len(compressed) | _COMPRESSED_FLAG), compressed]
+    if len(data) > _MAX_LENGTH:
+        raise GLOSocketError("The message is too large to be sent")
+    return [struct.pack("!I", len(data)), data]
+
+
+def _split_length(length: int, max_size: Optional[int]) -> tuple[int, bool]:
+    """
+    Sépare la taille reçue de l'indicateur de compression.
+
+    Lève une exception GLOSocketError si la taille dépasse `max_size`.
+    """
+    size = length & _MAX_LENGTH
+    if max_size is not None and size > max_size:
+        raise GLOSocketError(f"The message exceeds {max_size} bytes")
+    return size, bool(length & _COMPRESSED_FLAG)
+
+
+def _decompress(data: bytes, max_size: Optional[int]) -> bytes:
+    """
+    Décompresse un message reçu.
+
+    Lève une exception GLOSocketError si les données sont invalides ou si
+    le message décompressé dépasse `max_size` (ou la taille maximale d'un
+    message).
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        message = decompressor.decompress(data, max_size or _MAX_LENGTH)
+    except zlib.error as ex:
+        raise GLOSocketError("The received data could not be decompressed") from ex
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise GLOSocketError("The received data could not be decompressed")
+    return message
+
+
+def encode_frame(data: bytes, compress_threshold: Optional[int] = None) -> bytes:
+    """
+    Préfixe les octets de leur taille, prêts à être transmis, en les
+    compressant s'ils atteignent `compress_threshold` octets.
+    """
+    return b"".join(_frame_parts(data, compress_threshold))
+
+
+def encode_mesg(message: str) -> bytes:
+    """Encode le message et le préfixe de sa taille, prêt à être transmis."""
+    return encode_frame(message.encode(encoding='utf-8'))
+
+
+class FrameBuffer:
+    """
+    Tampon de réception pour les sockets non bloquants.
+
+    Accumule les octets reçus, qui peuvent contenir une partie d'entête,
+    une partie de message ou plusieurs messages, et n'en extrait que les
+    messages complets (décompressés, mais sans les décoder).
+
+    Un message annoncé plus grand que `max_size` est refusé dès la
+    réception de sa taille.
+    """
+
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self._buffer = bytearray()
+        self._max_size = max_size
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """
+        Ajoute les octets reçus au tampon et retourne la liste (possiblement
+        vide) des messages complets.
+
+        Lève une exception GLOSocketError si un message compressé est invalide
+        ou si un message dépasse la taille maximale.
+        """
+        self._buffer += data
+        frames = []
+        position = 0
+        while len(self._buffer) - position >= 4:
+            length, compressed = _split_length(
+                struct.unpack_from("!I", self._buffer, position)[0], self._max_size)
+            if len(self._buffer) - position - 4 < length:
+                break
+            start = position + 4
+            frame = bytes(self._buffer[start:start + length])
+            frames.append(_decompress(frame, self._max_size) if compressed else frame)
+            position = start + length
+        if position:
+            del self._buffer[:position]
+        return frames
+
+
+class MessageBuffer(FrameBuffer):
+    """Tampon de réception retournant les messages décodés en UTF-8."""
+
+    def feed(self, data: bytes) -> list[str]:
+        """
+        Ajoute les octets reçus au tampon et retourne la liste (possiblement
+        vide) des messages complets décodés.
+
+        Lève une exception GLOSocketError si un message n'est pas de l'UTF-8.
+        """
+        try:
+            return [frame.decode('utf-8') for frame in super().feed(data)]
+        except UnicodeDecodeError as ex:
+            raise GLOSocketError("The received data was not UTF-8") from ex
+
+
+def _sendall_parts(dest_soc: socket.socket, parts: list[bytes]) -> None:
+    """
+    Transmet les parties à la suite sans les concaténer, en un seul appel
+    système (socket.sendmsg) lorsque c'est possible.
+    """
+    if not hasattr(dest_soc, "sendmsg"):
+        # Pas de sendmsg (Windows): concaténer reste moins coûteux pour les
+        # petits messages qu'un envoi séparé de l'entête.
+        if sum(len(part) for part in parts) <= _SMALL_MESSAGE_SIZE:
+            dest_soc.sendall(b"".join(parts))
+        else:
+            for part in parts:
+                dest_soc.sendall(part)
+        return
+
+    buffers = [memoryview(part) for part in parts if part]
+    while buffers:
+        sent = dest_soc.sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def snd_frame(dest_soc: socket.socket, data: bytes,
+              compress_threshold: Optional[int] = None) -> None:
+    """
+    Transmet les octets à la destination, préfixés de leur taille et
+    compressés s'ils atteignent `compress_threshold` octets.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    parts = _frame_parts(data, compress_threshold)
     try:
-        dest_soc.sendall(data_length + data)
+        _sendall_parts(dest_soc, parts)
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
-def recv_mesg(source_soc: socket.socket) -> str:
+def recv_frame(source_soc: socket.socket, max_size: Optional[int] = None) -> bytes:
     """
-    Récupère un message de la source et le décode.
+    Récupère un message de la source et le décompresse au besoin, sans le
+    décoder. Un message plus grand que `max_size` est refusé.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
@@ -63,5 +231,87 @@ def recv_mesg(source_soc: socket.socket) -> str:
         raise GLOSocketError("The received data was"
                              " not the message's length") from ex
 
+    length, compressed = _split_length(length, max_size)
     data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+    return _decompress(data, max_size) if compressed else data
+
+
+def snd_mesg(dest_soc: socket.socket, message: str) -> None:
+    """
+    Encode le message puis le transmet à la destination.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    snd_frame(dest_soc, message.encode(encoding='utf-8'))
+
+
+def recv_mesg(source_soc: socket.socket) -> str:
+    """
+    Récupère un message de la source et le décode.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    return recv_frame(source_soc).decode('utf-8')
+
+
+async def snd_frame_async(writer: asyncio.StreamWriter, data: bytes,
+                          compress_threshold: Optional[int] = None) -> None:
+    """
+    Équivalent de snd_frame pour un StreamWriter asyncio: transmet les
+    octets et attend que le tampon d'envoi se vide.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    parts = _frame_parts(data, compress_threshold)
+    try:
+        writer.writelines(parts)
+        await writer.drain()
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with stream") from ex
+
+
+async def recv_frame_async(reader: asyncio.StreamReader,
+                           max_size: Optional[int] = None) -> bytes:
+    """
+    Équivalent de recv_frame pour un StreamReader asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    try:
+        data_length = await reader.readexactly(4)
+        length, compressed = _split_length(struct.unpack("!I", data_length)[0], max_size)
+        data = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    except OSError as ex:
+        raise GLOSocketError("The source stream is closed.") from ex
+    return _decompress(data, max_size) if compressed else data
+
+
+async def snd_mesg_async(writer: asyncio.StreamWriter, message: str) -> None:
+    """
+    Équivalent de snd_mesg pour un StreamWriter asyncio: encode le message,
+    le transmet et attend que le tampon d'envoi se vide.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    await snd_frame_async(writer, message.encode(encoding='utf-8'))
+
+
+async def recv_mesg_async(reader: asyncio.StreamReader) -> str:
+    """
+    Équivalent de recv_mesg pour un StreamReader asyncio.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    data = await recv_frame_async(reader)
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError as ex:
+        raise GLOSocketError("The received data was not UTF-8") from ex
@@ -0,0 +1,1314 @@
+"""\
+Module fournissant les moteurs de stockage des comptes et des boîtes du
+serveur mail @glo2000.ca.
+
+- `FileStorage` conserve chaque courriel dans son propre fichier JSON
+  (`<id>.json`), comme à l'origine.
+- `SegmentStorage` ajoute les courriels de chaque boîte à la fin d'un
+  unique fichier segment, repérés par un index de positions, et les relit
+  par une projection mmap.
+- `SQLiteStorage` conserve les comptes et les courriels dans les tables
+  indexées d'une base SQLite.
+
+Les deux premiers partagent les comptes (un dossier par utilisateur et son
+fichier `pass`), l'index JSON-lines des boîtes, les compteurs et les verrous.
+Le moteur est choisi au démarrage du serveur (`STORAGES`); l'outil
+`migrate_storage.py` copie les boîtes d'un moteur à l'autre.
+
+`UserRegistry` garde en mémoire les comptes et les hachages des mots de
+passe d'un moteur, pour que l'acheminement et les connexions ne touchent
+pas le disque.
+
+Chaque moteur tient aussi l'index de recherche (voir glosearch) de chaque
+boîte à jour à la livraison, et le reconstruit à partir des courriels
+(`rebuild_search`, ou à la première recherche si son fichier est absent).
+"""
+import bisect
+import concurrent.futures
+import contextlib
+import functools
+import io
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows: un seul processus, pas de verrou inter-processus
+    fcntl = None
+
+import glosearch
+import gloutils
+
+
+class _InboxCache:
+    """
+    Vue en mémoire de l'index d'une boîte, triée chronologiquement.
+
+    `entries` est triée en ordre croissant de `(timestamp, id)`, le plus
+    récent étant à la fin. `position` est le nombre d'octets de l'index déjà
+    lus et `inode` identifie le fichier lu, pour détecter une reconstruction.
+    `last` est la dernière entrée lue, dans l'ordre de l'index.
+    """
+
+    def __init__(self, inode: int) -> None:
+        self.inode = inode
+        self.position = 0
+        self.entries: list[dict] = []
+        self.by_id: dict[int, dict] = {}
+        self.max_id = 0
+        self.last: Optional[dict] = None
+
+    @staticmethod
+    def sort_key(entry: dict) -> tuple[float, int]:
+        """Clé de tri chronologique d'une entrée d'index."""
+        return entry["timestamp"], entry["id"]
+
+    def add(self, entries: list[dict]) -> None:
+        """
+        Intègre de nouvelles entrées en conservant l'ordre. Les courriels
+        arrivent presque toujours dans l'ordre chronologique et sont alors
+        simplement ajoutés à la fin.
+        """
+        for entry in entries:
+            if entry["id"] in self.by_id:
+                continue
+            self.by_id[entry["id"]] = entry
+            self.max_id = max(self.max_id, entry["id"])
+            self.last = entry
+            if not self.entries or self.sort_key(entry) >= self.sort_key(self.entries[-1]):
+                self.entries.append(entry)
+            else:
+                bisect.insort(self.entries, entry, key=self.sort_key)
+
+    def newest(self, offset: int, limit: int) -> list[dict]:
+        """Retourne `limit` entrées à partir de la `offset`-ième plus récente."""
+        end = len(self.entries) - offset
+        if end <= 0:
+            return []
+        return self.entries[max(0, end - limit):end][::-1]
+
+    def rank(self, email_id: int) -> int:
+        """
+        Retourne le rang (0 = plus récent) du courriel `email_id`, ou -1 s'il
+        n'est pas dans la boîte.
+        """
+        entry = self.by_id.get(email_id)
+        if entry is None:
+            return -1
+        position = bisect.bisect_left(self.entries, self.sort_key(entry),
+                                      key=self.sort_key)
+        return len(self.entries) - 1 - position
+
+
+class _SearchCache(glosearch.SearchIndex):
+    """
+    Index de recherche d'une boîte lu depuis son fichier de termes (une
+    ligne JSON `{"id": ..., "terms": [...]}` par courriel, en ordre
+    d'ajout). `position` et `inode` ont le même rôle que pour `_InboxCache`
+    (`inode` est None tant que le fichier n'existe pas).
+    """
+
+    def __init__(self, inode: Optional[int]) -> None:
+        super().__init__()
+        self.inode = inode
+        self.position = 0
+
+
+def _read_lines(path: str, position: int, size: int) -> tuple[list[dict], int]:
+    """
+    Lit les lignes JSON ajoutées au fichier `path` entre `position` et
+    `size` et retourne leurs objets et la position après la dernière ligne
+    complète. Une ligne sans fin de ligne est en cours d'écriture: elle sera
+    lue plus tard. Une ligne illisible (tronquée par un arrêt brutal) est
+    ignorée.
+    """
+    with open(path, 'rb') as lines_file:
+        lines_file.seek(position)
+        data = lines_file.read(size - position)
+    data = data[:data.rfind(b"\n") + 1]
+    records = []
+    for line in data.splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records, position + len(data)
+
+
+def _content_last(payload: dict) -> dict:
+    """Retourne le courriel avec son corps en dernier, pour la lecture en flux."""
+    if "content" not in payload:
+        return payload
+    email = {key: value for key, value in payload.items() if key != "content"}
+    email["content"] = payload["content"]
+    return email
+
+
+def _fsync_path(path: str) -> None:
+    """Force l'écriture sur le disque d'un fichier déjà fermé ou d'un dossier (POSIX)."""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class _MappedEmail:
+    """
+    Courriel du segment vu comme un fichier binaire en lecture seule
+    (`read`, `seek`, `tell`): les octets sont copiés depuis la projection
+    mmap du segment seulement lorsqu'ils sont lus.
+    """
+
+    def __init__(self, mapping: mmap.mmap, start: int, size: int) -> None:
+        self._mapping = mapping
+        self._start = start
+        self._size = size
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self._size - self._position
+        if size < 0 or size > remaining:
+            size = remaining
+        start = self._start + self._position
+        self._position += size
+        return self._mapping[start:start + size]
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: self._size}[whence]
+        self._position = min(max(0, base + offset), self._size)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        # La projection est partagée entre les lectures: elle reste ouverte
+        self._size = self._position = 0
+
+    def __enter__(self) -> "_MappedEmail":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class Storage:
+    """
+    Stockage des comptes et des boîtes sous le dossier `root`.
+
+    Chaque utilisateur a un dossier contenant son fichier `pass`, les
+    compteurs de sa boîte (`stats`), l'index de ses courriels (une ligne
+    JSON par courriel, en ordre d'ajout) et, en mode `shared`, le fichier de
+    verrou partagé entre les processus. Les sous-classes définissent où sont
+    écrits et relus les courriels.
+
+    Les méthodes peuvent être appelées depuis plusieurs fils et lèvent une
+    exception OSError en cas d'erreur d'accès au disque.
+    """
+
+    index_filename = gloutils.INDEX_FILENAME
+
+    def __init__(self, root: str, shared: bool = False) -> None:
+        """
+        Si `shared` est vrai, d'autres processus utilisent le même dossier:
+        les boîtes sont verrouillées (fcntl.flock) pendant leurs
+        modifications et les compteurs sont relus sur le disque plutôt
+        qu'en mémoire.
+
+        Prépare les attributs suivants:
+        - `_inboxes` un dictionnaire associant chaque dossier
+            utilisateur à la vue triée de son index (`_InboxCache`).
+        - `_mailbox_stats` un dictionnaire associant chaque dossier
+            utilisateur à ses compteurs `count` et `size`.
+        - `_searches` un dictionnaire associant chaque dossier utilisateur
+            à son index de recherche (`_SearchCache`).
+        """
+        self.root = root
+        self._shared = shared
+        self._inboxes: dict[str, _InboxCache] = {}
+        self._searches: dict[str, _SearchCache] = {}
+        self._mailbox_stats: dict[str, gloutils.StatsPayload] = {}
+        self._held_locks: dict[str, list] = {}
+        self._thread_locks: dict[str, threading.RLock] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _folder(self, username: str) -> str:
+        """Retourne le dossier de l'utilisateur `username`."""
+        return os.path.join(self.root, username)
+
+    # Comptes
+
+    def usernames(self) -> list[str]:
+        """Retourne les noms des utilisateurs, en ordre alphabétique."""
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, name,
+                                                     gloutils.PASSWORD_FILENAME)))
+
+    def user_exists(self, username: str) -> bool:
+        """Indique si le compte `username` existe."""
+        return os.path.exists(self._folder(username))
+
+    def create_user(self, username: str, password_hash: str) -> bool:
+        """
+        Crée le compte `username` (de manière atomique entre les processus)
+        avec le hachage de son mot de passe et une boîte vide. Retourne faux
+        si le nom est déjà utilisé.
+        """
+        folder = self._folder(username)
+        try:
+            os.mkdir(folder)
+        except FileExistsError:
+            return False
+        with open(os.path.join(folder, gloutils.PASSWORD_FILENAME), 'w') as password_file:
+            password_file.write(password_hash)
+        with self._lock(folder):
+            self._mailbox_stats[folder] = gloutils.StatsPayload(count=0, size=0)
+            self._write_stats(folder)
+        return True
+
+    def password_hash(self, username: str) -> Optional[str]:
+        """Retourne le hachage enregistré du mot de passe, ou None si le compte n'existe pas."""
+        try:
+            with open(os.path.join(self._folder(username), gloutils.PASSWORD_FILENAME),
+                      'r') as password_file:
+                return password_file.read().strip()
+        except FileNotFoundError:
+            # Un dossier sans mot de passe (LOST, compte en création) n'est
+            # pas un compte, comme pour `usernames`
+            return None
+
+    def set_password_hash(self, username: str, password_hash: str) -> None:
+        """Remplace de manière atomique le hachage enregistré du mot de passe."""
+        password_path = os.path.join(self._folder(username), gloutils.PASSWORD_FILENAME)
+        temp_path = password_path + ".tmp"
+        with open(temp_path, 'w') as password_file:
+            password_file.write(password_hash)
+        os.replace(temp_path, password_path)
+
+    # Boîtes
+
+    def inbox_page(self, username: str, offset: int, limit: int,
+                   before_id: Optional[int] = None) -> tuple[list[dict], int, int]:
+        """
+        Retourne les entrées d'index d'une page de la boîte, du plus récent
+        au plus ancien, la position de la page et le total de la boîte.
+
+        La page commence à la `offset`-ième entrée la plus récente ou, si
+        `before_id` est donné, juste après ce courriel (position 0 s'il
+        n'est pas dans la boîte). Aucun fichier de courriel n'est ouvert.
+        """
+        folder = self._folder(username)
+        with self._lock(folder):
+            inbox = self._load_inbox(folder)
+            if before_id is not None:
+                offset = inbox.rank(before_id) + 1
+            return inbox.newest(offset, limit), offset, len(inbox.entries)
+
+    def open_email(self, username: str, email_id: int) -> Optional[BinaryIO]:
+        """
+        Ouvre en lecture binaire le document JSON du courriel `email_id`
+        (corps en dernier), ou retourne None s'il n'est pas dans la boîte.
+        """
+        raise NotImplementedError
+
+    def emails(self, username: str) -> Iterator[tuple[int, dict]]:
+        """Relit un à un les courriels de la boîte, par identifiant croissant."""
+        folder = self._folder(username)
+        with self._lock(folder):
+            email_ids = sorted(self._load_inbox(folder).by_id)
+        for email_id in email_ids:
+            email_file = self.open_email(username, email_id)
+            if email_file is None:
+                continue
+            with email_file:
+                email = json.load(email_file)
+            email.pop("id", None)
+            yield email_id, email
+
+    def stats(self, username: str) -> gloutils.StatsPayload:
+        """Retourne les compteurs (nombre et taille des courriels) de la boîte."""
+        folder = self._folder(username)
+        with self._lock(folder):
+            return gloutils.StatsPayload(**self._current_stats(folder))
+
+    def search(self, username: str, terms: list[str], limit: int) -> tuple[list[dict], int]:
+        """
+        Retourne les entrées d'index d'au plus `limit` courriels de la boîte
+        contenant tous les `terms` (voir `glosearch.parse_query`), du plus
+        récent au plus ancien, et le nombre de courriels correspondants.
+        """
+        folder = self._folder(username)
+        with self._lock(folder):
+            inbox = self._load_inbox(folder)
+            email_ids, total = self._load_search(username).search(terms, limit)
+            return [inbox.by_id[email_id] for email_id in email_ids
+                    if email_id in inbox.by_id], total
+
+    def rebuild_search(self, username: str) -> None:
+        """Reconstruit l'index de recherche de la boîte à partir de ses courriels."""
+        folder = self._folder(username)
+        with self._lock(folder):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._search_path(folder))
+            self._searches.pop(folder, None)
+            self._load_search(username)
+
+    def deliver(self, username: str, payloads: list[dict], sync: bool = False) -> None:
+        """
+        Livre des courriels complets dans la boîte sous un seul verrou: les
+        identifiants sont consécutifs, l'index ne reçoit qu'un ajout et les
+        compteurs ne sont enregistrés qu'une fois pour le lot.
+
+        Si `sync` est vrai, les courriels sont sur le disque (fsync) au
+        retour: le lot entier ne coûte qu'une synchronisation de l'index.
+        """
+        folder = self._folder(username)
+        with self._lock(folder):
+            email_id = self._load_inbox(folder).max_id + 1
+            self._store(folder, [(email_id + number, payload, None)
+                                 for number, payload in enumerate(payloads)], sync)
+
+    def deliver_many(self, deliveries: dict[str, list[dict]],
+                     sync: bool = False) -> dict[str, OSError]:
+        """
+        Livre des courriels dans plusieurs boîtes (voir `deliver`) et
+        retourne l'erreur de chaque boîte dont la livraison a échoué.
+        """
+        errors = {}
+        for username, payloads in deliveries.items():
+            try:
+                self.deliver(username, payloads, sync)
+            except OSError as e:
+                errors[username] = e
+        return errors
+
+    def deliver_file(self, username: str, payload: dict, path: str,
+                     sync: bool = False, body_terms: Iterable[str] = ()) -> None:
+        """
+        Livre le courriel d'entêtes `payload` dont le document JSON (corps
+        en dernier) a été écrit dans le fichier temporaire `path`. Le
+        fichier temporaire est consommé. Voir `deliver` pour `sync`.
+
+        `body_terms` sont les mots du corps pour l'index de recherche,
+        collectés pendant la réception (`glosearch.TermCollector`).
+        """
+        folder = self._folder(username)
+        with self._lock(folder):
+            email_id = self._load_inbox(folder).max_id + 1
+            self._store(folder, [(email_id, payload, path)], sync,
+                        {email_id: glosearch.email_terms(payload, body_terms)})
+
+    def import_emails(self, username: str, emails: Iterable[tuple[int, dict]]) -> int:
+        """
+        Ajoute des courriels en conservant leurs identifiants (migration
+        entre moteurs). Les courriels déjà présents sont ignorés. Retourne
+        le nombre de courriels ajoutés.
+        """
+        folder = self._folder(username)
+        with self._lock(folder):
+            known = self._load_inbox(folder).by_id
+            new = {email_id: email for email_id, email in emails if email_id not in known}
+            self._store(folder, [(email_id, email, None) for email_id, email in new.items()])
+            return len(new)
+
+    def load(self) -> None:
+        """
+        Charge les compteurs enregistrés de chaque boîte et les vérifie contre
+        son contenu. Les compteurs absents ou erronés sont corrigés.
+        """
+        for username in self.usernames():
+            folder = self._folder(username)
+            with self._lock(folder):
+                scanned = self._scan_stats(folder)
+                stored = self._read_stats(folder)
+                self._mailbox_stats[folder] = scanned
+                if stored != scanned:
+                    self._write_stats(folder)
+
+    # Écriture et relecture des courriels (propres à chaque moteur)
+
+    def _write_emails(self, folder: str, emails: list[tuple[int, dict, Optional[str]]],
+                      sync: bool) -> list[dict]:
+        """
+        Écrit les courriels `(id, courriel, fichier temporaire ou None)` de
+        la boîte `folder`, synchronisés sur le disque si `sync` est vrai, et
+        retourne leurs entrées d'index. Appelé sous le verrou de la boîte.
+        """
+        raise NotImplementedError
+
+    def _rebuild_index(self, folder: str) -> list[dict]:
+        """Reconstruit l'index de la boîte `folder` à partir de ses courriels."""
+        raise NotImplementedError
+
+    def _scan_stats(self, folder: str) -> gloutils.StatsPayload:
+        """Calcule les compteurs de la boîte `folder` à partir de son index."""
+        inbox = self._load_inbox(folder)
+        return gloutils.StatsPayload(count=len(inbox.entries),
+                                     size=sum(entry["size"] for entry in inbox.entries))
+
+    # Index
+
+    def _store(self, folder: str, emails: list[tuple[int, dict, Optional[str]]],
+               sync: bool = False, terms: Optional[dict[int, set[str]]] = None) -> None:
+        """
+        Écrit des courriels puis met à jour l'index, l'index de recherche
+        (termes de `terms` ou du courriel) et les compteurs de la boîte.
+
+        Si `sync` est vrai, les courriels, l'index et le dossier sont
+        synchronisés sur le disque; les compteurs, vérifiés au démarrage
+        (voir `load`), et l'index de recherche, complété au besoin à la
+        recherche suivante (voir `_load_search`), ne le sont pas.
+        """
+        if not emails:
+            return
+        with self._lock(folder):
+            entries = self._write_emails(folder, emails, sync)
+            stats = self._current_stats(folder)
+            stats["count"] += len(entries)
+            stats["size"] += sum(entry["size"] for entry in entries)
+            self._append_to_index(folder, entries, sync)
+            if os.path.exists(self._search_path(folder)):
+                terms = terms or {}
+                self._append_terms(folder, [
+                    (email_id, terms.get(email_id) or glosearch.email_terms(payload))
+                    for email_id, payload, _ in emails])
+            self._write_stats(folder)
+            if sync and os.name == "posix":
+                # Noms des nouveaux fichiers
+                _fsync_path(folder)
+
+    def _index_path(self, folder: str) -> str:
+        """Retourne le chemin du fichier d'index de la boîte `folder`."""
+        return os.path.join(folder, self.index_filename)
+
+    @staticmethod
+    def _index_entry(email_id: int, payload: dict, size: int, **location) -> dict:
+        """
+        Construit l'entrée d'index décrivant un courriel livré, avec
+        l'emplacement de son document (`location`).
+        """
+        return {
+            "id": email_id,
+            "sender": payload.get("sender"),
+            "subject": payload.get("subject"),
+            "date": payload.get("date"),
+            "timestamp": gloutils.get_timestamp(payload.get("date") or ""),
+            **location,
+            "size": size
+        }
+
+    def _append_to_index(self, folder: str, entries: list[dict], sync: bool = False) -> None:
+        """Ajoute des entrées à la fin de l'index (une ligne JSON par courriel)."""
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with open(self._index_path(folder), 'a', encoding='utf-8') as index_file:
+            index_file.write(lines)
+            if sync:
+                index_file.flush()
+                os.fsync(index_file.fileno())
+
+    def _write_index(self, folder: str, entries: list[dict]) -> None:
+        """Remplace l'index de la boîte de manière atomique."""
+        temp_path = self._index_path(folder) + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as index_file:
+            index_file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        os.replace(temp_path, self._index_path(folder))
+
+    def _load_inbox(self, folder: str) -> _InboxCache:
+        """
+        Retourne la vue triée de l'index de la boîte `folder`.
+
+        Seules les lignes ajoutées à l'index depuis le dernier appel sont lues.
+        Si l'index n'existe pas encore (boîte créée avant l'index), il est
+        reconstruit à partir des courriels.
+        """
+        index_path = self._index_path(folder)
+        try:
+            index_stat = os.stat(index_path)
+        except FileNotFoundError:
+            with self._lock(folder):
+                if not os.path.exists(index_path):
+                    self._rebuild_index(folder)
+            index_stat = os.stat(index_path)
+
+        inbox = self._inboxes.get(folder)
+        if (inbox is None or inbox.inode != index_stat.st_ino
+                or index_stat.st_size < inbox.position):
+            inbox = _InboxCache(index_stat.st_ino)
+            self._inboxes[folder] = inbox
+        if index_stat.st_size == inbox.position:
+            return inbox
+
+        entries, inbox.position = _read_lines(index_path, inbox.position,
+                                              index_stat.st_size)
+        for entry in entries:
+            if "timestamp" not in entry:
+                # Index écrit avant l'ajout des timestamps
+                entry["timestamp"] = gloutils.get_timestamp(entry.get("date") or "")
+        inbox.add(entries)
+        return inbox
+
+    # Index de recherche
+
+    @staticmethod
+    def _search_path(folder: str) -> str:
+        """Retourne le chemin du fichier de termes de la boîte `folder`."""
+        return os.path.join(folder, gloutils.SEARCH_INDEX_FILENAME)
+
+    def _append_terms(self, folder: str,
+                      terms: list[tuple[int, Union[set[str], list[str]]]]) -> None:
+        """Ajoute les termes `(id, termes)` de courriels au fichier de termes."""
+        lines = "".join(json.dumps({"id": email_id, "terms": sorted(email_terms)}) + "\n"
+                        for email_id, email_terms in terms)
+        with open(self._search_path(folder), 'a', encoding='utf-8') as search_file:
+            search_file.write(lines)
+
+    def _read_search(self, folder: str) -> _SearchCache:
+        """Retourne l'index de recherche de la boîte après lecture des nouvelles lignes."""
+        search_path = self._search_path(folder)
+        try:
+            search_stat = os.stat(search_path)
+            inode, size = search_stat.st_ino, search_stat.st_size
+        except FileNotFoundError:
+            inode, size = None, 0
+        search = self._searches.get(folder)
+        if search is None or search.inode != inode or size < search.position:
+            search = _SearchCache(inode)
+            self._searches[folder] = search
+        if size > search.position:
+            records, search.position = _read_lines(search_path, search.position, size)
+            for record in records:
+                search.add(record["id"], record["terms"])
+        return search
+
+    def _load_search(self, username: str) -> _SearchCache:
+        """
+        Retourne l'index de recherche à jour de la boîte de `username`.
+
+        Les courriels plus récents que le dernier indexé (fichier de termes
+        absent, arrêt brutal entre l'index et les termes) sont relus et
+        indexés: le fichier est ainsi créé ou complété au besoin.
+        """
+        folder = self._folder(username)
+        with self._lock(folder):
+            inbox = self._load_inbox(folder)
+            search = self._read_search(folder)
+            if inbox.max_id <= search.max_id:
+                return search
+            terms = []
+            for email_id in sorted(email_id for email_id in inbox.by_id
+                                   if email_id > search.max_id):
+                email_terms = set()
+                email_file = self.open_email(username, email_id)
+                if email_file is not None:
+                    with email_file:
+                        with contextlib.suppress(ValueError):
+                            email_terms = glosearch.email_terms(json.load(email_file))
+                terms.append((email_id, email_terms))
+            self._append_terms(folder, terms)
+            return self._read_search(folder)
+
+    # Compteurs
+
+    def _write_stats(self, folder: str) -> None:
+        """Enregistre les compteurs de la boîte à côté du fichier `pass`."""
+        stats_path = os.path.join(folder, gloutils.STATS_FILENAME)
+        temp_path = stats_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as stats_file:
+            json.dump(self._mailbox_stats[folder], stats_file)
+        os.replace(temp_path, stats_path)
+
+    @staticmethod
+    def _read_stats(folder: str) -> Optional[gloutils.StatsPayload]:
+        """Lit les compteurs enregistrés de la boîte, ou None s'ils sont illisibles."""
+        try:
+            with open(os.path.join(folder, gloutils.STATS_FILENAME),
+                      'r', encoding='utf-8') as stats_file:
+                return json.load(stats_file)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _current_stats(self, folder: str) -> gloutils.StatsPayload:
+        """
+        Retourne les compteurs de la boîte: ceux en mémoire, ou ceux du
+        disque si d'autres processus peuvent livrer dans la même boîte.
+        """
+        stats = None
+        if self._shared:
+            stats = self._read_stats(folder)
+        else:
+            stats = self._mailbox_stats.get(folder)
+        if stats is None:
+            stats = self._scan_stats(folder)
+        self._mailbox_stats[folder] = stats
+        return stats
+
+    # Verrous
+
+    @contextlib.contextmanager
+    def _lock(self, folder: str) -> Iterator[None]:
+        """
+        Verrou exclusif (réentrant) sur une boîte, partagé entre les fils et,
+        en mode `shared`, entre les processus.
+        """
+        with self._thread_locks.setdefault(folder, threading.RLock()):
+            if not self._shared or fcntl is None:
+                yield
+                return
+            with self._process_lock(folder):
+                yield
+
+    @contextlib.contextmanager
+    def _process_lock(self, folder: str) -> Iterator[None]:
+        """Verrou fcntl.flock réentrant sur une boîte, entre les processus."""
+        held = self._held_locks.get(folder)
+        if held is not None:
+            held[1] += 1
+            try:
+                yield
+            finally:
+                held[1] -= 1
+            return
+
+        lock_file = open(os.path.join(folder, gloutils.LOCK_FILENAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._held_locks[folder] = [lock_file, 1]
+            yield
+        finally:
+            self._held_locks.pop(folder, None)
+            lock_file.close()
+
+
+class FileStorage(Storage):
+    """
+    Disposition d'origine: chaque courriel est un fichier `<id>.json` du
+    dossier de l'utilisateur, décrit par une ligne de l'index (`file`).
+
+    Une livraison synchronisée coûte une synchronisation (fsync) par
+    courriel, en plus de celles de l'index et du dossier: elles sont
+    lancées simultanément, pour que le journal du système de fichiers les
+    regroupe, mais leur nombre croît avec le lot. `SegmentStorage` et
+    `SQLiteStorage` n'en font qu'une par lot.
+    """
+
+    def __init__(self, root: str, shared: bool = False) -> None:
+        """Prépare `_syncs`, le pool des synchronisations simultanées des courriels."""
+        super().__init__(root, shared)
+        self._syncs = concurrent.futures.ThreadPoolExecutor(
+            max_workers=gloutils.STORAGE_SYNC_THREADS)
+
+    @staticmethod
+    def _email_filename(email_id: int) -> str:
+        """Retourne le nom du fichier contenant le courriel `email_id`."""
+        return f"{email_id}.json"
+
+    def open_email(self, username: str, email_id: int) -> Optional[BinaryIO]:
+        try:
+            return open(os.path.join(self._folder(username),
+                                     self._email_filename(email_id)), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def _write_emails(self, folder: str, emails: list[tuple[int, dict, Optional[str]]],
+                      sync: bool) -> list[dict]:
+        entries = []
+        written = []
+        moves = []
+        for email_id, payload, source in emails:
+            email_filename = self._email_filename(email_id)
+            email_path = os.path.join(folder, email_filename)
+            if source is None:
+                email_data = json.dumps(_content_last(payload)).encode('utf-8')
+                with open(email_path, 'wb') as email_file:
+                    email_file.write(email_data)
+                written.append(email_path)
+                email_size = len(email_data)
+            else:
+                written.append(source)
+                moves.append((source, email_path))
+                email_size = os.path.getsize(source)
+            entries.append(self._index_entry(email_id, payload, email_size,
+                                             file=email_filename))
+        if sync:
+            # Synchronisations simultanées, regroupées par le journal du système
+            # de fichiers; les courriels en flux le sont avant d'être renommés
+            list(self._syncs.map(_fsync_path, written))
+        for source, email_path in moves:
+            os.replace(source, email_path)
+        return entries
+
+    def _rebuild_index(self, folder: str) -> list[dict]:
+        """
+        Reconstruit l'index de la boîte `folder` en relisant tous les
+        fichiers de courriels, puis le remplace de manière atomique.
+
+        Les courriels de l'ancien format (`sujet_date.json`) reçoivent un
+        identifiant et sont renommés `<id>.json` pour que leur identifiant
+        reste stable lors des reconstructions suivantes.
+        """
+        identified, legacy = [], []
+        for email_file in os.listdir(folder):
+            if not email_file.endswith(".json"):
+                continue
+            stem = email_file[:-len(".json")]
+            if stem.isdigit():
+                identified.append((int(stem), email_file))
+            else:
+                legacy.append(email_file)
+
+        next_id = max((email_id for email_id, _ in identified), default=0) + 1
+        for email_file in sorted(legacy):
+            new_filename = self._email_filename(next_id)
+            os.replace(os.path.join(folder, email_file),
+                       os.path.join(folder, new_filename))
+            identified.append((next_id, new_filename))
+            next_id += 1
+
+        entries = []
+        for email_id, email_file in sorted(identified):
+            email_path = os.path.join(folder, email_file)
+            try:
+                with open(email_path, 'r', encoding='utf-8') as email:
+                    email_data = json.load(email)
+            except (OSError, json.JSONDecodeError):
+                continue
+            entries.append(self._index_entry(
+                email_id, email_data, os.path.getsize(email_path), file=email_file))
+
+        self._write_index(folder, entries)
+        return entries
+
+    def _scan_stats(self, folder: str) -> gloutils.StatsPayload:
+        """Calcule les compteurs de la boîte `folder` en parcourant le dossier."""
+        nb_emails, total_size = 0, 0
+        with os.scandir(folder) as files:
+            for file in files:
+                if file.name.endswith(".json") and file.is_file():
+                    nb_emails += 1
+                    total_size += file.stat().st_size
+        return gloutils.StatsPayload(count=nb_emails, size=total_size)
+
+
+class SegmentStorage(Storage):
+    """
+    Chaque boîte est un unique fichier segment auquel les courriels sont
+    ajoutés, un document JSON par ligne (`{"id": ..., ..., "content": ...}`),
+    et un index qui donne la position (`offset`) et la taille (`size`) de
+    chacun. Une livraison n'ouvre que ces deux fichiers, quel que soit le
+    nombre de courriels, et les lectures passent par une projection mmap du
+    segment partagée entre les requêtes.
+
+    Avant chaque ajout, le segment est tronqué à la fin du dernier courriel
+    indexé: un ajout interrompu par un arrêt brutal ne laisse pas de trace.
+    """
+
+    index_filename = gloutils.SEGMENT_INDEX_FILENAME
+
+    def __init__(self, root: str, shared: bool = False) -> None:
+        """Prépare `_mappings`, la projection mmap du segment de chaque boîte."""
+        super().__init__(root, shared)
+        self._mappings: dict[str, mmap.mmap] = {}
+
+    @staticmethod
+    def _segment_path(folder: str) -> str:
+        """Retourne le chemin du segment de la boîte `folder`."""
+        return os.path.join(folder, gloutils.SEGMENT_FILENAME)
+
+    def open_email(self, username: str, email_id: int) -> Optional[BinaryIO]:
+        folder = self._folder(username)
+        with self._lock(folder):
+            entry = self._load_inbox(folder).by_id.get(email_id)
+            if entry is None:
+                return None
+            # Le segment a grandi depuis la projection: elle est refaite
+            mapping = self._mappings.get(folder)
+            if mapping is None or len(mapping) < entry["offset"] + entry["size"]:
+                with open(self._segment_path(folder), 'rb') as segment:
+                    mapping = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mappings[folder] = mapping
+        return _MappedEmail(mapping, entry["offset"], entry["size"])
+
+    def _write_emails(self, folder: str, emails: list[tuple[int, dict, Optional[str]]],
+                      sync: bool) -> list[dict]:
+        last = self._load_inbox(folder).last
+        offset = 0 if last is None else last["offset"] + last["size"] + 1
+        entries = []
+        with open(self._segment_path(folder), 'ab') as segment:
+            segment.truncate(offset)
+            for email_id, payload, source in emails:
+                if source is None:
+                    record = {"id": email_id}
+                    record.update(_content_last(
+                        {key: value for key, value in payload.items() if key != "id"}))
+                    email_data = json.dumps(record).encode('utf-8')
+                    segment.write(email_data + b"\n")
+                    email_size = len(email_data)
+                else:
+                    # Document déjà écrit: l'identifiant est inséré après `{`
+                    prefix = b'{"id": %d, ' % email_id
+                    with open(source, 'rb') as email_file:
+                        email_size = len(prefix) + os.fstat(email_file.fileno()).st_size - 1
+                        email_file.seek(1)
+                        segment.write(prefix)
+                        shutil.copyfileobj(email_file, segment, gloutils.EMAIL_STREAM_CHUNK_SIZE)
+                    segment.write(b"\n")
+                    os.remove(source)
+                entries.append(self._index_entry(email_id, payload, email_size,
+                                                 offset=offset))
+                offset += email_size + 1
+            if sync:
+                # Une seule synchronisation du segment pour tout le lot
+                segment.flush()
+                os.fsync(segment.fileno())
+        return entries
+
+    def _rebuild_index(self, folder: str) -> list[dict]:
+        """
+        Reconstruit l'index de la boîte `folder` en parcourant son segment,
+        puis le remplace de manière atomique. Une ligne illisible ou
+        inachevée (arrêt brutal) est ignorée.
+        """
+        entries = []
+        offset = 0
+        with contextlib.suppress(FileNotFoundError), \
+                open(self._segment_path(folder), 'rb') as segment:
+            for line in segment:
+                record = None
+                if line.endswith(b"\n"):
+                    with contextlib.suppress(ValueError):
+                        record = json.loads(line)
+                if isinstance(record, dict) and isinstance(record.get("id"), int):
+                    entries.append(self._index_entry(record["id"], record, len(line) - 1,
+                                                     offset=offset))
+                offset += len(line)
+        self._write_index(folder, entries)
+        return entries
+
+
+def _sqlite_errors(method: Callable) -> Callable:
+    """Convertit les erreurs SQLite de `method` en OSError, comme pour les autres moteurs."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except sqlite3.Error as e:
+            raise OSError(f"Erreur SQLite : {e}") from e
+    return wrapper
+
+
+class _SQLiteEmail:
+    """
+    Gros courriel de la base vu comme un fichier binaire en lecture seule:
+    une poignée de blob incrémentale (`blobopen`) lit le document par
+    morceaux, sans le charger en entier. La poignée a sa propre connexion,
+    utilisable depuis n'importe quel fil (une lecture à la fois): le
+    courriel peut être relu par fenêtres depuis différents fils du pool.
+    """
+
+    @_sqlite_errors
+    def __init__(self, path: str, rowid: int) -> None:
+        self._connection = sqlite3.connect(path, timeout=gloutils.SQLITE_TIMEOUT,
+                                           check_same_thread=False)
+        try:
+            self._blob = self._connection.blobopen("emails", "document", rowid,
+                                                   readonly=True)
+        except sqlite3.Error:
+            self._connection.close()
+            raise
+
+    @_sqlite_errors
+    def read(self, size: int = -1) -> bytes:
+        return self._blob.read(size)
+
+    @_sqlite_errors
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def tell(self) -> int:
+        return self._blob.tell()
+
+    def close(self) -> None:
+        self._blob.close()
+        self._connection.close()
+
+    def __enter__(self) -> "_SQLiteEmail":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+_SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS emails (
+    username TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    sender TEXT,
+    subject TEXT,
+    date TEXT,
+    timestamp REAL NOT NULL,
+    size INTEGER NOT NULL,
+    document BLOB NOT NULL,
+    PRIMARY KEY (username, id)
+);
+CREATE INDEX IF NOT EXISTS emails_by_time ON emails (username, timestamp, id);
+CREATE TABLE IF NOT EXISTS email_terms (
+    username TEXT NOT NULL,
+    term TEXT NOT NULL,
+    email_id INTEGER NOT NULL,
+    PRIMARY KEY (username, term, email_id)
+) WITHOUT ROWID;
+"""
+# Version du schéma (PRAGMA user_version): 1 depuis l'ajout de `email_terms`
+_SQL_VERSION = 1
+_SQL_USERNAMES = "SELECT username FROM users ORDER BY username"
+_SQL_USER_EXISTS = "SELECT 1 FROM users WHERE username = ?"
+_SQL_CREATE_USER = "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)"
+_SQL_PASSWORD_HASH = "SELECT password_hash FROM users WHERE username = ?"
+_SQL_SET_PASSWORD_HASH = "UPDATE users SET password_hash = ? WHERE username = ?"
+_SQL_PAGE = ("SELECT id, sender, subject, date FROM emails WHERE username = ?"
+             " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?")
+_SQL_RANK = ("SELECT COUNT(*) FROM emails WHERE username = ?"
+             " AND (timestamp, id) > (SELECT timestamp, id FROM emails"
+             " WHERE username = ? AND id = ?)")
+_SQL_HAS_EMAIL = "SELECT 1 FROM emails WHERE username = ? AND id = ?"
+_SQL_STATS = "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM emails WHERE username = ?"
+_SQL_EMAIL = ("SELECT rowid, CASE WHEN size <= ? THEN document END FROM emails"
+              " WHERE username = ? AND id = ?")
+_SQL_DOCUMENTS = "SELECT id, document FROM emails WHERE username = ? ORDER BY id"
+_SQL_NEXT_ID = "SELECT COALESCE(MAX(id), 0) + 1 FROM emails WHERE username = ?"
+_SQL_INSERT_EMAIL = ("INSERT OR IGNORE INTO emails (username, id, sender, subject, date,"
+                     " timestamp, size, document) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+_SQL_INSERT_TERM = "INSERT OR IGNORE INTO email_terms (username, term, email_id) VALUES (?, ?, ?)"
+_SQL_DELETE_TERMS = "DELETE FROM email_terms WHERE username = ?"
+_SQL_TERM_IDS = "SELECT email_id FROM email_terms WHERE username = ? AND term = ?"
+_SQL_ENTRIES = "SELECT id, sender, subject, date FROM emails WHERE username = ? AND id IN ({})"
+_SQL_INSERT_EMPTY_EMAIL = ("INSERT INTO emails (username, id, sender, subject, date,"
+                           " timestamp, size, document) VALUES (?, ?, ?, ?, ?, ?, ?, zeroblob(?))")
+
+
+class SQLiteStorage(Storage):
+    """
+    Comptes et courriels dans une base SQLite unique (`SERVER_DATABASE_FILENAME`
+    sous `root`), en mode WAL: les lectures ne bloquent pas les livraisons.
+
+    La table `users` contient les hachages des mots de passe et la table
+    `emails` les courriels (entêtes, taille et document JSON, corps en
+    dernier), indexés par `(username, id)` et par `(username, timestamp,
+    id)`: les pages, les lectures par identifiant, les compteurs
+    (COUNT/SUM) et l'existence des comptes sont des requêtes sur index. La
+    table `email_terms` est l'index de recherche, une ligne par terme de
+    chaque courriel, écrite dans la transaction de sa livraison.
+
+    Chaque fil a sa propre connexion. Les requêtes, paramétrées, restent
+    préparées dans le cache de chaque connexion. En mode `shared`, les
+    processus se partagent la base grâce aux verrous de SQLite.
+    """
+
+    @_sqlite_errors
+    def __init__(self, root: str, shared: bool = False) -> None:
+        """
+        Ouvre la base (créée au besoin) et prépare ses tables. Les courriels
+        d'une base créée avant l'index de recherche sont indexés.
+        """
+        super().__init__(root, shared)
+        self._path = os.path.join(root, gloutils.SERVER_DATABASE_FILENAME)
+        self._local = threading.local()
+        connection = self._connection()
+        connection.executescript(_SQL_SCHEMA)
+        if connection.execute("PRAGMA user_version").fetchone()[0] < _SQL_VERSION:
+            for username in self.usernames():
+                self.rebuild_search(username)
+            connection.execute(f"PRAGMA user_version = {_SQL_VERSION}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Retourne la connexion du fil courant, ouverte au besoin."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Transactions explicites (BEGIN IMMEDIATE) pour les écritures
+            connection = sqlite3.connect(self._path, timeout=gloutils.SQLITE_TIMEOUT,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self, sync: bool = False) -> Iterator[sqlite3.Connection]:
+        """
+        Transaction d'écriture: validée à la sortie, annulée en cas d'erreur.
+        Si `sync` est vrai, le WAL est synchronisé sur le disque à la
+        validation (`synchronous=FULL`).
+        """
+        connection = self._connection()
+        if sync:
+            connection.execute("PRAGMA synchronous=FULL")
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.rollback()
+                raise
+            connection.commit()
+        finally:
+            if sync:
+                connection.execute("PRAGMA synchronous=NORMAL")
+
+    @_sqlite_errors
+    def usernames(self) -> list[str]:
+        return [row[0] for row in self._connection().execute(_SQL_USERNAMES)]
+
+    @_sqlite_errors
+    def user_exists(self, username: str) -> bool:
+        return self._connection().execute(_SQL_USER_EXISTS, (username,)).fetchone() is not None
+
+    @_sqlite_errors
+    def create_user(self, username: str, password_hash: str) -> bool:
+        with self._transaction() as connection:
+            return connection.execute(_SQL_CREATE_USER,
+                                      (username, password_hash)).rowcount == 1
+
+    @_sqlite_errors
+    def password_hash(self, username: str) -> Optional[str]:
+        row = self._connection().execute(_SQL_PASSWORD_HASH, (username,)).fetchone()
+        return None if row is None else row[0]
+
+    @_sqlite_errors
+    def set_password_hash(self, username: str, password_hash: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(_SQL_SET_PASSWORD_HASH, (password_hash, username))
+
+    @_sqlite_errors
+    def inbox_page(self, username: str, offset: int, limit: int,
+                   before_id: Optional[int] = None) -> tuple[list[dict], int, int]:
+        connection = self._connection()
+        # Lecture cohérente de la page et du total
+        connection.execute("BEGIN")
+        try:
+            if before_id is not None:
+                if connection.execute(_SQL_HAS_EMAIL, (username, before_id)).fetchone():
+                    offset = connection.execute(
+                        _SQL_RANK, (username, username, before_id)).fetchone()[0] + 1
+                else:
+                    offset = 0
+            entries = [{"id": email_id, "sender": sender, "subject": subject, "date": date}
+                       for email_id, sender, subject, date
+                       in connection.execute(_SQL_PAGE, (username, limit, offset))]
+            total = connection.execute(_SQL_STATS, (username,)).fetchone()[0]
+        finally:
+            connection.commit()
+        return entries, offset, total
+
+    @_sqlite_errors
+    def open_email(self, username: str, email_id: int) -> Optional[BinaryIO]:
+        row = self._connection().execute(
+            _SQL_EMAIL, (gloutils.EMAIL_STREAM_THRESHOLD, username, email_id)).fetchone()
+        if row is None:
+            return None
+        rowid, document = row
+        if document is not None:
+            return io.BytesIO(document)
+        return _SQLiteEmail(self._path, rowid)
+
+    def emails(self, username: str) -> Iterator[tuple[int, dict]]:
+        try:
+            for email_id, document in self._connection().execute(_SQL_DOCUMENTS, (username,)):
+                email = json.loads(document)
+                email.pop("id", None)
+                yield email_id, email
+        except sqlite3.Error as e:
+            raise OSError(f"Erreur SQLite : {e}") from e
+
+    @_sqlite_errors
+    def stats(self, username: str) -> gloutils.StatsPayload:
+        count, size = self._connection().execute(_SQL_STATS, (username,)).fetchone()
+        return gloutils.StatsPayload(count=count, size=size)
+
+    @_sqlite_errors
+    def search(self, username: str, terms: list[str], limit: int) -> tuple[list[dict], int]:
+        if not terms:
+            return [], 0
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            email_ids = [row[0] for row in connection.execute(
+                " INTERSECT ".join([_SQL_TERM_IDS] * len(terms)) + " ORDER BY 1 DESC",
+                [value for term in terms for value in (username, term)])]
+            page = email_ids[:limit]
+            rows = connection.execute(_SQL_ENTRIES.format(", ".join("?" * len(page))),
+                                      [username, *page])
+            entries = {email_id: {"id": email_id, "sender": sender,
+                                  "subject": subject, "date": date}
+                       for email_id, sender, subject, date in rows}
+        finally:
+            connection.commit()
+        return [entries[email_id] for email_id in page if email_id in entries], len(email_ids)
+
+    @_sqlite_errors
+    def rebuild_search(self, username: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(_SQL_DELETE_TERMS, (username,))
+            documents = connection.execute(_SQL_DOCUMENTS, (username,)).fetchall()
+            for email_id, document in documents:
+                self._insert_terms(connection, username, email_id,
+                                   glosearch.email_terms(json.loads(document)))
+
+    @staticmethod
+    def _insert_terms(connection: sqlite3.Connection, username: str, email_id: int,
+                      terms: Iterable[str]) -> None:
+        """Ajoute les termes d'un courriel à l'index de recherche."""
+        connection.executemany(_SQL_INSERT_TERM,
+                               [(username, term, email_id) for term in terms])
+
+    @staticmethod
+    def _email_row(username: str, email_id: int, payload: dict, document: bytes) -> tuple:
+        """Retourne la ligne de la table `emails` d'un courriel."""
+        return (username, email_id, payload.get("sender"), payload.get("subject"),
+                payload.get("date"), gloutils.get_timestamp(payload.get("date") or ""),
+                len(document), document)
+
+    def _insert(self, connection: sqlite3.Connection, username: str,
+                payloads: list[dict]) -> None:
+        """Insère des courriels dans la boîte, avec des identifiants consécutifs."""
+        documents = [json.dumps(_content_last(payload)).encode('utf-8')
+                     for payload in payloads]
+        email_id = connection.execute(_SQL_NEXT_ID, (username,)).fetchone()[0]
+        connection.executemany(_SQL_INSERT_EMAIL, [
+            self._email_row(username, email_id + number, payload, document)
+            for number, (payload, document) in enumerate(zip(payloads, documents))])
+        for number, payload in enumerate(payloads):
+            self._insert_terms(connection, username, email_id + number,
+                               glosearch.email_terms(payload))
+
+    @_sqlite_errors
+    def deliver(self, username: str, payloads: list[dict], sync: bool = False) -> None:
+        with self._transaction(sync) as connection:
+            self._insert(connection, username, payloads)
+
+    def deliver_many(self, deliveries: dict[str, list[dict]],
+                     sync: bool = False) -> dict[str, OSError]:
+        """
+        Livre les courriels de toutes les boîtes en une seule transaction:
+        une seule synchronisation du WAL pour le lot, mais un échec touche
+        toutes les boîtes.
+        """
+        try:
+            with self._transaction(sync) as connection:
+                for username, payloads in deliveries.items():
+                    self._insert(connection, username, payloads)
+        except sqlite3.Error as e:
+            error = OSError(f"Erreur SQLite : {e}")
+            return {username: error for username in deliveries}
+        return {}
+
+    @_sqlite_errors
+    def deliver_file(self, username: str, payload: dict, path: str,
+                     sync: bool = False, body_terms: Iterable[str] = ()) -> None:
+        with open(path, 'rb') as email_file:
+            size = os.fstat(email_file.fileno()).st_size
+            with self._transaction(sync) as connection:
+                email_id = connection.execute(_SQL_NEXT_ID, (username,)).fetchone()[0]
+                row = self._email_row(username, email_id, payload, b"")
+                rowid = connection.execute(_SQL_INSERT_EMPTY_EMAIL,
+                                           row[:-2] + (size, size)).lastrowid
+                # Document copié par morceaux, sans le charger en entier
+                with connection.blobopen("emails", "document", rowid) as blob:
+                    while data := email_file.read(gloutils.EMAIL_STREAM_CHUNK_SIZE):
+                        blob.write(data)
+                self._insert_terms(connection, username, email_id,
+                                   glosearch.email_terms(payload, body_terms))
+        os.remove(path)
+
+    @_sqlite_errors
+    def import_emails(self, username: str, emails: Iterable[tuple[int, dict]]) -> int:
+        emails = list(emails)
+        rows = [self._email_row(username, email_id, email,
+                                json.dumps(_content_last(email)).encode('utf-8'))
+                for email_id, email in emails]
+        with self._transaction() as connection:
+            imported = 0
+            for row, (email_id, email) in zip(rows, emails):
+                if connection.execute(_SQL_INSERT_EMAIL, row).rowcount == 1:
+                    imported += 1
+                    self._insert_terms(connection, username, email_id,
+                                       glosearch.email_terms(email))
+            return imported
+
+    def load(self) -> None:
+        """Les compteurs sont calculés par la base: rien à vérifier au démarrage."""
+
+
+class UserRegistry:
+    """
+    Annuaire en mémoire des comptes d'un moteur de stockage: le hachage du
+    mot de passe de chaque utilisateur, chargé au démarrage (`load`) puis
+    tenu à jour à la création des comptes et au remplacement des hachages.
+    Les recherches de comptes ne touchent alors plus le disque.
+
+    En mode `shared`, d'autres processus peuvent créer des comptes: un nom
+    inconnu est alors recherché dans le stockage (puis retenu s'il existe).
+    Les méthodes peuvent être appelées depuis plusieurs fils et lèvent une
+    exception OSError en cas d'erreur d'accès au stockage.
+    """
+
+    def __init__(self, storage: Storage, shared: bool = False) -> None:
+        self._storage = storage
+        self._shared = shared
+        self._hashes: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Charge les comptes et les hachages du stockage."""
+        hashes = {username: self._storage.password_hash(username)
+                  for username in self._storage.usernames()}
+        with self._lock:
+            self._hashes.update((username, password_hash)
+                                for username, password_hash in hashes.items()
+                                if password_hash is not None)
+
+    def password_hash(self, username: str) -> Optional[str]:
+        """Retourne le hachage du mot de passe, ou None si le compte n'existe pas."""
+        with self._lock:
+            password_hash = self._hashes.get(username)
+        if password_hash is None and self._shared:
+            password_hash = self._storage.password_hash(username)
+            if password_hash is not None:
+                with self._lock:
+                    self._hashes.setdefault(username, password_hash)
+        return password_hash
+
+    def user_exists(self, username: str) -> bool:
+        """Indique si le compte `username` existe."""
+        return self.password_hash(username) is not None
+
+    def create_user(self, username: str, password_hash: str) -> bool:
+        """Crée le compte dans le stockage (voir `Storage.create_user`) et le retient."""
+        created = self._storage.create_user(username, password_hash)
+        if created:
+            with self._lock:
+                self._hashes[username] = password_hash
+        return created
+
+    def set_password_hash(self, username: str, password_hash: str) -> None:
+        """Remplace le hachage du mot de passe dans le stockage et en mémoire."""
+        self._storage.set_password_hash(username, password_hash)
+        with self._lock:
+            self._hashes[username] = password_hash
+
+
+STORAGES: dict[str, type[Storage]] = {
+    "file": FileStorage,
+    "segment": SegmentStorage,
+    "sqlite": SQLiteStorage,
+}
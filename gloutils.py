@@ -5,12 +5,53 @@ protocoles et gabarits à utiliser pour le TP4.
 import enum
 from typing import TypedDict, Union
 import datetime
+import email.utils
 
 APP_PORT = 9672
 SERVER_DATA_DIR = "glo_server_data"
 SERVER_LOST_DIR = "LOST"
 SERVER_DOMAIN = "glo2000.ca"
+RECV_SIZE = 65536
+SERVER_THREADS = 8
+SERVER_HASH_THREADS = 4
+SERVER_STORAGE = "file"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INDEX_FILENAME = "index"
+SEGMENT_FILENAME = "segment"
+SEGMENT_INDEX_FILENAME = "segment.index"
+STATS_FILENAME = "stats"
+SEARCH_INDEX_FILENAME = "search.index"
+LOCK_FILENAME = "lock"
+SERVER_DATABASE_FILENAME = "glo_server.sqlite3"
+SQLITE_TIMEOUT = 30.0
+
+PASSWORD_SALT_SIZE = 16
+PASSWORD_KEY_SIZE = 32
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600_000
+SESSION_SECRET_FILENAME = "session.key"
+SESSION_SECRET_SIZE = 32
+SESSION_TOKEN_LIFETIME = 7 * 24 * 3600
+
+EMAIL_BATCH_MAX = 1000
+DELIVERY_MAX_BATCH = 512
+DELIVERY_MAX_LATENCY = 0.002
+STORAGE_SYNC_THREADS = 16
+
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 100
+
+CLIENT_POOL_SIZE = 4
+
+COMPRESSION_THRESHOLD = 1024
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+EMAIL_STREAM_CHUNK_SIZE = 64 * 1024
+EMAIL_STREAM_THRESHOLD = 1024 * 1024
+SERVER_STREAM_WINDOW = 1024 * 1024
+SERVER_PENDING_LIMIT = 4 * MAX_FRAME_SIZE
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -20,7 +61,8 @@ CLIENT_USE_CHOICE = """Menu principal
 1. Consultation de courriels
 2. Envoi de courriels
 3. Statistiques
-4. Se déconnecter"""
+4. Se déconnecter
+5. Recherche de courriels"""
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
 
@@ -55,6 +97,18 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    # Entêtes ajoutées à la fin pour conserver les valeurs existantes
+    EMAIL_BATCH_SENDING = enum.auto()
+    CAPABILITIES = enum.auto()
+
+    EMAIL_STREAM_BEGIN = enum.auto()
+    EMAIL_STREAM_CHUNK = enum.auto()
+    EMAIL_STREAM_END = enum.auto()
+    INBOX_READING_STREAM = enum.auto()
+    INBOX_SEARCH = enum.auto()
+    AUTH_RESUME = enum.auto()
+    METRICS = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -67,6 +121,26 @@ class AuthPayload(TypedDict, total=True):
     password: str
 
 
+class LoginPayload(TypedDict, total=False):
+    """
+    Payload pour la requête AUTH_LOGIN demandant un jeton de session: si
+    `session` est vrai, la réponse contient un `SessionPayload`.
+    """
+    username: str
+    password: str
+    session: bool
+
+
+class SessionPayload(TypedDict, total=False):
+    """
+    Payload d'un jeton de session: réponse à AUTH_LOGIN (`token` et son
+    échéance `expires`, en secondes depuis l'époque Unix) et requête
+    AUTH_RESUME, qui reprend la session sur une nouvelle connexion (`token`).
+    """
+    token: str
+    expires: int
+
+
 class EmailContentPayload(TypedDict, total=True):
     """Payload pour les transferts de courriels."""
     sender: str
@@ -76,14 +150,96 @@ class EmailContentPayload(TypedDict, total=True):
     content: str
 
 
+class EmailStreamPayload(TypedDict, total=True):
+    """
+    Payload décrivant un courriel transféré par morceaux.
+
+    Envoi: `EMAIL_STREAM_BEGIN` (ce payload), des `EMAIL_STREAM_CHUNK` puis
+    `EMAIL_STREAM_END`, auquel seul le serveur répond comme à `EMAIL_SENDING`.
+    Lecture: le serveur répond à `INBOX_READING_STREAM` par ce payload, puis
+    envoie des `EMAIL_STREAM_CHUNK` et termine par `EMAIL_STREAM_END`, tous
+    avec le `request_id` de la requête.
+    """
+    sender: str
+    destination: str
+    subject: str
+    date: str
+
+
+class EmailChunkPayload(TypedDict, total=True):
+    """Payload pour un morceau (`EMAIL_STREAM_CHUNK`) du corps d'un courriel."""
+    data: str
+
+
+class InboxRequestPayload(TypedDict, total=False):
+    """
+    Payload pour la consultation paginée de la boîte de réception.
+
+    `offset` et `limit` sélectionnent une page de la liste ordonnée du plus
+    récent au plus ancien. Si `before_id` est fourni, la page commence
+    juste après ce courriel et `offset` est ignoré.
+    """
+    offset: int
+    limit: int
+    before_id: int
+
+
+class EmailBatchPayload(TypedDict, total=False):
+    """
+    Payload pour l'envoi groupé de courriels (`EMAIL_BATCH_SENDING`).
+
+    Chaque courriel de `messages` est livré à chaque adresse de
+    `destinations` si cette liste est fournie, sinon à sa propre
+    `destination`.
+    """
+    messages: list[EmailContentPayload]
+    destinations: list[str]
+
+
+class EmailResultPayload(TypedDict, total=False):
+    """Résultat de la livraison d'un courriel à un destinataire d'un envoi groupé."""
+    message_index: int
+    destination: str
+    header: Headers
+    error_message: str
+
+
+class EmailBatchResultPayload(TypedDict, total=True):
+    """Payload de réponse à un envoi groupé: un résultat par livraison."""
+    results: list[EmailResultPayload]
+
+
 class EmailListPayload(TypedDict, total=True):
-    """Payload pour les consulation de courriel."""
+    """
+    Payload pour les consulation de courriel.
+
+    `email_ids[i]` est l'identifiant stable du courriel `email_list[i]`.
+    `offset` est la position de la page dans la boîte et `total` le nombre
+    total de courriels de la boîte.
+    """
     email_list: list[str]
+    email_ids: list[int]
+    offset: int
+    total: int
+
+
+class SearchPayload(TypedDict, total=False):
+    """
+    Payload pour la recherche dans la boîte de réception (`INBOX_SEARCH`).
+
+    `query` est une suite de mots cherchés dans l'expéditeur, le sujet et le
+    corps des courriels; un mot préfixé par `from:` ou `subject:` n'est
+    cherché que dans ce champ. Au plus `limit` résultats sont retournés,
+    dans une liste `EmailListPayload` dont `total` est le nombre de
+    courriels correspondants.
+    """
+    query: str
+    limit: int
 
 
 class EmailChoicePayload(TypedDict, total=True):
-    """Payload pour le choix du courriel à consulter."""
-    choice: int
+    """Payload pour le choix (par identifiant) du courriel à consulter."""
+    email_id: int
 
 
 class StatsPayload(TypedDict, total=True):
@@ -92,19 +248,63 @@ class StatsPayload(TypedDict, total=True):
     size: int
 
 
+class MetricsPayload(TypedDict, total=True):
+    """
+    Payload de la réponse à `METRICS`, réservée au compte d'administration: les
+    métriques du processus serveur au format texte de Prometheus.
+    """
+    text: str
+
+
+class CapabilitiesPayload(TypedDict, total=False):
+    """
+    Payload pour la négociation des capacités (`CAPABILITIES`).
+
+    Le client envoie, en JSON, les `encodings` et les `compressions` qu'il
+    accepte par ordre de préférence; le serveur répond, encore en JSON et
+    sans compression, avec l'`encoding` et la `compression` retenus (pas de
+    `compression` si aucune) puis les utilise pour ses réponses suivantes.
+    """
+    encodings: list[str]
+    encoding: str
+    compressions: list[str]
+    compression: str
+
+
 class GloMessage(TypedDict, total=False):
     """
     Classe à utiliser pour générer des messages.
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    `request_id` est facultatif: s'il est présent dans une requête, le
+    serveur le renvoie dans la réponse, ce qui permet d'envoyer plusieurs
+    requêtes sans attendre et d'associer ensuite chaque réponse.
     """
     header: Headers
-    payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+    payload: Union[ErrorPayload, AuthPayload, LoginPayload, SessionPayload,
+                   EmailContentPayload,
+                   EmailBatchPayload, EmailBatchResultPayload,
+                   InboxRequestPayload, EmailListPayload, SearchPayload,
+                   EmailChoicePayload, StatsPayload, MetricsPayload,
+                   CapabilitiesPayload, EmailStreamPayload,
+                   EmailChunkPayload]
+    request_id: int
 
 
 def get_current_utc_time() -> str:
     """Récupère l'heure courante au fuseau UTC et la formatte en string."""
     current_time = datetime.datetime.now(datetime.timezone.utc)
     return current_time.strftime("%a, %d %b %Y %H:%M:%S %z")
+
+
+def get_timestamp(date: str) -> float:
+    """
+    Convertit une date produite par `get_current_utc_time` en timestamp
+    epoch. Une date illisible est remplacée par l'heure courante.
+    """
+    try:
+        return email.utils.parsedate_to_datetime(date).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return datetime.datetime.now(datetime.timezone.utc).timestamp()
@@ -0,0 +1,76 @@
+"""\
+Outil de migration des boîtes du serveur mail d'un moteur de stockage à
+l'autre (voir glostorage.STORAGES), par exemple de la disposition d'origine
+(un fichier JSON par courriel) vers le segment en ajout seul:
+
+    python migrate_storage.py --from file --to segment
+
+Les comptes absents de la destination y sont créés et les courriels gardent
+leurs identifiants. Les courriels déjà présents dans la destination sont
+ignorés: l'outil peut être relancé après une interruption. Les données de la
+source ne sont pas supprimées. Le serveur doit être arrêté pendant la
+migration, puis relancé avec `--storage` égal au moteur de destination.
+"""
+import argparse
+import itertools
+import sys
+
+import glostorage
+import gloutils
+
+
+def migrate(source: glostorage.Storage, target: glostorage.Storage,
+            batch_size: int) -> dict[str, int]:
+    """
+    Copie tous les comptes et courriels de `source` vers `target`, par lots
+    de `batch_size` courriels, et retourne le nombre de courriels ajoutés
+    par utilisateur.
+    """
+    migrated = {}
+    for username in source.usernames():
+        if not target.user_exists(username):
+            target.create_user(username, source.password_hash(username))
+        emails = source.emails(username)
+        migrated[username] = 0
+        while batch := list(itertools.islice(emails, batch_size)):
+            migrated[username] += target.import_emails(username, batch)
+    return migrated
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from", action="store", dest="source", required=True,
+                        choices=tuple(glostorage.STORAGES),
+                        help="Moteur de stockage actuel.")
+    parser.add_argument("--to", action="store", dest="target", required=True,
+                        choices=tuple(glostorage.STORAGES),
+                        help="Moteur de stockage de destination.")
+    parser.add_argument("--data-dir", action="store", dest="data_dir",
+                        default=gloutils.SERVER_DATA_DIR,
+                        help="Dossier de données du serveur.")
+    parser.add_argument("--target-dir", action="store", dest="target_dir",
+                        help="Dossier de données de destination (par défaut le même).")
+    parser.add_argument("--batch", action="store", dest="batch", type=int, default=256,
+                        help="Nombre de courriels écrits par lot.")
+    args = parser.parse_args(sys.argv[1:])
+
+    target_dir = args.target_dir or args.data_dir
+    if args.source == args.target and target_dir == args.data_dir:
+        print("Erreur : la source et la destination sont identiques.")
+        return 1
+    try:
+        source = glostorage.STORAGES[args.source](args.data_dir)
+        target = glostorage.STORAGES[args.target](target_dir)
+        migrated = migrate(source, target, max(1, args.batch))
+    except (OSError, ValueError) as e:
+        print(f"Erreur : Migration interrompue. {e}")
+        return 1
+    for username, count in migrated.items():
+        print(f"{username} : {count} courriel(s) migré(s).")
+    print(f"Migration terminée : {sum(migrated.values())} courriel(s), "
+          f"{len(migrated)} compte(s).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
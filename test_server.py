@@ -0,0 +1,321 @@
+"""\
+Tests de non-régression du serveur.
+
+Chaque classe démarre un serveur (moteur select) sur un dossier de données
+temporaire et un port libre.
+
+- Envois malformés: des `EMAIL_SENDING` et `EMAIL_BATCH_SENDING` dont des
+  champs ne sont pas des chaînes. Le serveur doit les refuser par un
+  message d'erreur, sans retirer le client ni s'arrêter, et livrer les
+  courriels valides soumis avec eux.
+- Sessions: un client qui se déconnecte pendant sa connexion ne doit
+  laisser aucune session (métriques `glo_sessions`). L'entête `METRICS`
+  est réservé à la session du compte d'administration.
+- Recherches: une requête de trop de termes est refusée par un message
+  d'erreur, sans retirer le client.
+
+Utilisation: python -m pytest test_server.py (ou python -m unittest)
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+import gloclient
+import glosearch
+import gloutils
+
+_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TP4_server.py")
+_PASSWORD = "MotDePasse123"
+_DATE = "Sun, 18 Oct 2026 09:32:04 +0000"
+_MALFORMED = ({"date": 123}, {"date": ["x"]}, {"subject": {"a": 1}},
+              {"sender": None}, {"content": 42})
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def _email(destination: str, **fields) -> dict:
+    email = {"sender": "alice@glo2000.ca", "destination": destination,
+             "subject": "Sujet", "date": _DATE, "content": "Bonjour"}
+    email.update(fields)
+    return email
+
+
+class _ServerTestCase(unittest.TestCase):
+    """Serveur démarré pour les tests de la classe, avec les comptes alice et bob."""
+
+    STORAGE = "file"
+    SERVER_ARGS: tuple[str, ...] = ()
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls._workdir = tempfile.TemporaryDirectory()
+        cls.port = _free_port()
+        cls._server = subprocess.Popen(
+            [sys.executable, _SERVER, "--port", str(cls.port), "--storage", cls.STORAGE,
+             *cls.SERVER_ARGS],
+            cwd=cls._workdir.name, stdout=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", cls.port)).close()
+                break
+            except OSError:
+                if cls._server.poll() is not None or time.monotonic() > deadline:
+                    cls._stop()
+                    raise RuntimeError("Le serveur n'a pas démarré.")
+                time.sleep(0.05)
+        for username in ("alice", "bob"):
+            connection = cls._connect()
+            response = connection.request(gloutils.Headers.AUTH_REGISTER,
+                                          {"username": username, "password": _PASSWORD})
+            connection.close()
+            if response["header"] != gloutils.Headers.OK:
+                cls._stop()
+                raise RuntimeError(f"Création du compte {username} impossible.")
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls._stop()
+
+    @classmethod
+    def _stop(cls) -> None:
+        if cls._server.poll() is None:
+            os.killpg(cls._server.pid, signal.SIGINT)
+            try:
+                cls._server.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(cls._server.pid, signal.SIGKILL)
+                cls._server.wait()
+        cls._workdir.cleanup()
+
+    @classmethod
+    def _connect(cls) -> gloclient.GloConnection:
+        return gloclient.GloConnection("127.0.0.1", cls.port)
+
+    def assertServerAlive(self) -> None:
+        connection = self._connect()
+        try:
+            response = connection.request(gloutils.Headers.AUTH_LOGIN,
+                                          {"username": "bob", "password": _PASSWORD})
+        finally:
+            connection.close()
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+
+
+class MalformedSendingTest(_ServerTestCase):
+    """Envois malformés sur le stockage par fichiers."""
+
+    def setUp(self) -> None:
+        self.connection = self._connect()
+        self.addCleanup(self.connection.close)
+        response = self.connection.request(gloutils.Headers.AUTH_LOGIN,
+                                           {"username": "alice", "password": _PASSWORD})
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+
+    def _inbox_count(self) -> int:
+        connection = self._connect()
+        try:
+            connection.request(gloutils.Headers.AUTH_LOGIN,
+                               {"username": "bob", "password": _PASSWORD})
+            return connection.request(gloutils.Headers.STATS_REQUEST)["payload"]["count"]
+        finally:
+            connection.close()
+
+    def test_email_sending_rejects_non_string_fields(self) -> None:
+        count = self._inbox_count()
+        for destination in ("bob@glo2000.ca", "inconnu@glo2000.ca"):
+            for fields in _MALFORMED:
+                with self.subTest(destination=destination, fields=fields):
+                    response = self.connection.request(
+                        gloutils.Headers.EMAIL_SENDING, _email(destination, **fields))
+                    self.assertEqual(response["header"], gloutils.Headers.ERROR)
+                    self.assertEqual(response["payload"]["error_message"],
+                                     "Courriel invalide.")
+        response = self.connection.request(gloutils.Headers.EMAIL_SENDING,
+                                           _email(7))
+        self.assertEqual(response["header"], gloutils.Headers.ERROR)
+        self.assertEqual(self._inbox_count(), count)
+        self.assertServerAlive()
+
+    def test_pipelined_sending_delivers_valid_emails(self) -> None:
+        # Envois consécutifs soumis ensemble à la file de livraison
+        count = self._inbox_count()
+        requests = [(gloutils.Headers.EMAIL_SENDING, _email("bob@glo2000.ca", **fields))
+                    for fields in _MALFORMED]
+        requests.insert(2, (gloutils.Headers.EMAIL_SENDING, _email("bob@glo2000.ca")))
+        request_ids = self.connection.submit_many(requests)
+        headers = [self.connection.result(request_id)["header"]
+                   for request_id in request_ids]
+        self.assertEqual(headers.count(gloutils.Headers.OK), 1)
+        self.assertEqual(headers[2], gloutils.Headers.OK)
+        self.assertEqual(self._inbox_count(), count + 1)
+        self.assertServerAlive()
+
+    def test_batch_sending_rejects_malformed_messages_only(self) -> None:
+        count = self._inbox_count()
+        messages = [_email("bob@glo2000.ca", **fields) for fields in _MALFORMED]
+        messages.append(_email("bob@glo2000.ca"))
+        messages.append(_email("inconnu@glo2000.ca", subject=5))
+        response = self.connection.request(gloutils.Headers.EMAIL_BATCH_SENDING,
+                                           {"messages": messages})
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+        results = response["payload"]["results"]
+        self.assertEqual(len(results), len(messages))
+        for result in results:
+            with self.subTest(result=result):
+                if result["message_index"] == len(_MALFORMED):
+                    self.assertEqual(result["header"], gloutils.Headers.OK)
+                else:
+                    self.assertEqual(result["header"], gloutils.Headers.ERROR)
+                    self.assertEqual(result["error_message"], "Courriel invalide.")
+        self.assertEqual(self._inbox_count(), count + 1)
+        self.assertServerAlive()
+
+    def test_batch_sending_with_destinations(self) -> None:
+        count = self._inbox_count()
+        response = self.connection.request(
+            gloutils.Headers.EMAIL_BATCH_SENDING,
+            {"messages": [_email("", date=123), _email("")],
+             "destinations": ["bob@glo2000.ca", "inconnu@glo2000.ca", 3]})
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+        headers = [(result["message_index"], result["header"])
+                   for result in response["payload"]["results"]]
+        self.assertEqual(headers, [(0, gloutils.Headers.ERROR)] * 3 + [
+            (1, gloutils.Headers.OK), (1, gloutils.Headers.ERROR),
+            (1, gloutils.Headers.ERROR)])
+        self.assertEqual(self._inbox_count(), count + 1)
+        self.assertServerAlive()
+
+
+class MalformedSendingSQLiteTest(MalformedSendingTest):
+    """Envois malformés sur le stockage SQLite."""
+
+    STORAGE = "sqlite"
+
+
+class SearchTest(_ServerTestCase):
+    """Recherches sur le stockage par fichiers."""
+
+    def test_query_with_too_many_terms_is_refused(self) -> None:
+        connection = self._connect()
+        self.addCleanup(connection.close)
+        connection.request(gloutils.Headers.AUTH_LOGIN,
+                           {"username": "alice", "password": _PASSWORD})
+        words = [f"mot{index}" for index in range(glosearch.MAX_QUERY_TERMS + 1)]
+        for count, header in ((len(words) - 1, gloutils.Headers.OK),
+                              (len(words), gloutils.Headers.ERROR)):
+            with self.subTest(count=count):
+                response = connection.request(gloutils.Headers.INBOX_SEARCH,
+                                              {"query": " ".join(words[:count])})
+                self.assertEqual(response["header"], header)
+        response = connection.request(gloutils.Headers.INBOX_SEARCH,
+                                      {"query": " ".join(f"mot{index}"
+                                                         for index in range(2000))})
+        self.assertEqual(response["header"], gloutils.Headers.ERROR)
+        self.assertEqual(response["payload"]["error_message"], "Recherche invalide.")
+        self.assertEqual(connection.request(gloutils.Headers.STATS_REQUEST)["header"],
+                         gloutils.Headers.OK)
+
+
+class SearchSQLiteTest(SearchTest):
+    """Recherches sur le stockage SQLite."""
+
+    STORAGE = "sqlite"
+
+
+class SessionTest(_ServerTestCase):
+    """Sessions des clients, observées par les métriques du serveur."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.metrics_port = _free_port()
+        cls.SERVER_ARGS = ("--metrics-port", str(cls.metrics_port), "--metrics-admin", "Bob")
+        super().setUpClass()
+
+    def _metrics(self) -> dict[str, float]:
+        url = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode("utf-8")
+        return {name: float(value) for name, value
+                in (line.rsplit(" ", 1) for line in text.splitlines()
+                    if line and not line.startswith("#"))}
+
+    def _wait_metric(self, name: str, value: float) -> dict[str, float]:
+        deadline = time.monotonic() + 20
+        while True:
+            metrics = self._metrics()
+            if metrics.get(name) == value or time.monotonic() > deadline:
+                return metrics
+            time.sleep(0.05)
+
+    def test_disconnect_during_login_leaves_no_session(self) -> None:
+        logins = 'glo_request_seconds_count{header="AUTH_LOGIN"}'
+        before = self._metrics().get(logins, 0)
+        for _ in range(10):
+            connection = self._connect()
+            connection.submit(gloutils.Headers.AUTH_LOGIN,
+                              {"username": "alice", "password": _PASSWORD})
+            # Fermé pendant le hachage du mot de passe
+            connection.close()
+        metrics = self._wait_metric(logins, before + 10)
+        self.assertEqual(metrics[logins], before + 10)
+        metrics = self._wait_metric("glo_connections", 0)
+        self.assertEqual(metrics["glo_connections"], 0)
+        self.assertEqual(metrics["glo_sessions"], 0)
+        self.assertServerAlive()
+
+    def test_username_case_is_the_same_for_every_authentication(self) -> None:
+        connections = [self._connect() for _ in range(3)]
+        for connection in connections:
+            self.addCleanup(connection.close)
+        first, resumed, lower = connections
+        response = first.request(gloutils.Headers.AUTH_LOGIN,
+                                 {"username": "Alice", "password": _PASSWORD, "session": True})
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+        response = resumed.request(gloutils.Headers.AUTH_RESUME,
+                                   {"token": response["payload"]["token"]})
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+        response = lower.request(gloutils.Headers.AUTH_LOGIN,
+                                 {"username": "alice", "password": _PASSWORD})
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+
+        response = first.request(gloutils.Headers.EMAIL_SENDING, _email("alice@glo2000.ca"))
+        self.assertEqual(response["header"], gloutils.Headers.OK)
+        stats = [connection.request(gloutils.Headers.STATS_REQUEST)
+                 for connection in connections]
+        for response in stats:
+            self.assertEqual(response["header"], gloutils.Headers.OK)
+            self.assertEqual(response["payload"], stats[0]["payload"])
+        self.assertGreaterEqual(stats[0]["payload"]["count"], 1)
+        self.assertEqual(self._metrics()["glo_sessions"], 3)
+
+    def test_metrics_header_is_reserved_to_the_admin(self) -> None:
+        for username in (None, "alice", "bob"):
+            with self.subTest(username=username):
+                connection = self._connect()
+                self.addCleanup(connection.close)
+                if username is not None:
+                    response = connection.request(gloutils.Headers.AUTH_LOGIN,
+                                                  {"username": username,
+                                                   "password": _PASSWORD})
+                    self.assertEqual(response["header"], gloutils.Headers.OK)
+                response = connection.request(gloutils.Headers.METRICS)
+                if username == "bob":
+                    self.assertEqual(response["header"], gloutils.Headers.OK)
+                    self.assertIn("glo_sessions", response["payload"]["text"])
+                else:
+                    self.assertEqual(response["header"], gloutils.Headers.ERROR)
+
+
+if __name__ == "__main__":
+    unittest.main()